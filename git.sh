@@ -93,21 +93,24 @@ for commit in $commits; do
         echo "LOG: `date '+%Y-%m-%d %H:%M:%S'` - Set commit date as $commit_date"
         cd .. || exit $?
 
-        # Disable this because it doesn't work for date dependent stuff.........
-        #mkdir -p $GITOUT_DIR/hash
-        #python statsrunner/hashlink.py || exit 1
-        # (and also this on the next line: --new)
+        # Use the time each file took in previous runs to schedule the most expensive files first
+        loop_args="--timings-file $GITOUT_DIR/loop_timings.json"
+        # Reuse the per file output of previous runs for files that haven't changed
+        if [ "$STATS_CACHE_DIR" != "" ]; then
+            loop_args="$loop_args --cache-dir $STATS_CACHE_DIR"
+        fi
+        # Reuse the total of each publisher's files from previous runs, for publishers whose files haven't changed
+        aggregate_args="--incremental --incremental-cache-dir $GITOUT_DIR/aggregate-cache"
 
         # Run the stats commands and save output to log files
         echo "LOG: `date '+%Y-%m-%d %H:%M:%S'` - Calculating stats (loop) for commit $commit"
-        python calculate_stats.py $@ --today "$commit_date" loop > $GITOUT_DIR/logs/${commit}_loop.log || exit 1
+        python calculate_stats.py $@ --today "$commit_date" loop $loop_args > $GITOUT_DIR/logs/${commit}_loop.log || exit 1
         echo "LOG: `date '+%Y-%m-%d %H:%M:%S'` - Calculating stats (aggregate) for commit $commit"
-        python calculate_stats.py $@ --today "$commit_date" aggregate > $GITOUT_DIR/logs/${commit}_aggregate.log || exit 1
+        python calculate_stats.py $@ --today "$commit_date" aggregate $aggregate_args > $GITOUT_DIR/logs/${commit}_aggregate.log || exit 1
         if [ $commit = $current_hash ]; then
 		echo "LOG: `date '+%Y-%m-%d %H:%M:%S'` - Calculating stats (invert) for commit $commit"
     python calculate_stats.py $@ --today "$commit_date" invert > $GITOUT_DIR/logs/${commit}_invert.log
         fi
-        #python statsrunner/hashcopy.py || exit 1
         echo "LOG: `date '+%Y-%m-%d %H:%M:%S'` - Removing output for commit dir: $commit"
         rm -r $GITOUT_DIR/commits/$commit
         mv out $GITOUT_DIR/commits/$commit || exit $?
@@ -28,6 +28,17 @@ for row in reader:
         currency_values[currency][year] = float(value)
 
 
+# A dense table of the reciprocal of each exchange rate, for converting to USD
+# with a multiplication. usd_rates[currency][year - first_year] is 0 where
+# there is no exchange rate for that currency and year.
+first_year = min(min(years) for years in currency_values.values() if years)
+last_year = max(max(years) for years in currency_values.values() if years)
+usd_rates = {}
+for currency, years in currency_values.items():
+    usd_rates[currency] = [1 / years[year] if years.get(year) else 0
+                           for year in range(first_year, last_year + 1)]
+
+
 def get_USD_value(input_currency, input_value, year):
     """Returns a USD value based on an inputted ISO currency, an inputted value and a year
     Inputs:
@@ -38,16 +49,24 @@ def get_USD_value(input_currency, input_value, year):
     Returns:
        Decimal of the USD value. Can be a negative value
     """
+    rates = usd_rates.get(input_currency)
+    if rates is None:
+        # The currency is not in the sheet
+        return Decimal(0)
+    index = int(year) - first_year
+    rate = rates[index] if 0 <= index < len(rates) else 0
+    if not rate:
+        # There is no data for the given year
+        return Decimal(0)
+    return Decimal(rate * float(input_value))
 
-    # Attempt to make a USD conversion
-    try:
-        usd_value = (1 / currency_values[input_currency][int(year)]) * float(input_value)
-    except KeyError:
-        # Arises if the currency is not in the sheet
-        usd_value = 0
-    except ZeroDivisionError:
-        # Arises if there is no data for the given year - i.e. set as zero for that year
-        usd_value = 0
-
-    # Cast to Decimal and return result
-    return Decimal(usd_value)
+
+def get_USD_values(values):
+    """Returns a list of USD values for an iterable of (currency, value, year) tuples, as get_USD_value() does for each one
+    Inputs:
+       values -- iterable of tuples of an ISO currency code, a currency value, and a year (as a string or integer)
+
+    Returns:
+       List of Decimals of the USD values
+    """
+    return [get_USD_value(input_currency, input_value, year) for input_currency, input_value, year in values]
@@ -0,0 +1,226 @@
+"""
+A snapshot of the reference data used by stats.dashboard.
+
+Importing stats.dashboard needs the codelist mappings, codelists, country
+language map, reference spend data, registry ID changes and ckan.json, all of
+which are parsed from the files in helpers/. build() parses them once and
+pickles the result to reference_data.pickle in the helpers directory, along
+with the size and modification time of each source file. load() returns the
+data from the snapshot, rebuilding it first if it is missing, was written by
+a different SNAPSHOT_VERSION, or any of the sources have changed since.
+
+The snapshot is only built when the stats are first imported, so that the
+sources can be fetched in any order (see the README). To rebuild it by hand,
+or to time importing the stats with and without it, run (in the parent
+directory):
+python helpers/reference_data.py [--benchmark]
+
+"""
+from __future__ import print_function
+import argparse
+import csv
+import json
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+# Increment this when the structure of the snapshot changes
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILENAME = 'reference_data.pickle'
+
+MAJOR_VERSIONS = ['1', '2']
+CODELIST_NAMES = [
+    'Version',
+    'ActivityStatus',
+    'Currency',
+    'Sector',
+    'SectorCategory',
+    'DocumentCategory',
+    'AidType',
+    'BudgetNotProvided'
+]
+
+# The files the snapshot is built from, relative to the helpers directory
+SOURCES = (
+    ['mapping-{}.xml'.format(major_version) for major_version in MAJOR_VERSIONS] +
+    ['codelists/{}/{}.json'.format(major_version, codelist_name)
+        for major_version in MAJOR_VERSIONS for codelist_name in CODELIST_NAMES] +
+    [
+        'transparency_indicator/country_lang_map.csv',
+        'transparency_indicator/reference_spend_data.csv',
+        'registry_id_relationships.csv',
+        'ckan.json',
+    ]
+)
+
+
+def get_codelist_mapping(helpers_dir, major_version):
+    """Return the paths of the elements that use codelists, from mapping-{major_version}.xml, relative to an iati-activity."""
+    codelist_mapping_xml = etree.parse(os.path.join(helpers_dir, 'mapping-{}.xml'.format(major_version)))
+    codelist_mappings = [x.text for x in codelist_mapping_xml.xpath('mapping/path')]
+    codelist_mappings = [re.sub(r'^\/\/iati-activity', './', path) for path in codelist_mappings]
+    codelist_mappings = [re.sub(r'^\/\/', './/', path) for path in codelist_mappings]
+    return codelist_mappings
+
+
+def get_codelists(helpers_dir):
+    """Return the set of codes in each codelist, keyed by major version and then codelist name."""
+    codelists = {}
+    for major_version in MAJOR_VERSIONS:
+        codelists[major_version] = {}
+        for codelist_name in CODELIST_NAMES:
+            with open(os.path.join(helpers_dir, 'codelists', major_version, codelist_name + '.json')) as fp:
+                codelists[major_version][codelist_name] = set(c['code'] for c in json.load(fp)['data'])
+    return codelists
+
+
+def get_country_lang_map(helpers_dir):
+    """Return a dictionary of ISO 3166-1 country codes (as key) with a list of ISO 639-1 language codes (as value)."""
+    country_lang_map = {}
+    with open(os.path.join(helpers_dir, 'transparency_indicator', 'country_lang_map.csv')) as fp:
+        for row in csv.reader(fp, delimiter=','):
+            country_lang_map.setdefault(row[0], []).append(row[2])
+    return country_lang_map
+
+
+def get_registry_id_matches(helpers_dir):
+    """Return a dictionary of publishers who have modified their registry ID, from the previous registry ID to the current one.
+
+    This is the same as stats.common.get_registry_id_matches(), but reads from helpers_dir.
+    """
+    with open(os.path.join(helpers_dir, 'registry_id_relationships.csv')) as fp:
+        return dict((row['previous_registry_id'], row['current_registry_id'])
+                    for row in csv.DictReader(fp, delimiter=','))
+
+
+def get_reference_spend_data(helpers_dir, registry_id_matches):
+    """Return the reference spend data for each publisher, keyed by their current registry ID."""
+    reference_spend_data = {}
+    with open(os.path.join(helpers_dir, 'transparency_indicator', 'reference_spend_data.csv')) as fp:
+        for line in csv.reader(fp, delimiter=','):
+            # Update the publisher registry ID, if this publisher has since updated their registry ID
+            pub_registry_id = registry_id_matches.get(line[1], line[1])
+            reference_spend_data[pub_registry_id] = {'publisher_name': line[0],
+                                                     '2014_ref_spend': line[2],
+                                                     '2015_ref_spend': line[6],
+                                                     '2015_official_forecast': line[10],
+                                                     'currency': line[11],
+                                                     'spend_data_error_reported': True if line[12] == 'Y' else False,
+                                                     'DAC': True if 'DAC' in line[3] else False}
+    return reference_spend_data
+
+
+def fingerprint(helpers_dir):
+    """Return the size and modification time of each of the SOURCES."""
+    out = {}
+    for source in SOURCES:
+        try:
+            stat = os.stat(os.path.join(helpers_dir, source))
+            out[source] = (stat.st_size, stat.st_mtime)
+        except OSError:
+            out[source] = None
+    return out
+
+
+def parse(helpers_dir):
+    """Parse the reference data from the SOURCES."""
+    registry_id_matches = get_registry_id_matches(helpers_dir)
+    with open(os.path.join(helpers_dir, 'ckan.json')) as fp:
+        ckan = json.load(fp)
+    return {
+        'codelist_mappings': {major_version: get_codelist_mapping(helpers_dir, major_version)
+                              for major_version in MAJOR_VERSIONS},
+        'codelists': get_codelists(helpers_dir),
+        'country_lang_map': get_country_lang_map(helpers_dir),
+        'registry_id_matches': registry_id_matches,
+        'reference_spend_data': get_reference_spend_data(helpers_dir, registry_id_matches),
+        'ckan': ckan,
+    }
+
+
+def build(helpers_dir='helpers'):
+    """Parse the reference data and write the snapshot. Returns the reference data.
+
+    The snapshot is written to a temporary file and then renamed, so that other
+    processes never load a partial snapshot. If it can't be written (eg. the
+    helpers directory is read only), the reference data is still returned.
+    """
+    sources = fingerprint(helpers_dir)
+    data = parse(helpers_dir)
+    tmp_filename = None
+    try:
+        fd, tmp_filename = tempfile.mkstemp(dir=helpers_dir, prefix='.' + SNAPSHOT_FILENAME)
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'sources': sources, 'data': data}, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, os.path.join(helpers_dir, SNAPSHOT_FILENAME))
+    except (IOError, OSError):
+        # Don't leave a partial snapshot behind
+        if tmp_filename is not None and os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    return data
+
+
+def load(helpers_dir='helpers'):
+    """Return the reference data from the snapshot, rebuilding the snapshot if it is out of date."""
+    try:
+        with open(os.path.join(helpers_dir, SNAPSHOT_FILENAME), 'rb') as fp:
+            snapshot = pickle.load(fp)
+        if snapshot['version'] == SNAPSHOT_VERSION and snapshot['sources'] == fingerprint(helpers_dir):
+            return snapshot['data']
+    except Exception:
+        # Missing, or unreadable by this version of Python
+        pass
+    return build(helpers_dir)
+
+
+def time_import(stats_module, repeat):
+    """Return the fastest of repeat imports of stats_module, each in a new Python process, in seconds."""
+    code = 'import time; start = time.time(); import {0}; print(time.time() - start)'.format(stats_module)
+    return min(float(subprocess.check_output([sys.executable, '-c', code]))
+               for i in range(repeat))
+
+
+def benchmark(helpers_dir, stats_module, repeat):
+    """Print the time taken to parse the reference data, to load the snapshot, and to import stats_module."""
+    start = time.time()
+    parse(helpers_dir)
+    print('Parse reference data: {0:.3f}s'.format(time.time() - start))
+    build(helpers_dir)
+    start = time.time()
+    load(helpers_dir)
+    print('Load snapshot: {0:.3f}s'.format(time.time() - start))
+    print('Import {0}: {1:.3f}s'.format(stats_module, time_import(stats_module, repeat)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the reference data snapshot')
+    parser.add_argument(
+        "--benchmark",
+        help="Time parsing the reference data, loading the snapshot and importing the stats module",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--stats-module",
+        help="Stats module to time the import of with --benchmark, defaults to stats.dashboard",
+        default='stats.dashboard'
+    )
+    parser.add_argument(
+        "--repeat",
+        help="Number of times to import the stats module with --benchmark, the fastest is reported. Defaults to 5",
+        default=5,
+        type=int
+    )
+    args = parser.parse_args()
+    helpers_dir = os.path.dirname(os.path.abspath(__file__))
+    if args.benchmark:
+        # The stats modules read helpers/ relative to the current directory
+        os.chdir(os.path.dirname(helpers_dir))
+        benchmark(helpers_dir, args.stats_module, args.repeat)
+    else:
+        build(helpers_dir)
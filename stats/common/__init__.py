@@ -1,5 +1,6 @@
 import csv
 import datetime
+import functools
 import re
 
 
@@ -11,6 +12,43 @@ def debug(stats, error):
 xsDateRegex = re.compile('(-?[0-9]{4,})-([0-9]{2})-([0-9]{2})')
 
 
+# IATI files use the same dates a great many times, so the parsed date for
+# each raw string is cached (up to this many strings per process)
+ISO_DATE_CACHE_SIZE = 16384
+
+
+@functools.lru_cache(maxsize=ISO_DATE_CACHE_SIZE)
+def parse_iso_date(raw_date):
+    """Return a datetime object for a given textual ISO date string, or None if it is not a valid date
+
+    Keyword arguments:
+    raw_date -- an ISO date as text
+    """
+    # Fast path for dates that start YYYY-MM-DD, which is all that the
+    # regular expression matches of them
+    if raw_date[4:5] == '-' and raw_date[7:8] == '-':
+        try:
+            return datetime.date.fromisoformat(raw_date[:10])
+        except ValueError:
+            pass
+    m1 = xsDateRegex.match(raw_date)
+    if m1:
+        try:
+            return datetime.date(*map(int, m1.groups()))
+        except ValueError:
+            # A ValueError occurs when there is an invalid raw_date,
+            # for example '2015-11-31' or '2015-13-01'
+            return None
+    else:
+        return None
+
+
+def iso_date_cache_info():
+    """Return the hits and misses of the parse_iso_date() cache in this process."""
+    info = parse_iso_date.cache_info()
+    return {'hits': info.hits, 'misses': info.misses}
+
+
 def iso_date_match(raw_date):
     """Return a datetime object for a given textual ISO date string
 
@@ -18,16 +56,7 @@ def iso_date_match(raw_date):
     raw_date -- an ISO date as text
     """
     if raw_date:
-        m1 = xsDateRegex.match(raw_date)
-        if m1:
-            try:
-                return datetime.date(*map(int, m1.groups()))
-            except ValueError:
-                # A ValueError occurs when there is an invalid raw_date,
-                # for example '2015-11-31' or '2015-13-01'
-                return None
-        else:
-            return None
+        return parse_iso_date(raw_date)
 
 
 def iso_date(element):
@@ -54,10 +83,12 @@ def transaction_date(transaction):
        Returns:
          datetime object or None
     """
-    if transaction.find('transaction-date') is not None:
-        return iso_date(transaction.find('transaction-date'))
-    elif transaction.find('value') is not None:
-        return iso_date_match(transaction.find('value').attrib.get('value-date'))
+    transaction_date_element = transaction.find('transaction-date')
+    if transaction_date_element is not None:
+        return iso_date(transaction_date_element)
+    value = transaction.find('value')
+    if value is not None:
+        return iso_date_match(value.attrib.get('value-date'))
 
 
 def budget_year(budget):
@@ -68,9 +99,18 @@ def budget_year(budget):
        Returns:
          year (integer) or None
     """
-    start = iso_date(budget.find('period-start'))
-    end = iso_date(budget.find('period-end'))
+    return period_year(iso_date(budget.find('period-start')), iso_date(budget.find('period-end')))
+
 
+def period_year(start, end):
+    """Returns the year of a period (normally of a budget), as budget_year() does.
+
+       Input:
+         start -- datetime object or None
+         end -- datetime object or None
+       Returns:
+         year (integer) or None
+    """
     if start and end:
         if (end - start).days <= 370:
             if end.month >= 7:
@@ -88,7 +128,7 @@ def planned_disbursement_year(planned_disbursement):
     end = iso_date(planned_disbursement.find('period-end'))
 
     if start and end:
-        return budget_year(planned_disbursement)
+        return period_year(start, end)
     elif start:
         return start.year
     else:
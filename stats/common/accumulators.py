@@ -0,0 +1,213 @@
+"""
+Accumulators, which say how the values of a stat are summed by the aggregation.
+
+Each of the returns_* decorators in stats.common.decorators declares the
+accumulator for its stat, as the accumulator attribute of the decorated
+function. An accumulator has two methods:
+
+blank() returns a new total with nothing in it, which is also what the stat
+returns when self.blank is True.
+
+merge(total, value) adds a value of the stat (or another total) into total,
+and returns the new total. Merging is associative, so totals can be built up
+per file, per publisher and for all the data in any grouping. It takes parts
+of value into total rather than copying them, so value must not be used
+afterwards.
+
+Stats without a declared accumulator are merged with merge_value(), which adds
+numbers and merges dictionaries recursively, whatever their depth, in the same
+way that the declared accumulators merge anything not of their declared shape.
+
+"""
+from collections import defaultdict
+import copy
+from decimal import Decimal
+import datetime
+import functools
+
+import dateutil.parser
+import dateutil.tz
+
+NUMBER_TYPES = (int, Decimal, float)
+DICT_TYPES = (dict, defaultdict)
+
+
+def merge_item(total, k, v):
+    """Merge v into the dictionary total, for the key k.
+
+    Dictionaries are merged recursively and numbers added. Where total has
+    anything else (eg. None or a string) for a key, it is kept.
+    """
+    if type(v) in DICT_TYPES:
+        if k in total:
+            merge_dicts(total[k], v)
+        else:
+            total[k] = v
+    elif type(total) is not defaultdict and k not in total:
+        total[k] = v
+    elif type(total[k]) in NUMBER_TYPES:
+        total[k] += v
+
+
+def merge_dicts(total, value):
+    """Merge the dictionary value into the dictionary total (unless total is None)."""
+    if total is None:
+        return
+    for k, v in value.items():
+        merge_item(total, k, v)
+
+
+def merge_value(total, value):
+    """Merge value into total, for stats of any shape. Returns the new total."""
+    if type(value) in DICT_TYPES:
+        merge_dicts(total, value)
+    elif type(total) in NUMBER_TYPES:
+        total += value
+    return total
+
+
+class Sum(object):
+    """A number, eg. a count."""
+
+    def blank(self):
+        return 0
+
+    def merge(self, total, value):
+        if type(value) in NUMBER_TYPES and type(total) in NUMBER_TYPES:
+            return total + value
+        return merge_value(total, value)
+
+
+class Counter(object):
+    """Numbers keyed by depth levels of dictionaries, eg. depth 2 for a count by type and then by year."""
+
+    def __init__(self, depth):
+        self.depth = depth
+
+    def blank(self):
+        factory = int
+        for i in range(self.depth - 1):
+            factory = functools.partial(defaultdict, factory)
+        return defaultdict(factory)
+
+    def merge(self, total, value):
+        if type(value) in DICT_TYPES and type(total) in DICT_TYPES:
+            merge_counts(total, value, self.depth)
+            return total
+        return merge_value(total, value)
+
+
+def merge_counts(total, value, depth):
+    """Merge the counts in value into total, where the counts are depth levels of dictionaries deep.
+
+    Anything not of the declared shape is merged by merge_item().
+    """
+    if depth == 1:
+        for k, v in value.items():
+            if type(v) in NUMBER_TYPES:
+                if k in total:
+                    if type(total[k]) in NUMBER_TYPES:
+                        total[k] += v
+                        continue
+                elif type(total) is not defaultdict:
+                    total[k] = v
+                    continue
+            merge_item(total, k, v)
+    else:
+        for k, v in value.items():
+            if type(v) in DICT_TYPES and k in total and type(total[k]) in DICT_TYPES:
+                merge_counts(total[k], v, depth - 1)
+            else:
+                merge_item(total, k, v)
+
+
+class Dict(object):
+    """A dictionary of any depth, merged with merge_value()."""
+
+    def blank(self):
+        return {}
+
+    def merge(self, total, value):
+        return merge_value(total, value)
+
+
+class NoAggregation(object):
+    """A stat that isn't aggregated, so is None in every total."""
+
+    def blank(self):
+        return None
+
+    def merge(self, total, value):
+        return total
+
+
+class Blank(object):
+    """A stat without a declared accumulator, starting from the value it returns when self.blank is True."""
+
+    def __init__(self, blank_value):
+        self.blank_value = blank_value
+
+    def blank(self):
+        return copy.deepcopy(self.blank_value)
+
+    def merge(self, total, value):
+        return merge_value(total, value)
+
+
+class LargestDateAggregator(object):
+    """The latest of the dates added to it, written to the JSON as its value."""
+    value = datetime.datetime(1900, 1, 1, tzinfo=dateutil.tz.tzutc())
+
+    def __add__(self, x):
+        if type(x) == datetime.datetime:
+            pass
+        elif type(x) == LargestDateAggregator:
+            x = x.value
+        else:
+            x = dateutil.parser.parse(x)
+        if x > self.value:
+            self.value = x
+        return self
+
+
+class MaxDate(object):
+    """The latest of the dates (datetimes, or strings that dateutil can parse)."""
+
+    def blank(self):
+        return LargestDateAggregator()
+
+    def merge(self, total, value):
+        if value is None:
+            return total
+        return total + value
+
+
+class LargestAggregator(object):
+    """The largest of the integers added to it, written to the JSON as its value."""
+    value = 0
+
+    def __add__(self, x):
+        if type(x) == LargestAggregator:
+            x = x.value
+        try:
+            x = int(x)
+        except TypeError:
+            x = 0
+        except ValueError:
+            x = 0
+        if x > self.value:
+            self.value = x
+        return self
+
+    def __int__(self):
+        return self.value
+
+
+class Largest(object):
+    """The largest of the integers (or values that int() accepts)."""
+
+    def blank(self):
+        return LargestAggregator()
+
+    def merge(self, total, value):
+        return total + value
@@ -1,7 +1,4 @@
-from collections import defaultdict
-import datetime
-import dateutil.parser
-import dateutil.tz
+from stats.common import accumulators
 
 
 # Memoize decorator caches the result of the wrapped function
@@ -19,26 +16,28 @@ def memoize(f):
 def returns_numberdictdictdict(f):
     def wrapper(self, *args, **kwargs):
         if self.blank:
-            return defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+            return wrapper.accumulator.blank()
         else:
             out = f(self, *args, **kwargs)
             if out is None:
                 return {}
             else:
                 return out
+    wrapper.accumulator = accumulators.Counter(3)
     return wrapper
 
 
 def returns_numberdictdict(f):
     def wrapper(self, *args, **kwargs):
         if self.blank:
-            return defaultdict(lambda: defaultdict(int))
+            return wrapper.accumulator.blank()
         else:
             out = f(self, *args, **kwargs)
             if out is None:
                 return {}
             else:
                 return out
+    wrapper.accumulator = accumulators.Counter(2)
     return wrapper
 
 
@@ -46,13 +45,14 @@ def returns_numberdict(f):
     """ Dectorator for dictionaries of integers. """
     def wrapper(self, *args, **kwargs):
         if self.blank:
-            return defaultdict(int)
+            return wrapper.accumulator.blank()
         else:
             out = f(self, *args, **kwargs)
             if out is None:
                 return {}
             else:
                 return out
+    wrapper.accumulator = accumulators.Counter(1)
     return wrapper
 
 
@@ -60,13 +60,14 @@ def returns_dict(f):
     """ Dectorator for dictionaries. """
     def wrapper(self, *args, **kwargs):
         if self.blank:
-            return {}
+            return wrapper.accumulator.blank()
         else:
             out = f(self, *args, **kwargs)
             if out is None:
                 return {}
             else:
                 return out
+    wrapper.accumulator = accumulators.Dict()
     return wrapper
 
 
@@ -74,13 +75,14 @@ def returns_number(f):
     """ Decorator for integers. """
     def wrapper(self, *args, **kwargs):
         if self.blank:
-            return 0
+            return wrapper.accumulator.blank()
         else:
             out = f(self, *args, **kwargs)
             if out is None:
                 return 0
             else:
                 return out
+    wrapper.accumulator = accumulators.Sum()
     return wrapper
 
 
@@ -88,33 +90,18 @@ def no_aggregation(f):
     """ Decorator that perevents aggreagation. """
     def wrapper(self, *args, **kwargs):
         if self.blank:
-            return None
+            return wrapper.accumulator.blank()
         else:
             return f(self, *args, **kwargs)
+    wrapper.accumulator = accumulators.NoAggregation()
     return wrapper
 
 
 def returns_date(f):
-    class LargestDateAggregator(object):
-        value = datetime.datetime(1900, 1, 1, tzinfo=dateutil.tz.tzutc())
-
-        def __add__(self, x):
-            if type(x) == datetime.datetime:
-                pass
-            elif type(x) == LargestDateAggregator:
-                x = x.value
-            else:
-                x = dateutil.parser.parse(x)
-            if x > self.value:
-                self.value = x
-            return self
-
-    def __int__(self):
-        return self.value
-
     def wrapper(self, *args, **kwargs):
         if self.blank:
-            return LargestDateAggregator()
+            return wrapper.accumulator.blank()
         else:
             return f(self, *args, **kwargs)
+    wrapper.accumulator = accumulators.MaxDate()
     return wrapper
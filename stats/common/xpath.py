@@ -0,0 +1,33 @@
+"""
+A registry of compiled XPath expressions.
+
+element.xpath(path) parses path every time it is called, and the stats run the
+same expressions on every activity. xpath() compiles each expression (with its
+namespaces) into an etree.XPath object the first time it is used in a process,
+and reuses that afterwards.
+
+"""
+from lxml import etree
+
+XML_NAMESPACES = {'xml': 'http://www.w3.org/XML/1998/namespace'}
+
+# Compiled etree.XPath objects, keyed by (expression, namespaces)
+compiled_xpaths = {}
+xpath_cache_info = {'compiles': 0, 'hits': 0}
+
+
+def compile_xpath(path, namespaces=None):
+    """Return the compiled etree.XPath for path, compiling it if this is the first time it has been used."""
+    key = (path, tuple(sorted(namespaces.items())) if namespaces else None)
+    compiled = compiled_xpaths.get(key)
+    if compiled is None:
+        compiled = compiled_xpaths[key] = etree.XPath(path, namespaces=namespaces)
+        xpath_cache_info['compiles'] += 1
+    else:
+        xpath_cache_info['hits'] += 1
+    return compiled
+
+
+def xpath(element, path, namespaces=None):
+    """Evaluate path against element, as element.xpath(path, namespaces=namespaces) does, using a compiled expression."""
+    return compile_xpath(path, namespaces)(element)
@@ -7,13 +7,13 @@ from __future__ import print_function
 from lxml import etree
 import datetime
 from datetime import date
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, namedtuple, OrderedDict
 from decimal import Decimal
 import decimal
+import functools
 import os
 import re
 import json
-import csv
 
 from stats.common.decorators import (
     memoize,
@@ -27,15 +27,27 @@ from stats.common.decorators import (
 from stats.common import (
     budget_year,
     debug,
-    get_registry_id_matches,
     iso_date,
+    iso_date_cache_info,
     iso_date_match,
     planned_disbursement_year,
     transaction_date,
 )
+from stats.common.xpath import (
+    compile_xpath,
+    XML_NAMESPACES,
+    xpath,
+    xpath_cache_info,
+)
 
 import iatirulesets
-from helpers.currency_conversion import get_USD_value
+from helpers.currency_conversion import get_USD_value, get_USD_values
+import helpers.reference_data
+
+# None of the stats in this module use self.today, so the loop's result cache
+# (statsrunner/cache.py) can reuse their output between runs for different dates.
+# Remove this if a stat here starts depending on the date.
+uses_today = False
 
 
 def add_years(d, years):
@@ -101,67 +113,19 @@ def convert_to_float(x):
         return 0
 
 
-# Import codelists
+# Reference data, loaded from a snapshot that is rebuilt when the files in helpers/ change
+reference_data = helpers.reference_data.load()
+
 # In order to test whether or not correct codelist values are being used in the data
 # we need to pull in data about how codelists map to elements
-def get_codelist_mapping(major_version):
-    codelist_mapping_xml = etree.parse('helpers/mapping-{}.xml'.format(major_version))
-    codelist_mappings = [x.text for x in codelist_mapping_xml.xpath('mapping/path')]
-    codelist_mappings = [re.sub(r'^\/\/iati-activity', './', path) for path in codelist_mappings]
-    codelist_mappings = [re.sub(r'^\/\/', './/', path) for path in codelist_mappings]
-    return codelist_mappings
-
-
-codelist_mappings = {major_version: get_codelist_mapping(major_version) for major_version in ['1', '2']}
-
-CODELISTS = {'1': {}, '2': {}}
-for major_version in ['1', '2']:
-    for codelist_name in [
-        'Version',
-        'ActivityStatus',
-        'Currency',
-        'Sector',
-        'SectorCategory',
-        'DocumentCategory',
-        'AidType',
-        'BudgetNotProvided'
-    ]:
-        CODELISTS[major_version][codelist_name] = set(
-            c['code'] for c in json.load(
-                open('helpers/codelists/{}/{}.json'.format(major_version, codelist_name))
-            )['data']
-        )
-
+codelist_mappings = reference_data['codelist_mappings']
+CODELISTS = reference_data['codelists']
 
-# Import country language mappings, and save as a dictionary
 # Contains a dictionary of ISO 3166-1 country codes (as key) with a list of ISO 639-1 language codes (as value)
-reader = csv.reader(open('helpers/transparency_indicator/country_lang_map.csv'), delimiter=',')
-country_lang_map = {}
-for row in reader:
-    if row[0] not in country_lang_map.keys():
-        country_lang_map[row[0]] = [row[2]]
-    else:
-        country_lang_map[row[0]].append(row[2])
+country_lang_map = reference_data['country_lang_map']
 
-
-# Import reference spending data, and save as a dictionary
-reference_spend_data = {}
-with open('helpers/transparency_indicator/reference_spend_data.csv', 'r') as csv_file:
-    reader = csv.reader(csv_file, delimiter=',')
-    for line in reader:
-        pub_registry_id = line[1]
-
-        # Update the publisher registry ID, if this publisher has since updated their registry ID
-        if pub_registry_id in get_registry_id_matches().keys():
-            pub_registry_id = get_registry_id_matches()[pub_registry_id]
-
-        reference_spend_data[pub_registry_id] = {'publisher_name': line[0],
-                                                 '2014_ref_spend': line[2],
-                                                 '2015_ref_spend': line[6],
-                                                 '2015_official_forecast': line[10],
-                                                 'currency': line[11],
-                                                 'spend_data_error_reported': True if line[12] == 'Y' else False,
-                                                 'DAC': True if 'DAC' in line[3] else False}
+# Reference spending data, keyed by the publisher's current registry ID
+reference_spend_data = reference_data['reference_spend_data']
 
 
 def element_to_count_dict(element, path, count_dict, count_multiple=False):
@@ -185,35 +149,106 @@ def element_to_count_dict(element, path, count_dict, count_multiple=False):
     return count_dict
 
 
-def valid_date(date_element):
-    if date_element is None:
-        return False
-    schema_root = etree.XML('''
-        <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
-            <xsd:element name="activity-date" type="dateType"/>
-            <xsd:element name="transaction-date" type="dateType"/>
-            <xsd:element name="period-start" type="dateType"/>
-            <xsd:element name="period-end" type="dateType"/>
-            <xsd:complexType name="dateType" mixed="true">
+# Schemas used by valid_date(), valid_url() and valid_value(), compiled once when the module is loaded
+date_schema = etree.XMLSchema(etree.XML('''
+    <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+        <xsd:element name="activity-date" type="dateType"/>
+        <xsd:element name="transaction-date" type="dateType"/>
+        <xsd:element name="period-start" type="dateType"/>
+        <xsd:element name="period-end" type="dateType"/>
+        <xsd:complexType name="dateType" mixed="true">
+            <xsd:sequence>
+                <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
+            </xsd:sequence>
+            <xsd:attribute name="iso-date" type="xsd:date" use="required"/>
+            <xsd:anyAttribute processContents="lax"/>
+        </xsd:complexType>
+        <xsd:element name="value">
+            <xsd:complexType mixed="true">
                 <xsd:sequence>
                     <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
                 </xsd:sequence>
-                <xsd:attribute name="iso-date" type="xsd:date" use="required"/>
+                <xsd:attribute name="value-date" type="xsd:date" use="required"/>
                 <xsd:anyAttribute processContents="lax"/>
             </xsd:complexType>
-            <xsd:element name="value">
-                <xsd:complexType mixed="true">
-                    <xsd:sequence>
-                        <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
-                    </xsd:sequence>
-                    <xsd:attribute name="value-date" type="xsd:date" use="required"/>
-                    <xsd:anyAttribute processContents="lax"/>
-                </xsd:complexType>
-            </xsd:element>
-        </xsd:schema>
-    ''')
-    schema = etree.XMLSchema(schema_root)
-    return schema.validate(date_element)
+        </xsd:element>
+    </xsd:schema>
+'''))
+
+url_schema = etree.XMLSchema(etree.XML('''
+    <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+        <xsd:element name="document-link">
+            <xsd:complexType mixed="true">
+                <xsd:sequence>
+                    <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
+                </xsd:sequence>
+                <xsd:attribute name="url" type="xsd:anyURI" use="required"/>
+                <xsd:anyAttribute processContents="lax"/>
+            </xsd:complexType>
+        </xsd:element>
+        <xsd:element name="activity-website">
+            <xsd:complexType>
+                <xsd:simpleContent>
+                    <xsd:extension base="xsd:anyURI">
+                        <xsd:anyAttribute processContents="lax"/>
+                    </xsd:extension>
+                </xsd:simpleContent>
+            </xsd:complexType>
+        </xsd:element>
+    </xsd:schema>
+'''))
+
+value_schema = etree.XMLSchema(etree.XML('''
+    <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+        <xsd:element name="value">
+            <xsd:complexType>
+                <xsd:simpleContent>
+                    <xsd:extension base="xsd:decimal">
+                        <xsd:anyAttribute processContents="lax"/>
+                    </xsd:extension>
+                </xsd:simpleContent>
+            </xsd:complexType>
+        </xsd:element>
+    </xsd:schema>
+'''))
+
+# The attribute holding the date for each element that valid_date() accepts
+date_attributes = {
+    'activity-date': 'iso-date',
+    'transaction-date': 'iso-date',
+    'period-start': 'iso-date',
+    'period-end': 'iso-date',
+    'value': 'value-date',
+}
+# An xsd:date without a timezone and with a four digit year
+simple_date_re = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})\Z')
+# The lexical space of xsd:decimal, after whitespace is collapsed
+decimal_re = re.compile(r'[ \t\n\r]*[+-]?([0-9]+(\.[0-9]*)?|\.[0-9]+)[ \t\n\r]*\Z')
+
+
+def simple_content(element):
+    """ Returns True if element has no children (including comments) and no namespaced attributes (eg. xsi:type),
+        so that validating it against the schemas above only depends on its text and own attributes.
+    """
+    return len(element) == 0 and not any(key.startswith('{') for key in element.attrib)
+
+
+def valid_date(date_element):
+    if date_element is None:
+        return False
+    # Fast path for the common case of a YYYY-MM-DD date, giving the same result as the schema
+    if date_element.tag in date_attributes and simple_content(date_element):
+        raw_date = date_element.attrib.get(date_attributes[date_element.tag])
+        if raw_date is None:
+            return False
+        m = simple_date_re.match(raw_date)
+        if m:
+            try:
+                datetime.date(*map(int, m.groups()))
+                return True
+            except ValueError:
+                return False
+    return date_schema.validate(date_element)
 
 
 def valid_url(element):
@@ -231,50 +266,32 @@ def valid_url(element):
         # Return false if it's empty or not an absolute url
         return False
 
-    schema_root = etree.XML('''
-        <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
-            <xsd:element name="document-link">
-                <xsd:complexType mixed="true">
-                    <xsd:sequence>
-                        <xsd:any minOccurs="0" maxOccurs="unbounded" processContents="lax" />
-                    </xsd:sequence>
-                    <xsd:attribute name="url" type="xsd:anyURI" use="required"/>
-                    <xsd:anyAttribute processContents="lax"/>
-                </xsd:complexType>
-            </xsd:element>
-            <xsd:element name="activity-website">
-                <xsd:complexType>
-                    <xsd:simpleContent>
-                        <xsd:extension base="xsd:anyURI">
-                            <xsd:anyAttribute processContents="lax"/>
-                        </xsd:extension>
-                    </xsd:simpleContent>
-                </xsd:complexType>
-            </xsd:element>
-        </xsd:schema>
-    ''')
-    schema = etree.XMLSchema(schema_root)
-    return schema.validate(element)
+    return url_schema.validate(element)
 
 
 def valid_value(value_element):
     if value_element is None:
         return False
-    schema_root = etree.XML('''
-        <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
-            <xsd:element name="value">
-                <xsd:complexType>
-                    <xsd:simpleContent>
-                        <xsd:extension base="xsd:decimal">
-                            <xsd:anyAttribute processContents="lax"/>
-                        </xsd:extension>
-                    </xsd:simpleContent>
-                </xsd:complexType>
-            </xsd:element>
-        </xsd:schema>
-    ''')
-    schema = etree.XMLSchema(schema_root)
-    return schema.validate(value_element)
+    # Fast path for a value with just text, giving the same result as the schema
+    if value_element.tag == 'value' and simple_content(value_element):
+        return decimal_re.match(value_element.text or '') is not None
+    return value_schema.validate(value_element)
+
+
+def valid_stream(inputfile, xmlschema):
+    """Validate the file at inputfile against xmlschema, without loading the whole document into memory.
+
+    Returns True if the file is valid, False otherwise.
+    """
+    try:
+        for event, element in etree.iterparse(inputfile, schema=xmlschema):
+            if element.getparent() is not None and element.getparent().getparent() is None:
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        return True
+    except etree.XMLSyntaxError:
+        return False
 
 
 def valid_coords(x):
@@ -309,19 +326,44 @@ def get_currency(iati_activity_object, budget_pd_transaction):
     currency = iati_activity_object.element.attrib.get('default-currency')
 
     # If there is a currency within the value element, overwrite the default currency
-    if budget_pd_transaction.xpath('value/@currency'):
-        currency = budget_pd_transaction.xpath('value/@currency')[0]
+    if xpath(budget_pd_transaction, 'value/@currency'):
+        currency = xpath(budget_pd_transaction, 'value/@currency')[0]
 
     # Return the currency
     return currency
 
 
+def child_index(element):
+    """ Returns a dictionary of the direct children of element, keyed by tag, in document order. """
+    children = defaultdict(list)
+    for child in element:
+        children[child.tag].append(child)
+    return children
+
+
+# The parts of a transaction used by the transaction stats, see ActivityStats._transactions()
+Transaction = namedtuple('Transaction', ['element', 'children', 'type_code', 'type_codes', 'value', 'currency', 'date'])
+
+
+def usd_by_type_by_year(sums):
+    """Returns sums of values by type, currency and year (eg. from sum_budgets_by_type_by_year())
+       converted to USD, as sums by type and year under the currency 'USD'.
+    """
+    out = defaultdict(lambda: defaultdict(lambda: defaultdict(Decimal)))
+    for value_type, data in sums.items():
+        for currency, years in data.items():
+            for year, value in years.items():
+                if None not in [currency, value, year]:
+                    out[value_type]['USD'][year] += get_USD_value(currency, value, year)
+    return out
+
+
 def has_xml_lang(obj):
     """Test if an obj has an XML lang attribute declared.
        Input: an etree XML object, for example a narrative element
        Return: True if @xml:lang is present, or False if not
     """
-    return len(obj.xpath("@xml:lang", namespaces={"xml": "http://www.w3.org/XML/1998/namespace"})) > 0
+    return len(xpath(obj, "@xml:lang", namespaces=XML_NAMESPACES)) > 0
 
 
 def get_language(major_version, iati_activity_obj, title_or_description_obj):
@@ -338,18 +380,18 @@ def get_language(major_version, iati_activity_obj, title_or_description_obj):
 
     # Get default language for this activity
     if has_xml_lang(iati_activity_obj):
-        default_lang = iati_activity_obj.xpath("@xml:lang", namespaces={"xml": "http://www.w3.org/XML/1998/namespace"})[0]
+        default_lang = xpath(iati_activity_obj, "@xml:lang", namespaces=XML_NAMESPACES)[0]
 
     if major_version == '2':
         for narrative_obj in title_or_description_obj.findall('narrative'):
             if has_xml_lang(narrative_obj):
-                langs.append(narrative_obj.xpath("@xml:lang", namespaces={"xml": "http://www.w3.org/XML/1998/namespace"})[0])
+                langs.append(xpath(narrative_obj, "@xml:lang", namespaces=XML_NAMESPACES)[0])
             elif has_xml_lang(iati_activity_obj):
                 langs.append(default_lang)
 
     else:
         if has_xml_lang(title_or_description_obj):
-            langs.append(title_or_description_obj.xpath("@xml:lang", namespaces={"xml": "http://www.w3.org/XML/1998/namespace"})[0])
+            langs.append(xpath(title_or_description_obj, "@xml:lang", namespaces=XML_NAMESPACES)[0])
         elif has_xml_lang(iati_activity_obj):
             langs.append(default_lang)
 
@@ -357,6 +399,34 @@ def get_language(major_version, iati_activity_obj, title_or_description_obj):
     return list(set(langs))
 
 
+# Rulesets from helpers/rulesets, keyed by name, see get_ruleset()
+rulesets = {}
+# A test for each rule of each ruleset, see get_ruleset_rule_tests()
+ruleset_rule_tests = {}
+
+
+def get_ruleset(ruleset_name):
+    """ Returns the named ruleset, loading it the first time it is used in this process. """
+    if ruleset_name not in rulesets:
+        with open('helpers/rulesets/{0}.json'.format(ruleset_name)) as fp:
+            rulesets[ruleset_name] = json.load(fp, object_pairs_hook=OrderedDict)
+    return rulesets[ruleset_name]
+
+
+def get_ruleset_rule_tests(ruleset_name):
+    """ Returns a list of (context, rule name, test) for each rule of the named ruleset,
+        where test(element) returns whether element passes that one rule.
+    """
+    if ruleset_name not in ruleset_rule_tests:
+        tests = []
+        for context, rules in get_ruleset(ruleset_name).items():
+            for rule_name, rule in rules.items():
+                rule_ruleset = OrderedDict([(context, OrderedDict([(rule_name, rule)]))])
+                tests.append((context, rule_name, functools.partial(iatirulesets.test_ruleset_subelement, rule_ruleset)))
+        ruleset_rule_tests[ruleset_name] = tests
+    return ruleset_rule_tests[ruleset_name]
+
+
 # Deals with elements that are in both organisation and activity files
 class CommonSharedElements(object):
     blank = False
@@ -409,8 +479,16 @@ class CommonSharedElements(object):
     def _ruleset_passes(self):
         out = {}
         for ruleset_name in ['standard']:
-            ruleset = json.load(open('helpers/rulesets/{0}.json'.format(ruleset_name)), object_pairs_hook=OrderedDict)
-            out[ruleset_name] = int(iatirulesets.test_ruleset_subelement(ruleset, self.element))
+            out[ruleset_name] = int(iatirulesets.test_ruleset_subelement(get_ruleset(ruleset_name), self.element))
+        return out
+
+    @returns_numberdictdictdict
+    def _ruleset_rule_passes(self):
+        """ The number of passes and fails of each rule, keyed by ruleset name, then context and rule name. """
+        out = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+        for ruleset_name in ['standard']:
+            for context, rule_name, test in get_ruleset_rule_tests(ruleset_name):
+                out[ruleset_name]['{0} {1}'.format(context, rule_name)]['pass' if test(self.element) else 'fail'] += 1
         return out
 
 
@@ -443,9 +521,49 @@ class ActivityStats(CommonSharedElements):
         else:
             return None
 
+    @memoize
+    def _children(self):
+        """ Returns the direct children of the activity, keyed by tag (see child_index()), so that stats
+            share a single pass over the activity rather than each searching it.
+        """
+        return child_index(self.element)
+
+    @memoize
+    def _transactions(self):
+        """ Returns a list of Transaction tuples for the transactions of the activity, with the
+            transaction-type code(s), first value element, currency (as get_currency()) and date
+            (as transaction_date()) of each worked out once.
+        """
+        transactions = []
+        for transaction in self._children().get('transaction', []):
+            children = child_index(transaction)
+            type_codes = [x.attrib.get('code') for x in children.get('transaction-type', [])]
+            values = children.get('value', [])
+            value = values[0] if values else None
+            currency = self.element.attrib.get('default-currency')
+            for x in values:
+                if 'currency' in x.attrib:
+                    currency = x.attrib['currency']
+                    break
+            if children.get('transaction-date'):
+                t_date = iso_date(children['transaction-date'][0])
+            elif value is not None:
+                t_date = iso_date_match(value.attrib.get('value-date'))
+            else:
+                t_date = None
+            transactions.append(Transaction(
+                element=transaction,
+                children=children,
+                type_code=type_codes[0] if type_codes else None,
+                type_codes=type_codes,
+                value=value,
+                currency=currency,
+                date=t_date))
+        return transactions
+
     @returns_numberdict
     def currencies(self):
-        currencies = [x.find('value').get('currency') for x in self.element.findall('transaction') if x.find('value') is not None]
+        currencies = [x.value.get('currency') for x in self._transactions() if x.value is not None]
         currencies = [c if c else self.element.get('default-currency') for c in currencies]
         return dict((c, 1) for c in currencies)
 
@@ -558,7 +676,7 @@ class ActivityStats(CommonSharedElements):
     def codelist_values(self):
         out = defaultdict(lambda: defaultdict(int))
         for path in codelist_mappings[self._major_version()]:
-            for value in self.element.xpath(path):
+            for value in xpath(self.element, path):
                 out[path][value] += 1
         return out
 
@@ -566,7 +684,7 @@ class ActivityStats(CommonSharedElements):
     def codelist_values_by_major_version(self):
         out = defaultdict(lambda: defaultdict(int))
         for path in codelist_mappings[self._major_version()]:
-            for value in self.element.xpath(path):
+            for value in xpath(self.element, path):
                 out[path][value] += 1
         return {self._major_version(): out}
 
@@ -584,26 +702,24 @@ class ActivityStats(CommonSharedElements):
                 'result/@aggregation-status',
                 'transaction/@humanitarian'
         ]:
-            for value in self.element.xpath(path):
+            for value in xpath(self.element, path):
                 out[path][value] += 1
         return out
 
     @returns_numberdict
     def provider_org(self):
         out = defaultdict(int)
-        for transaction in self.element.findall('transaction'):
-            provider_org = transaction.find('provider-org')
-            if provider_org is not None:
-                out[provider_org.attrib.get('ref')] += 1
+        for transaction in self._transactions():
+            if transaction.children.get('provider-org'):
+                out[transaction.children['provider-org'][0].attrib.get('ref')] += 1
         return out
 
     @returns_numberdict
     def receiver_org(self):
         out = defaultdict(int)
-        for transaction in self.element.findall('transaction'):
-            receiver_org = transaction.find('receiver-org')
-            if receiver_org is not None:
-                out[receiver_org.attrib.get('ref')] += 1
+        for transaction in self._transactions():
+            if transaction.children.get('receiver-org'):
+                out[transaction.children['receiver-org'][0].attrib.get('ref')] += 1
         return out
 
     def _transaction_year(self, transaction):
@@ -619,7 +735,7 @@ class ActivityStats(CommonSharedElements):
           False -- Secondary-reporter flag not set, or evaulates to False
         """
         return bool(list((filter(lambda x: int(x) if str(x).isdigit() else 0,
-                    self.element.xpath('reporting-org/@secondary-reporter')))))
+                    xpath(self.element, 'reporting-org/@secondary-reporter')))))
 
     @returns_dict
     def activities_secondary_reported(self):
@@ -635,8 +751,8 @@ class ActivityStats(CommonSharedElements):
            Output: a date object, or None if no value date found
         """
         # Get enddate. An 'actual end date' is preferred over a 'planned end date'
-        end_date_list = (self.element.xpath('activity-date[@type="{}"]'.format(self._actual_end_code())) or
-                         self.element.xpath('activity-date[@type="{}"]'.format(self._planned_end_code())))
+        end_date_list = (xpath(self.element, 'activity-date[@type="{}"]'.format(self._actual_end_code())) or
+                         xpath(self.element, 'activity-date[@type="{}"]'.format(self._planned_end_code())))
 
         # If there is a date, convert to a date object
         if end_date_list:
@@ -655,28 +771,32 @@ class ActivityStats(CommonSharedElements):
 
         # Compute the sum of all commitments
 
+        def value_text(transaction):
+            texts = [x.text for x in transaction.children.get('value', []) if x.text is not None]
+            return texts[0] if texts else None
+
         # Build a list of tuples, each tuple contains: (currency, value, date)
         commitment_transactions = [(
-            get_currency(self, transaction),
-            transaction.xpath('value/text()')[0] if transaction.xpath('value/text()') else None,
-            transaction_date(transaction)
-        ) for transaction in self.element.xpath('transaction[transaction-type/@code="{}"]'.format(self._commitment_code()))]
+            transaction.currency,
+            value_text(transaction),
+            transaction.date
+        ) for transaction in self._transactions() if self._commitment_code() in transaction.type_codes]
 
         # Convert transaction values to USD and aggregate
-        commitment_transactions_usd_total = sum([get_USD_value(x[0], x[1], x[2].year)
-                                                 for x in commitment_transactions if None not in x])
+        commitment_transactions_usd_total = sum(get_USD_values((x[0], x[1], x[2].year)
+                                                               for x in commitment_transactions if None not in x))
 
         # Compute the sum of all disbursements and expenditures up to and including the inputted year
         # Build a list of tuples, each tuple contains: (currency, value, date)
         exp_disb_transactions = [(
-            get_currency(self, transaction),
-            transaction.xpath('value/text()')[0] if transaction.xpath('value/text()') else None,
-            transaction_date(transaction)
-        ) for transaction in self.element.xpath('transaction[transaction-type/@code="{}" or transaction-type/@code="{}"]'.format(self._disbursement_code(), self._expenditure_code()))]
+            transaction.currency,
+            value_text(transaction),
+            transaction.date
+        ) for transaction in self._transactions() if {self._disbursement_code(), self._expenditure_code()}.intersection(transaction.type_codes)]
 
         # If the transaction date this year or older, convert transaction values to USD and aggregate
-        exp_disb_transactions_usd_total = sum([get_USD_value(x[0], x[1], x[2].year)
-                                              for x in exp_disb_transactions if None not in x and x[2].year <= int(year)])
+        exp_disb_transactions_usd_total = sum(get_USD_values((x[0], x[1], x[2].year)
+                                                             for x in exp_disb_transactions if None not in x and x[2].year <= int(year)))
 
         if commitment_transactions_usd_total > 0:
             return convert_to_float(exp_disb_transactions_usd_total) / convert_to_float(commitment_transactions_usd_total)
@@ -689,16 +809,16 @@ class ActivityStats(CommonSharedElements):
         """
         # If there is no 'reporting-org/@ref' element, return False to avoid a 'list index out of range'
         # error in the statement that follows
-        if len(self.element.xpath('reporting-org/@ref')) < 1:
+        if len(xpath(self.element, 'reporting-org/@ref')) < 1:
             return False
 
         return (
             (
-                self.element.xpath('reporting-org/@ref')[0] in self.element.xpath("participating-org[@role='{}']/@ref|participating-org[@role='{}']/@ref".format(
+                xpath(self.element, 'reporting-org/@ref')[0] in xpath(self.element, "participating-org[@role='{}']/@ref|participating-org[@role='{}']/@ref".format(
                     self._funding_code(),
                     self._OrganisationRole_Extending_code()))
             ) and (
-                self.element.xpath('reporting-org/@ref')[0] not in self.element.xpath("participating-org[@role='{}']/@ref".format(
+                xpath(self.element, 'reporting-org/@ref')[0] not in xpath(self.element, "participating-org[@role='{}']/@ref".format(
                     self._OrganisationRole_Implementing_code())
                 )
             )
@@ -713,7 +833,7 @@ class ActivityStats(CommonSharedElements):
         if len(self.element.findall('recipient-country')) == 1:
             # Get list of languages for the recipient-country
             try:
-                country_langs = country_lang_map[self.element.xpath('recipient-country/@code')[0]]
+                country_langs = country_lang_map[xpath(self.element, 'recipient-country/@code')[0]]
             except (KeyError, IndexError):
                 country_langs = []
 
@@ -743,14 +863,20 @@ class ActivityStats(CommonSharedElements):
         # logic around use of the @humanitarian attribute
         is_humanitarian_by_attrib_activity = 1 if ('humanitarian' in self.element.attrib) and (self.element.attrib['humanitarian'] in ['1', 'true']) else 0
         is_not_humanitarian_by_attrib_activity = 1 if ('humanitarian' in self.element.attrib) and (self.element.attrib['humanitarian'] in ['0', 'false']) else 0
-        is_humanitarian_by_attrib_transaction = 1 if set(self.element.xpath('transaction/@humanitarian')).intersection(['1', 'true']) else 0
+        is_humanitarian_by_attrib_transaction = 1 if set(x.element.attrib.get('humanitarian') for x in self._transactions()).intersection(['1', 'true']) else 0
         is_humanitarian_by_attrib = (self._version() in ['2.02', '2.03']) and (is_humanitarian_by_attrib_activity or (is_humanitarian_by_attrib_transaction and not is_not_humanitarian_by_attrib_activity))
 
         # logic around DAC sector codes deemed to be humanitarian
-        is_humanitarian_by_sector_5_digit_activity = 1 if set(self.element.xpath('sector[@vocabulary="{0}" or not(@vocabulary)]/@code'.format(self._dac_5_code()))).intersection(humanitarian_sectors_dac_5_digit) else 0
-        is_humanitarian_by_sector_5_digit_transaction = 1 if set(self.element.xpath('transaction[not(@humanitarian="0" or @humanitarian="false")]/sector[@vocabulary="{0}" or not(@vocabulary)]/@code'.format(self._dac_5_code()))).intersection(humanitarian_sectors_dac_5_digit) else 0
-        is_humanitarian_by_sector_3_digit_activity = 1 if set(self.element.xpath('sector[@vocabulary="{0}"]/@code'.format(self._dac_3_code()))).intersection(humanitarian_sectors_dac_3_digit) else 0
-        is_humanitarian_by_sector_3_digit_transaction = 1 if set(self.element.xpath('transaction[not(@humanitarian="0" or @humanitarian="false")]/sector[@vocabulary="{0}"]/@code'.format(self._dac_3_code()))).intersection(humanitarian_sectors_dac_3_digit) else 0
+        activity_sectors = self._children().get('sector', [])
+        transaction_sectors = [sector for x in self._transactions() if x.element.attrib.get('humanitarian') not in ['0', 'false'] for sector in x.children.get('sector', [])]
+
+        def sector_codes(sectors, vocabularies):
+            return set(sector.attrib['code'] for sector in sectors if 'code' in sector.attrib and sector.attrib.get('vocabulary') in vocabularies)
+
+        is_humanitarian_by_sector_5_digit_activity = 1 if sector_codes(activity_sectors, [self._dac_5_code(), None]).intersection(humanitarian_sectors_dac_5_digit) else 0
+        is_humanitarian_by_sector_5_digit_transaction = 1 if sector_codes(transaction_sectors, [self._dac_5_code(), None]).intersection(humanitarian_sectors_dac_5_digit) else 0
+        is_humanitarian_by_sector_3_digit_activity = 1 if sector_codes(activity_sectors, [self._dac_3_code()]).intersection(humanitarian_sectors_dac_3_digit) else 0
+        is_humanitarian_by_sector_3_digit_transaction = 1 if sector_codes(transaction_sectors, [self._dac_3_code()]).intersection(humanitarian_sectors_dac_3_digit) else 0
         # helper variables to help make logic easier to read
         is_humanitarian_by_sector_activity = is_humanitarian_by_sector_5_digit_activity or is_humanitarian_by_sector_3_digit_activity
         is_humanitarian_by_sector_transaction = is_humanitarian_by_sector_5_digit_transaction or is_humanitarian_by_sector_3_digit_transaction
@@ -768,13 +894,13 @@ class ActivityStats(CommonSharedElements):
             'contains_humanitarian_scope': 1 if (
                 is_humanitarian and
                 self._version() in ['2.02', '2.03'] and
-                all_true_and_not_empty(self.element.xpath('humanitarian-scope/@type')) and
-                all_true_and_not_empty(self.element.xpath('humanitarian-scope/@code'))
+                all_true_and_not_empty(x.attrib['type'] for x in self._children().get('humanitarian-scope', []) if 'type' in x.attrib) and
+                all_true_and_not_empty(x.attrib['code'] for x in self._children().get('humanitarian-scope', []) if 'code' in x.attrib)
             ) else 0,
             'uses_humanitarian_clusters_vocab': 1 if (
                 is_humanitarian and
                 self._version() in ['2.02', '2.03'] and
-                self.element.xpath('sector/@vocabulary="10"')
+                any(x.attrib.get('vocabulary') == '10' for x in activity_sectors)
             ) else 0
         }
 
@@ -795,47 +921,43 @@ class ActivityStats(CommonSharedElements):
         return out
 
     @returns_numberdictdictdict
+    @memoize
     def sum_transactions_by_type_by_year(self):
         out = defaultdict(lambda: defaultdict(lambda: defaultdict(Decimal)))
-        for transaction in self.element.findall('transaction'):
-            value = transaction.find('value')
-            if (transaction.find('transaction-type') is not None and
-                    transaction.find('transaction-type').attrib.get('code') in [self._incoming_funds_code(), self._commitment_code(), self._disbursement_code(), self._expenditure_code()]):
+        summed_type_codes = set([self._incoming_funds_code(), self._commitment_code(), self._disbursement_code(), self._expenditure_code()])
+        for transaction in self._transactions():
+            value = transaction.value
+            if transaction.type_code in summed_type_codes and transaction.date:
 
                 # Set transaction_value if a value exists for this transaction. Else set to 0
                 try:
                     transaction_value = 0 if (value is None or value.text is None) else Decimal(value.text)
                 except decimal.InvalidOperation:
                     transaction_value = 0
-                if self._transaction_year(transaction):
-                    out[self._transaction_type_code(transaction)][get_currency(self, transaction)][self._transaction_year(transaction)] += transaction_value
+                out[transaction.type_code][transaction.currency][transaction.date.year] += transaction_value
         return out
 
     @returns_numberdictdictdict
     def sum_transactions_by_type_by_year_usd(self):
-        out = defaultdict(lambda: defaultdict(lambda: defaultdict(Decimal)))
-
-        # Loop over the values in computed in sum_transactions_by_type_by_year() and build a
-        # dictionary of USD values for the currency and year
-        for transaction_type, data in list(self.sum_transactions_by_type_by_year().items()):
-            for currency, years in list(data.items()):
-                for year, value in list(years.items()):
-                    if None not in [currency, value, year]:
-                        out[transaction_type]['USD'][year] += get_USD_value(currency, value, year)
-        return out
+        return usd_by_type_by_year(self.sum_transactions_by_type_by_year())
 
     @returns_numberdictdict
     def count_budgets_by_type_by_year(self):
         out = defaultdict(lambda: defaultdict(int))
         for budget in self.element.findall('budget'):
-            if budget_year(budget):
-                out[budget.attrib.get('type')][budget_year(budget)] += 1
+            year = budget_year(budget)
+            if year:
+                out[budget.attrib.get('type')][year] += 1
         return out
 
     @returns_numberdictdictdict
+    @memoize
     def sum_budgets_by_type_by_year(self):
         out = defaultdict(lambda: defaultdict(lambda: defaultdict(Decimal)))
         for budget in self.element.findall('budget'):
+            year = budget_year(budget)
+            if not year:
+                continue
             value = budget.find('value')
 
             # Set budget_value if a value exists for this budget. Else set to 0
@@ -843,22 +965,12 @@ class ActivityStats(CommonSharedElements):
                 budget_value = Decimal(0) if (value is None or value.text is None) else Decimal(value.text)
             except (TypeError, AttributeError, decimal.InvalidOperation):
                 budget_value = Decimal(0)
-            if budget_year(budget):
-                out[budget.attrib.get('type')][get_currency(self, budget)][budget_year(budget)] += budget_value
+            out[budget.attrib.get('type')][get_currency(self, budget)][year] += budget_value
         return out
 
     @returns_numberdictdictdict
     def sum_budgets_by_type_by_year_usd(self):
-        out = defaultdict(lambda: defaultdict(lambda: defaultdict(Decimal)))
-
-        # Loop over the values in computed in sum_budgets_by_type_by_year() and build a
-        # dictionary of USD values for the currency and year
-        for budget_type, data in self.sum_budgets_by_type_by_year().items():
-            for currency, years in data.items():
-                for year, value in years.items():
-                    if None not in [currency, value, year]:
-                        out[budget_type]['USD'][year] += get_USD_value(currency, value, year)
-        return out
+        return usd_by_type_by_year(self.sum_budgets_by_type_by_year())
 
     @returns_numberdictdict
     def sum_planned_disbursements_by_year(self):
@@ -873,12 +985,63 @@ class ActivityStats(CommonSharedElements):
         return out
 
 
-ckan = json.load(open('helpers/ckan.json'))
+ckan = reference_data['ckan']
 publisher_re = re.compile(r'(.*)\-[^\-]')
 
+# Compiled IATI schemas, keyed by (version, schema name). Compiling a schema
+# costs far more than validating a typical file, so each process does it once.
+xmlschemas = {}
+xmlschema_cache_info = {'compiles': 0, 'hits': 0}
+
+
+def get_xmlschema(version, schema_name):
+    """Return the compiled XMLSchema for schema_name (eg. iati-activities-schema.xsd) at the given version.
+
+    Raises IOError if the schema is not available.
+    """
+    key = (version, schema_name)
+    if key in xmlschemas:
+        xmlschema_cache_info['hits'] += 1
+    else:
+        try:
+            with open('helpers/schemas/{0}/{1}'.format(version, schema_name)) as f:
+                xmlschemas[key] = etree.XMLSchema(etree.parse(f))
+            xmlschema_cache_info['compiles'] += 1
+        except IOError:
+            xmlschemas[key] = None
+    if xmlschemas[key] is None:
+        raise IOError('No schema for version {0}'.format(version))
+    return xmlschemas[key]
+
+
+def warm_caches():
+    """Compile each of the available schemas and the codelist mapping XPaths, and load the rulesets. Called by the stats runner when each process starts."""
+    for paths in codelist_mappings.values():
+        for path in paths:
+            compile_xpath(path)
+    try:
+        get_ruleset_rule_tests('standard')
+    except IOError:
+        pass
+    if not os.path.isdir('helpers/schemas'):
+        return
+    for version in os.listdir('helpers/schemas'):
+        for schema_name in [ActivityFileStats.schema_name, OrganisationFileStats.schema_name]:
+            try:
+                get_xmlschema(version, schema_name)
+            except IOError:
+                pass
+
+
+def cache_info():
+    """Return counters for the caches in this module, for the stats runner to report."""
+    return {'xmlschema': dict(xmlschema_cache_info), 'xpath': dict(xpath_cache_info), 'iso_date': iso_date_cache_info()}
+
 
 class GenericFileStats(object):
     blank = False
+    # Set by the stats runner when streaming a file, in which case self.doc is None
+    streamed_element_versions = None
 
     @returns_numberdict
     def versions(self):
@@ -887,8 +1050,11 @@ class GenericFileStats(object):
     @returns_numberdict
     def version_mismatch(self):
         file_version = self.root.attrib.get('version')
-        element_versions = self.root.xpath('//iati-activity/@version')
-        element_versions = list(set(element_versions))
+        if self.doc is None:
+            element_versions = self.streamed_element_versions
+        else:
+            element_versions = xpath(self.root, '//iati-activity/@version')
+            element_versions = list(set(element_versions))
         return {
             'true' if (file_version is not None and len(element_versions) and [file_version] != element_versions) else 'false': 1
         }
@@ -899,13 +1065,15 @@ class GenericFileStats(object):
         if version in [None, '1', '1.0', '1.00']:
             version = '1.01'
         try:
-            with open('helpers/schemas/{0}/{1}'.format(version, self.schema_name)) as f:
-                xmlschema_doc = etree.parse(f)
-                xmlschema = etree.XMLSchema(xmlschema_doc)
-                if xmlschema.validate(self.doc):
-                    return {'pass': 1}
-                else:
-                    return {'fail': 1}
+            xmlschema = get_xmlschema(version, self.schema_name)
+            if self.doc is None:
+                valid = valid_stream(self.inputfile, xmlschema)
+            else:
+                valid = xmlschema.validate(self.doc)
+            if valid:
+                return {'pass': 1}
+            else:
+                return {'fail': 1}
         except IOError:
             debug(self, 'Unsupported version \'{0}\' '.format(version))
             return {'fail': 1}
@@ -969,6 +1137,14 @@ class GenericFileStats(object):
     def toolarge(self):
         return 0
 
+    def memoryexceeded(self):
+        # Set by the loop when the file can't be processed within the --max-memory limit
+        return 0
+
+    def timeout(self):
+        # Set by the loop when the file can't be processed within the --timeout
+        return 0
+
 
 class ActivityFileStats(GenericFileStats):
     """ Stats calculated for an IATI Activity XML file. """
@@ -0,0 +1,34 @@
+"""
+This is a stats module for checking activities and organisations against the IATI Rulesets,
+with a count of the passes and fails of each rule. You can use it by running (in the parent directory)
+python calculate_stats.py --stats-module stats.rulesets loop
+
+"""
+import stats.dashboard
+
+warm_caches = stats.dashboard.warm_caches
+cache_info = stats.dashboard.cache_info
+
+
+class PublisherStats(object):
+    pass
+
+
+class ActivityFileStats(object):
+    pass
+
+
+class ActivityStats(stats.dashboard.ActivityStats):
+    enabled_stats = ['_ruleset_passes', '_ruleset_rule_passes']
+
+
+class OrganisationFileStats(object):
+    pass
+
+
+class OrganisationStats(stats.dashboard.OrganisationStats):
+    enabled_stats = ['_ruleset_passes', '_ruleset_rule_passes']
+
+
+class AllDataStats(object):
+    pass
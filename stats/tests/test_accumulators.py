@@ -0,0 +1,90 @@
+import copy
+import datetime
+import pickle
+from collections import defaultdict
+from decimal import Decimal
+
+from stats.common import accumulators
+from stats.common.decorators import returns_date, returns_number, returns_numberdict, returns_numberdictdict
+from statsrunner.aggregate import dict_sum_inplace
+
+
+def example_values():
+    return [
+        {'1': {'2015': 1, '2016': 2}, '2': {'2015': Decimal('1.5')}},
+        {'1': {'2015': 3}, '3': {'2017': 1}},
+        {'2': {'2015': Decimal('2.25'), '2016': 1}, '4': {}},
+    ]
+
+
+def test_counter_matches_dict_sum_inplace():
+    counter = accumulators.Counter(2)
+    total = counter.blank()
+    expected = counter.blank()
+    for value in example_values():
+        dict_sum_inplace(expected, value)
+        total = counter.merge(total, value)
+    assert total == expected == {'1': {'2015': 4, '2016': 2}, '2': {'2015': Decimal('3.75'), '2016': 1},
+                                 '3': {'2017': 1}, '4': {}}
+    # Values not of the declared shape are merged as dict_sum_inplace does
+    for value in [{'5': 2}, {'5': 1}, {'6': {'a': {'b': 1}}}, {'6': {'a': {'b': 2}}}, {'7': None}, {'7': 3}]:
+        dict_sum_inplace(expected, copy.deepcopy(value))
+        total = counter.merge(total, value)
+    assert total == expected
+
+
+def test_merge_is_associative():
+    counter = accumulators.Counter(2)
+    a, b, c = example_values()
+    left = counter.merge(counter.merge(counter.blank(), a), counter.merge(b, c))
+    a, b, c = example_values()
+    right = counter.merge(counter.merge(counter.merge(counter.blank(), a), b), c)
+    assert left == right
+
+
+def test_blank_can_be_pickled():
+    blank = accumulators.Counter(3).blank()
+    blank['a']['b']['c'] += 1
+    assert pickle.loads(pickle.dumps(blank)) == {'a': {'b': {'c': 1}}}
+
+
+def test_decorators_declare_accumulators():
+    class Stats(object):
+        blank = True
+
+        @returns_numberdictdict
+        def by_type_by_year(self):
+            return {}
+
+        @returns_numberdict
+        def by_type(self):
+            return {}
+
+        @returns_number
+        def count(self):
+            return 1
+
+    stats = Stats()
+    assert type(Stats.by_type_by_year.accumulator) == accumulators.Counter
+    assert Stats.by_type_by_year.accumulator.depth == 2
+    assert Stats.by_type.accumulator.depth == 1
+    assert type(Stats.count.accumulator) == accumulators.Sum
+    assert stats.by_type_by_year() == {}
+    assert type(stats.by_type_by_year()) == defaultdict
+    assert stats.count() == 0
+    stats.blank = False
+    assert stats.count() == 1
+
+
+def test_max_date_and_largest():
+    max_date = returns_date(lambda self: None).accumulator
+    total = max_date.blank()
+    for value in ['2015-01-02T00:00:00Z', None, datetime.datetime(2014, 1, 1, tzinfo=datetime.timezone.utc), max_date.blank()]:
+        total = max_date.merge(total, value)
+    assert total.value.date() == datetime.date(2015, 1, 2)
+
+    largest = accumulators.Largest()
+    total = largest.blank()
+    for value in [3, '7', 'not a number', None, 5]:
+        total = largest.merge(total, value)
+    assert int(total) == 7
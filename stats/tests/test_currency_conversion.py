@@ -0,0 +1,23 @@
+from decimal import Decimal
+
+from helpers.currency_conversion import currency_values, get_USD_value, get_USD_values
+
+
+def test_get_USD_values():
+    values = [
+        ('GBP', '100', 2010),
+        ('EUR', '-12.5', '2015'),
+        # Currency not in the sheet
+        ('XXX', '100', 2010),
+        # No data for the year
+        ('GBP', '100', 1800),
+        ('EEK', '100', 2016),
+    ]
+    assert get_USD_values(values) == [
+        Decimal((1 / currency_values['GBP'][2010]) * 100.0),
+        Decimal((1 / currency_values['EUR'][2015]) * -12.5),
+        Decimal(0),
+        Decimal(0),
+        Decimal(0),
+    ]
+    assert [get_USD_value(*value) for value in values] == get_USD_values(values)
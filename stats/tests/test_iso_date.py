@@ -0,0 +1,72 @@
+import datetime
+
+from lxml import etree
+
+from stats.common import (
+    budget_year,
+    iso_date_cache_info,
+    iso_date_match,
+    planned_disbursement_year,
+    transaction_date,
+    xsDateRegex,
+)
+
+
+def regex_iso_date_match(raw_date):
+    m1 = xsDateRegex.match(raw_date)
+    if m1:
+        try:
+            return datetime.date(*map(int, m1.groups()))
+        except ValueError:
+            return None
+
+
+def test_iso_date_match_matches_regex():
+    for raw_date in ['2012-01-01', '2012-01-01T00:00:00', '2012-01-01Z', '2015-11-31', '2015-13-01',
+                     '0000-01-01', '12012-01-01', '-2012-01-01', '2012-1-01', '2012-01-1', '2012/01/01',
+                     '201a-01-01', '2012-0a-01', '٢012-01-01', ' 2012-01-01', '2012-01-01 ', '2012', 'x']:
+        assert iso_date_match(raw_date) == regex_iso_date_match(raw_date), raw_date
+    assert iso_date_match('') is None
+    assert iso_date_match(None) is None
+
+
+def test_iso_date_match_cached():
+    raw_date = '1999-12-31'
+    iso_date_match(raw_date)
+    hits = iso_date_cache_info()['hits']
+    misses = iso_date_cache_info()['misses']
+    assert iso_date_match(raw_date) == datetime.date(1999, 12, 31)
+    assert iso_date_cache_info() == {'hits': hits + 1, 'misses': misses}
+
+
+def test_transaction_date():
+    assert transaction_date(etree.fromstring('''
+        <transaction>
+            <transaction-date iso-date="2012-01-01"/>
+            <value value-date="2011-01-01"/>
+        </transaction>
+    ''')) == datetime.date(2012, 1, 1)
+    assert transaction_date(etree.fromstring('''
+        <transaction>
+            <value value-date="2011-01-01"/>
+        </transaction>
+    ''')) == datetime.date(2011, 1, 1)
+    assert transaction_date(etree.fromstring('<transaction/>')) is None
+
+
+def test_budget_year():
+    budget = etree.fromstring('''
+        <budget>
+            <period-start iso-date="2012-04-01"/>
+            <period-end iso-date="2013-03-31"/>
+        </budget>
+    ''')
+    assert budget_year(budget) == 2012
+    assert planned_disbursement_year(budget) == 2012
+    budget = etree.fromstring('''
+        <budget>
+            <period-start iso-date="2012-04-01"/>
+        </budget>
+    ''')
+    assert budget_year(budget) is None
+    assert planned_disbursement_year(budget) == 2012
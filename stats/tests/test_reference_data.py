@@ -0,0 +1,55 @@
+import os
+import shutil
+
+import pytest
+
+from helpers import reference_data
+
+
+@pytest.fixture
+def helpers_dir(tmpdir):
+    """A copy of the reference data sources from helpers/."""
+    for source in reference_data.SOURCES:
+        destination = tmpdir.join(source)
+        destination.dirpath().ensure(dir=True)
+        shutil.copy(os.path.join('helpers', source), str(destination))
+    return str(tmpdir)
+
+
+def test_load_builds_snapshot(helpers_dir, monkeypatch):
+    data = reference_data.load(helpers_dir)
+    assert os.path.exists(os.path.join(helpers_dir, reference_data.SNAPSHOT_FILENAME))
+    assert data == reference_data.parse(helpers_dir)
+
+    # An up to date snapshot is loaded without parsing the sources
+    def parse(helpers_dir):
+        raise AssertionError('parse() should not be called')
+    monkeypatch.setattr(reference_data, 'parse', parse)
+    assert reference_data.load(helpers_dir) == data
+
+
+def test_load_rebuilds_when_sources_change(helpers_dir):
+    reference_data.load(helpers_dir)
+    with open(os.path.join(helpers_dir, 'registry_id_relationships.csv'), 'a') as fp:
+        fp.write('test-older,test-newer\n')
+    assert reference_data.load(helpers_dir)['registry_id_matches']['test-older'] == 'test-newer'
+
+
+def test_load_rebuilds_other_version(helpers_dir, monkeypatch):
+    reference_data.load(helpers_dir)
+    monkeypatch.setattr(reference_data, 'SNAPSHOT_VERSION', reference_data.SNAPSHOT_VERSION + 1)
+    parsed = []
+    parse = reference_data.parse
+    monkeypatch.setattr(reference_data, 'parse', lambda helpers_dir: parsed.append(1) or parse(helpers_dir))
+    reference_data.load(helpers_dir)
+    reference_data.load(helpers_dir)
+    assert parsed == [1]
+
+
+def test_build_removes_temporary_file_on_failure(helpers_dir, monkeypatch):
+    def rename(src, dst):
+        raise OSError('rename failed')
+    monkeypatch.setattr(reference_data.os, 'rename', rename)
+    assert reference_data.build(helpers_dir) == reference_data.parse(helpers_dir)
+    # Neither the snapshot nor its temporary file are left
+    assert not [filename for filename in os.listdir(helpers_dir) if reference_data.SNAPSHOT_FILENAME in filename]
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import json
+
+import iatirulesets
+from lxml import etree
+import pytest
+
+from stats import dashboard
+from stats.dashboard import ActivityStats, get_ruleset, get_ruleset_rule_tests
+
+RULESET = {
+    '//iati-activity': {
+        'atleast_one': {'cases': [{'paths': ['iati-identifier']}]},
+        'date_order': {'cases': [{'less': 'activity-date[@type="1"]/@iso-date',
+                                  'more': 'activity-date[@type="3"]/@iso-date'}]},
+    },
+    '//transaction': {
+        'atleast_one': {'cases': [{'paths': ['value']}]},
+    },
+}
+
+# Passes all of the rules in RULESET
+PASSING_ACTIVITY = '''
+    <iati-activity>
+        <iati-identifier>AA-AAA-123456789-ABC123</iati-identifier>
+        <activity-date type="1" iso-date="2010-01-01" />
+        <activity-date type="3" iso-date="2011-01-01" />
+        <transaction><value>100</value></transaction>
+    </iati-activity>
+'''
+
+# Has an iati-identifier, but ends before it starts, and has a transaction without a value
+FAILING_ACTIVITY = '''
+    <iati-activity>
+        <iati-identifier>AA-AAA-123456789-ABC123</iati-identifier>
+        <activity-date type="1" iso-date="2012-01-01" />
+        <activity-date type="3" iso-date="2011-01-01" />
+        <transaction><transaction-date iso-date="2012-01-01" /></transaction>
+    </iati-activity>
+'''
+
+
+@pytest.fixture
+def ruleset_dir(tmpdir, monkeypatch):
+    """A helpers/rulesets directory containing a small test ruleset as the standard ruleset, made the current directory."""
+    tmpdir.join('helpers', 'rulesets').ensure(dir=True).join('standard.json').write(json.dumps(RULESET))
+    monkeypatch.chdir(tmpdir)
+    # Don't keep the test ruleset, or use one loaded by another test
+    monkeypatch.setattr(dashboard, 'rulesets', {})
+    monkeypatch.setattr(dashboard, 'ruleset_rule_tests', {})
+    return str(tmpdir)
+
+
+def test_ruleset_loaded_once(ruleset_dir):
+    assert get_ruleset('standard') == RULESET
+    assert get_ruleset('standard') is get_ruleset('standard')
+
+
+def test_ruleset_rule_tests(ruleset_dir):
+    ruleset = get_ruleset('standard')
+    tests = get_ruleset_rule_tests('standard')
+    # One test for each rule in each context
+    assert len(tests) == 3
+    assert [(context, rule_name) for context, rule_name, test in tests] == [
+        (context, rule_name) for context, rules in ruleset.items() for rule_name in rules]
+    for context, rule_name, test in tests:
+        assert callable(test)
+
+
+def activity_stats(xml):
+    activity_stats = ActivityStats()
+    activity_stats.element = etree.fromstring(xml)
+    return activity_stats
+
+
+@pytest.mark.parametrize('xml, expected', [
+    (PASSING_ACTIVITY, {
+        '//iati-activity atleast_one': {'pass': 1},
+        '//iati-activity date_order': {'pass': 1},
+        '//transaction atleast_one': {'pass': 1},
+    }),
+    (FAILING_ACTIVITY, {
+        '//iati-activity atleast_one': {'pass': 1},
+        '//iati-activity date_order': {'fail': 1},
+        '//transaction atleast_one': {'fail': 1},
+    }),
+])
+def test_ruleset_rule_passes(ruleset_dir, xml, expected):
+    assert activity_stats(xml)._ruleset_rule_passes() == {'standard': expected}
+
+
+@pytest.mark.parametrize('xml, expected', [
+    (PASSING_ACTIVITY, 1),
+    (FAILING_ACTIVITY, 0),
+])
+def test_ruleset_passes(ruleset_dir, xml, expected):
+    assert activity_stats(xml)._ruleset_passes() == {'standard': expected}
+
+    # The same as testing the whole ruleset, loaded from the file each time, as before the rulesets were kept
+    with open('helpers/rulesets/standard.json') as fp:
+        ruleset = json.load(fp, object_pairs_hook=OrderedDict)
+    assert int(iatirulesets.test_ruleset_subelement(ruleset, activity_stats(xml).element)) == expected
@@ -0,0 +1,119 @@
+import datetime
+from decimal import Decimal
+
+from lxml import etree
+
+from stats.dashboard import ActivityStats
+
+
+class MockActivityStats(ActivityStats):
+    def __init__(self, major_version='2'):
+        self.major_version = major_version
+        return super(MockActivityStats, self).__init__()
+
+    def _major_version(self):
+        return self.major_version
+
+
+def test_transactions():
+    activity_stats = MockActivityStats()
+    activity_stats.element = etree.fromstring('''
+        <iati-activity default-currency="GBP">
+            <transaction>
+                <transaction-type code="2"/>
+                <transaction-date iso-date="2012-01-01"/>
+                <value value-date="2011-01-01">100</value>
+                <provider-org ref="GB-1"/>
+            </transaction>
+            <!-- A comment -->
+            <transaction>
+                <value currency="USD" value-date="2013-06-01">200</value>
+                <receiver-org ref="GB-2"/>
+            </transaction>
+        </iati-activity>
+    ''')
+    first, second = activity_stats._transactions()
+
+    assert first.type_code == '2'
+    assert first.currency == 'GBP'
+    assert first.date == datetime.date(2012, 1, 1)
+    assert first.value.text == '100'
+
+    assert second.type_code is None
+    assert second.type_codes == []
+    assert second.currency == 'USD'
+    # Falls back to value/@value-date without a transaction-date
+    assert second.date == datetime.date(2013, 6, 1)
+
+    assert activity_stats.provider_org() == {'GB-1': 1}
+    assert activity_stats.receiver_org() == {'GB-2': 1}
+    assert activity_stats.currencies() == {'GBP': 1, 'USD': 1}
+
+
+def test_transactions_no_value():
+    activity_stats = MockActivityStats()
+    activity_stats.element = etree.fromstring('''
+        <iati-activity>
+            <transaction>
+                <transaction-type code="3"/>
+            </transaction>
+        </iati-activity>
+    ''')
+    transaction, = activity_stats._transactions()
+    assert transaction.value is None
+    assert transaction.currency is None
+    assert transaction.date is None
+    assert activity_stats.currencies() == {}
+
+
+def test_sum_transactions_by_type_by_year():
+    activity_stats = MockActivityStats()
+    activity_stats.element = etree.fromstring('''
+        <iati-activity default-currency="GBP">
+            <transaction>
+                <transaction-type code="2"/>
+                <transaction-date iso-date="2012-01-01"/>
+                <value>100.50</value>
+            </transaction>
+            <transaction>
+                <transaction-type code="2"/>
+                <transaction-date iso-date="2012-06-01"/>
+                <value>not a number</value>
+            </transaction>
+            <transaction>
+                <transaction-type code="3"/>
+                <value>200</value>
+            </transaction>
+            <transaction>
+                <transaction-type code="11"/>
+                <transaction-date iso-date="2012-01-01"/>
+                <value>300</value>
+            </transaction>
+        </iati-activity>
+    ''')
+    sums = activity_stats.sum_transactions_by_type_by_year()
+    # Undated transactions and other transaction types are left out
+    assert sums == {'2': {'GBP': {2012: Decimal('100.50')}}}
+    assert activity_stats.sum_transactions_by_type_by_year() is sums
+
+
+def test_sum_budgets_by_type_by_year():
+    activity_stats = MockActivityStats()
+    activity_stats.element = etree.fromstring('''
+        <iati-activity default-currency="GBP">
+            <budget type="1">
+                <period-start iso-date="2012-01-01"/>
+                <period-end iso-date="2012-12-31"/>
+                <value>100</value>
+            </budget>
+            <budget type="1">
+                <period-start iso-date="2012-01-01"/>
+                <period-end iso-date="2012-12-31"/>
+            </budget>
+            <budget type="1">
+                <period-start iso-date="2012-01-01"/>
+                <value>300</value>
+            </budget>
+        </iati-activity>
+    ''')
+    assert activity_stats.sum_budgets_by_type_by_year() == {'1': {'GBP': {2012: Decimal('100')}}}
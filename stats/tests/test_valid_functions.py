@@ -1,4 +1,4 @@
-from stats.dashboard import valid_coords, valid_date, valid_url, valid_value
+from stats.dashboard import date_schema, valid_coords, valid_date, valid_stream, valid_url, valid_value, value_schema
 from lxml import etree
 
 
@@ -86,3 +86,92 @@ def test_valid_value():
     assert valid_value(etree.XML('<value>1.0</value>'))
     assert valid_value(etree.XML('<value someattribute="a">1.0</value>'))
     assert not valid_value(etree.XML('<value>1,0</value>'))
+
+
+tricky_dates = [
+    '', ' ', '2014-01-01', ' 2014-01-01', '2014-01-01 ', '2014-01-01\n', '2014-1-01', '2014-01-1', '20140101',
+    '2014-02-29', '2016-02-29', '1900-02-29', '2000-02-29', '2014-04-31', '2014-00-10', '2014-13-01', '2014-01-00',
+    '2014-12-32', '0000-01-01', '0001-01-01', '0999-12-31', '9999-12-31', '10000-01-01', '-0001-01-01',
+    '2014-01-01Z', '2014-01-01+14:00', '2014-01-01+14:01', '2014-01-01-05:00', '2014-01-01T00:00:00',
+    '\uff12\uff10\uff11\uff14-01-01', '2014/01/01', 'abcd-ef-gh',
+]
+
+
+def test_valid_date_matches_schema():
+    """ Check the fast path of valid_date gives the same results as validating against the schema. """
+    elements = []
+    for raw_date in tricky_dates:
+        for tag, attribute in [('activity-date', 'iso-date'), ('transaction-date', 'iso-date'), ('period-end', 'iso-date'), ('value', 'value-date')]:
+            element = etree.Element(tag)
+            element.set(attribute, raw_date)
+            elements.append(element)
+    elements += [
+        etree.XML('<activity-date/>'),
+        etree.XML('<activity-date iso-date="2014-01-01"><value/></activity-date>'),
+        etree.XML('<activity-date iso-date="2014-01-01"><!-- comment --></activity-date>'),
+        etree.XML('<activity-date iso-date="2014-01-01" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:nil="true"/>'),
+        etree.XML('<activity-date iso-date="2014-01-01" xml:lang="en"/>'),
+        etree.XML('<x:activity-date xmlns:x="http://example.org/" iso-date="2014-01-01"/>'),
+        etree.XML('<value iso-date="2014-01-01"/>'),
+    ]
+    for element in elements:
+        assert valid_date(element) == date_schema.validate(element), etree.tostring(element)
+
+
+def test_valid_value_matches_schema():
+    """ Check the fast path of valid_value gives the same results as validating against the schema. """
+    elements = []
+    for text in [None, '', ' ', '1', '-1', '+1', '1.', '.1', '.', '-.5', '+.0', '-0', '007', '1e5', '1E5', '1,000',
+                 '1 000', ' 1 ', '\n1\t', '- 1', '0x10', '1.2.3', '\uff11', 'NaN', 'INF', '1' * 40, '1' * 200 + '.' + '1' * 200]:
+        element = etree.Element('value')
+        element.text = text
+        elements.append(element)
+    elements += [
+        etree.XML('<value currency="GBP" value-date="2014-01-01">10</value>'),
+        etree.XML('<value>1<!-- comment -->0</value>'),
+        etree.XML('<value>1<child/></value>'),
+        etree.XML('<value xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:nil="true"/>'),
+        etree.XML('<x:value xmlns:x="http://example.org/">1</x:value>'),
+        etree.XML('<notvalue>1</notvalue>'),
+    ]
+    for element in elements:
+        assert valid_value(element) == value_schema.validate(element), etree.tostring(element)
+
+
+def test_valid_stream(tmpdir):
+    """Check that validating a file as it is streamed gives the same result as validating the whole document."""
+    xmlschema = etree.XMLSchema(etree.fromstring('''
+        <xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+            <xsd:element name="iati-activities">
+                <xsd:complexType>
+                    <xsd:sequence>
+                        <xsd:element name="iati-activity" maxOccurs="unbounded">
+                            <xsd:complexType>
+                                <xsd:sequence>
+                                    <xsd:element name="iati-identifier" type="xsd:string"/>
+                                </xsd:sequence>
+                            </xsd:complexType>
+                        </xsd:element>
+                    </xsd:sequence>
+                    <xsd:attribute name="version" type="xsd:string"/>
+                </xsd:complexType>
+            </xsd:element>
+        </xsd:schema>
+    '''))
+    passing = tmpdir.join('passing.xml')
+    passing.write('''<iati-activities version="2.03">
+        <iati-activity><iati-identifier>A</iati-identifier></iati-activity>
+        <!-- comment -->
+        <iati-activity><iati-identifier>B</iati-identifier></iati-activity>
+    </iati-activities>''')
+    # The second activity is missing its iati-identifier, after the first has been cleared
+    failing = tmpdir.join('failing.xml')
+    failing.write('''<iati-activities version="2.03">
+        <iati-activity><iati-identifier>A</iati-identifier></iati-activity>
+        <iati-activity></iati-activity>
+    </iati-activities>''')
+
+    assert valid_stream(passing.strpath, xmlschema)
+    assert xmlschema.validate(etree.parse(passing.strpath))
+    assert not valid_stream(failing.strpath, xmlschema)
+    assert not xmlschema.validate(etree.parse(failing.strpath))
@@ -0,0 +1,27 @@
+from lxml import etree
+
+from stats.common.xpath import XML_NAMESPACES, compiled_xpaths, xpath, xpath_cache_info
+
+
+def test_xpath_matches_element_xpath():
+    element = etree.fromstring('''
+        <iati-activity xml:lang="fr">
+            <sector code="72010" vocabulary="1"/>
+            <sector code="111"/>
+        </iati-activity>
+    ''')
+    for path in ['sector/@code', 'sector[@vocabulary="1"]/@code', 'sector/@vocabulary="10"', 'count(sector)']:
+        assert xpath(element, path) == element.xpath(path)
+    assert xpath(element, '@xml:lang', namespaces=XML_NAMESPACES) == ['fr']
+
+
+def test_xpath_compiled_once():
+    element = etree.fromstring('<iati-activity><title/></iati-activity>')
+    path = 'title[not(@test-xpath-compiled-once)]'
+    compiles = xpath_cache_info['compiles']
+    hits = xpath_cache_info['hits']
+    for i in range(3):
+        assert len(xpath(element, path)) == 1
+    assert xpath_cache_info['compiles'] == compiles + 1
+    assert xpath_cache_info['hits'] == hits + 2
+    assert (path, None) in compiled_xpaths
@@ -6,11 +6,13 @@ python calculate_stats.py --stats-module stats.transparency_indicator loop
 import datetime
 import csv
 import copy
+from stats.common import accumulators
 from stats.common.decorators import returns_number, returns_numberdict, returns_dict, no_aggregation, memoize
+from stats.common.xpath import xpath
 from decimal import Decimal
 from collections import defaultdict
 
-from common import (
+from stats.common import (
     budget_year,
     iso_date,
     transaction_date,
@@ -25,35 +27,20 @@ KeyError: 'INR'
 
 """
 
-reader = csv.reader(open('helpers/transparency_indicator/country_lang_map.csv'), delimiter=';')
+reader = csv.reader(open('helpers/transparency_indicator/country_lang_map.csv'), delimiter=',')
 country_lang_map = dict((row[0], row[2]) for row in reader)
 reader = csv.reader(open('helpers/transparency_indicator/Timeliness_Files_1.2.csv'))
 frequency_map = dict((row[0], row[13]) for row in reader)
 
 
 def aggregate_largest(f):
-    class LargestAggregator(object):
-        value = 0
-
-        def __add__(self, x):
-            try:
-                x = int(x)
-            except TypeError:
-                x = 0
-            except ValueError:
-                x = 0
-            if x > self.value:
-                self.value = x
-            return self
-
-        def __int__(self):
-            return self.value
-
+    """ Decorator for stats whose total is the largest of their values, as an integer. """
     def wrapper(self, *args, **kwargs):
         if self.blank:
-            return LargestAggregator()
+            return wrapper.accumulator.blank()
         else:
             return f(self, *args, **kwargs)
+    wrapper.accumulator = accumulators.Largest()
     return wrapper
 
 
@@ -165,8 +152,8 @@ class ActivityStats(GenericStats):
         return {self.element.attrib.get('hierarchy'): 1}
 
     def _oda_test(self, transaction):
-        default_flow_type = self.element.xpath('default-flow-type/@code')
-        flow_type = transaction.xpath('flow-type/@code')
+        default_flow_type = xpath(self.element, 'default-flow-type/@code')
+        flow_type = xpath(transaction, 'flow-type/@code')
         return '10' in default_flow_type or '10' in flow_type or (len(default_flow_type) == 0 and len(flow_type) == 0)
 
     @memoize
@@ -235,19 +222,19 @@ class ActivityStats(GenericStats):
     @memoize
     def _start_date(self):
         try:
-            return iso_date(self.element.xpath("activity-date[@type='start-actual']")[0])
+            return iso_date(xpath(self.element, "activity-date[@type='start-actual']")[0])
         except IndexError:
             try:
-                return iso_date(self.element.xpath("activity-date[@type='start-planned']")[0])
+                return iso_date(xpath(self.element, "activity-date[@type='start-planned']")[0])
             except IndexError:
                 return None
 
     def _end_date(self):
         try:
-            return iso_date(self.element.xpath("activity-date[@type='end-actual']")[0])
+            return iso_date(xpath(self.element, "activity-date[@type='end-actual']")[0])
         except IndexError:
             try:
-                return iso_date(self.element.xpath("activity-date[@type='end-planned']")[0])
+                return iso_date(xpath(self.element, "activity-date[@type='end-planned']")[0])
             except IndexError:
                 return None
 
@@ -312,7 +299,7 @@ class ActivityStats(GenericStats):
             30: 'transaction/transaction-type[@code="C"]',
             31: 'transaction/transaction-type[@code="D" or @code="E"]',
             32: 'transaction/transaction-type[@code="IF"]',
-            33: lambda: self.element.xpath('transaction/transaction-type[@code="IR" or @code="LR"]') if len(self.element.xpath('transaction[starts-with(finance-type/@code, "4") and string-length(finance-type/@code) = 3]')) or self.element.xpath('starts-with(default-finance-type/@code, "4") and string-length(default-finance-type/@code) = 3') else True,
+            33: lambda: xpath(self.element, 'transaction/transaction-type[@code="IR" or @code="LR"]') if len(xpath(self.element, 'transaction[starts-with(finance-type/@code, "4") and string-length(finance-type/@code) = 3]')) or xpath(self.element, 'starts-with(default-finance-type/@code, "4") and string-length(default-finance-type/@code) = 3') else True,
             34: 'document-link',
             35: 'activity-website',
             36: 'related-activity',
@@ -331,7 +318,7 @@ class ActivityStats(GenericStats):
             elif type(element) == list:
                 return 0 if len(element) == 0 or 0 in map(test_exists, element) else 1
             else:
-                if len(self.element.xpath(element)) >= 1:
+                if len(xpath(self.element, element)) >= 1:
                     return 1
                 else:
                     return 0
@@ -345,17 +332,17 @@ class ActivityStats(GenericStats):
         # regions = set()
         e = self.element
         return not(
-            ((len(e.xpath('recipient-country/@code')) == 0 or '' in e.xpath('recipient-country/@code')) and (len(e.xpath('recipient-region/@code')) == 0 or '998' in e.xpath('recipient-region/@code') or '' in e.xpath('recipient-region/@code'))) or
-            len(sectors.intersection(e.xpath('sector/@code'))) > 0 or
-            len(aid_types.intersection(e.xpath('default-aid-type/@code'))) > 0 or
-            len(flow_types.intersection(e.xpath('default-flow-type/@code'))) > 0 or
-            len(finance_types.intersection(e.xpath('default-finance-type/@code'))) > 0 or
-            len(finance_types.intersection(e.xpath('recipient-region/@code'))) > 0 or
+            ((len(xpath(e, 'recipient-country/@code')) == 0 or '' in xpath(e, 'recipient-country/@code')) and (len(xpath(e, 'recipient-region/@code')) == 0 or '998' in xpath(e, 'recipient-region/@code') or '' in xpath(e, 'recipient-region/@code'))) or
+            len(sectors.intersection(xpath(e, 'sector/@code'))) > 0 or
+            len(aid_types.intersection(xpath(e, 'default-aid-type/@code'))) > 0 or
+            len(flow_types.intersection(xpath(e, 'default-flow-type/@code'))) > 0 or
+            len(finance_types.intersection(xpath(e, 'default-finance-type/@code'))) > 0 or
+            len(finance_types.intersection(xpath(e, 'recipient-region/@code'))) > 0 or
             (transaction is not None and
                 (
-                    len(aid_types.intersection(transaction.xpath('aid-type/@code'))) > 0 or
-                    len(flow_types.intersection(transaction.xpath('flow-type/@code'))) > 0 or
-                    len(finance_types.intersection(transaction.xpath('finance-type/@code'))) > 0)))
+                    len(aid_types.intersection(xpath(transaction, 'aid-type/@code'))) > 0 or
+                    len(flow_types.intersection(xpath(transaction, 'flow-type/@code'))) > 0 or
+                    len(finance_types.intersection(xpath(transaction, 'finance-type/@code'))) > 0)))
 
     @returns_number
     def coverage_numerator(self):
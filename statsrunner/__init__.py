@@ -2,6 +2,8 @@ import argparse
 import statsrunner.loop
 import statsrunner.aggregate
 import statsrunner.invert
+import statsrunner.intermediate
+import statsrunner.database
 import datetime
 import re
 
@@ -34,7 +36,7 @@ def calculate_stats():
     )
     parser.add_argument(
         "--multi",
-        help="Number of processes to use. Defaults to 1",
+        help="Number of processes to use for loop, aggregate and invert. Defaults to 1",
         default=1,
         type=int
     )
@@ -48,6 +50,23 @@ def calculate_stats():
         help="",
         action="store_true"
     )
+    parser.add_argument(
+        "--intermediate-format",
+        help="Format of the per file output of the loop, which aggregate and invert read. Defaults to json. pickle is quicker to write and read, and invert then writes the JSON in aggregated-file",
+        choices=sorted(statsrunner.intermediate.FORMATS),
+        default='json'
+    )
+    parser.add_argument(
+        "--bundle",
+        help="Write the stats for each file to a single bundle, aggregated-file/<publisher>/<file>.bundle.json, rather than a folder with a file for each stat",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--output-backend",
+        help="Where aggregate and invert write the stats. Defaults to json, a JSON file for each stat. sqlite writes them all to stats.sqlite in the output directory, from which the export command writes the JSON files",
+        choices=['json', 'sqlite'],
+        default='json'
+    )
     parser.add_argument(
         "--today",
         help="",
@@ -74,12 +93,54 @@ def calculate_stats():
         help="Only create new files, don't overwrite existing ones",
         action="store_true"
     )
+    parser_loop.add_argument(
+        "--stream",
+        help="Parse each file incrementally, so that memory use is bounded by the largest activity/organisation rather than the largest file. Files over the registry size limit are then processed, rather than being marked as toolarge",
+        action="store_true"
+    )
+    parser_loop.add_argument(
+        "--cache-dir",
+        help="Directory for a cache of the output for each file, keyed by the file's contents, the stats code and the reference data. Files with a cached output are not parsed again"
+    )
+    parser_loop.add_argument(
+        "--timings-file",
+        help="JSON file of the time taken to process each file. If it exists, it is used to hand out the most expensive files first when using --multi, and it is updated with the timings from this run"
+    )
+    parser_loop.add_argument(
+        "--profile-stats",
+        help="Time each stats function, and write a summary by stat, stats class and publisher to profile/stats_timing.json in the output directory",
+        action="store_true"
+    )
+    parser_loop.add_argument(
+        "--max-memory",
+        help="Limit the address space of each process to this many megabytes. Files that can't be processed within the limit are recorded as memoryexceeded, and the run carries on",
+        type=int
+    )
+    parser_loop.add_argument(
+        "--max-tasks-per-child",
+        help="With --multi, replace each worker process after it has processed this many chunks of files, to release any memory it has built up",
+        type=int
+    )
+    parser_loop.add_argument(
+        "--timeout",
+        help="Seconds allowed for processing each file. A file that takes longer is recorded as timeout, and the run carries on. With --multi, a worker that is still on the same file after twice this time is killed and replaced",
+        type=float
+    )
     parser_loop.set_defaults(func=statsrunner.loop.loop)
 
     parser_aggregate = subparsers.add_parser(
         'aggregate',
         help='Aggregate the per activity JSON into per file and per publisher JSON.'
     )
+    parser_aggregate.add_argument(
+        "--incremental",
+        help="Keep the total of each publisher's files, with a hash of the contents of the files. Publishers whose files are unchanged since are not summed again",
+        action="store_true"
+    )
+    parser_aggregate.add_argument(
+        "--incremental-cache-dir",
+        help="Directory for the publisher totals kept by --incremental, defaults to aggregate-cache in the output directory"
+    )
     parser_aggregate.set_defaults(func=statsrunner.aggregate.aggregate)
 
     parser_invert = subparsers.add_parser(
@@ -88,5 +149,11 @@ def calculate_stats():
     )
     parser_invert.set_defaults(func=statsrunner.invert.invert)
 
+    parser_export = subparsers.add_parser(
+        'export',
+        help="Write the JSON files from the stats database written with --output-backend sqlite"
+    )
+    parser_export.set_defaults(func=statsrunner.database.export)
+
     args = parser.parse_args()
     args.func(args)
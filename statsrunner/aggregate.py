@@ -1,11 +1,15 @@
 from collections import defaultdict, OrderedDict
-import inspect
 import json
 import os
 import copy
 import decimal
+import io
 import statsrunner
+import statsrunner.database
+import statsrunner.incremental
+import statsrunner.intermediate
 import datetime
+import stats.common.accumulators
 from statsrunner import common
 
 
@@ -42,108 +46,231 @@ def dict_sum_inplace(d1, d2):
         #         import pdb; pdb.set_trace()
 
 
-def make_blank(stats_module):
-    """Return dictionary of stats functions for enabled stats_modules."""
-    blank = {}
-    for stats_object in [stats_module.ActivityStats(),
-                         stats_module.ActivityFileStats(),
-                         stats_module.OrganisationStats(),
-                         stats_module.OrganisationFileStats(),
-                         stats_module.PublisherStats(),
-                         stats_module.AllDataStats()]:
-        stats_object.blank = True
-        for name, function in inspect.getmembers(stats_object, predicate=inspect.ismethod):
-            if not statsrunner.shared.use_stat(stats_object, name):
-                continue
-            blank[name] = function()
-    return blank
-
-
-def aggregate_file(stats_module, stats_json, output_dir):
-    """Create JSON file for each stats_module function."""
-    subtotal = make_blank(stats_module)  # FIXME This may be inefficient
+# The accumulators of each stats module, worked out by make_accumulators()
+stats_accumulators = {}
+
+
+def make_accumulators(stats_module):
+    """Return a dictionary of the accumulator of each enabled stat in stats_module.
+
+    Stats whose decorator doesn't declare an accumulator (see
+    stats.common.accumulators) start from the value that they return when
+    self.blank is True.
+    """
+    if stats_module not in stats_accumulators:
+        accumulators = {}
+        for stats_object in [stats_module.ActivityStats(),
+                             stats_module.ActivityFileStats(),
+                             stats_module.OrganisationStats(),
+                             stats_module.OrganisationFileStats(),
+                             stats_module.PublisherStats(),
+                             stats_module.AllDataStats()]:
+            stats_object.blank = True
+            for name, function in statsrunner.shared.stat_plan(stats_object):
+                accumulator = getattr(function, 'accumulator', None)
+                if accumulator is None:
+                    accumulator = stats.common.accumulators.Blank(function(stats_object))
+                accumulators[name] = accumulator
+        stats_accumulators[stats_module] = accumulators
+    return stats_accumulators[stats_module]
+
+
+def blank_stats(accumulators):
+    """Return a dictionary of the blank total of each stat."""
+    return dict((name, accumulator.blank()) for name, accumulator in accumulators.items())
+
+
+def merge_stats(accumulators, total, stats_values):
+    """Merge a dictionary of the values of stats into total, a dictionary of the totals of the stats.
+
+    The values are taken into total rather than copied, so mustn't be used afterwards.
+    """
+    for name, value in stats_values.items():
+        if name in total and name in accumulators:
+            total[name] = accumulators[name].merge(total[name], value)
+        else:
+            stats.common.accumulators.merge_item(total, name, value)
+
+
+def dumps_aggregate(aggregate, indent=2):
+    """Return the JSON for an aggregate, converting date and null keys if needed."""
+    try:
+        return json.dumps(aggregate, sort_keys=True, indent=indent, default=decimal_default)
+    except TypeError:
+        try:
+            date_aggregate = date_dict_builder(aggregate)
+            null_aggregate = null_dict(date_aggregate)
+            return json.dumps(null_aggregate, sort_keys=True, indent=indent, default=decimal_default)
+        except (AttributeError, TypeError):
+            null_aggregate = null_dict(aggregate)
+            return json.dumps(null_sorter(null_aggregate), indent=indent, default=decimal_default)
+
+
+def aggregate_file(stats_module, stats_json, output_dir, intermediate_format='json', bundle=False):
+    """Create a file in intermediate_format for each stats_module function.
+
+    If bundle is True, output_dir is instead the path of a single bundle of all the stats.
+    """
+    accumulators = make_accumulators(stats_module)
+    subtotal = blank_stats(accumulators)
     for activity_json in stats_json['elements']:
-        dict_sum_inplace(subtotal, activity_json)
-    dict_sum_inplace(subtotal, stats_json['file'])
+        merge_stats(accumulators, subtotal, activity_json)
+    merge_stats(accumulators, subtotal, stats_json['file'])
+
+    # Compact JSON is much quicker to produce than the pretty printed JSON, for the pickle format
+    indent = None if intermediate_format == 'pickle' else 2
+    if bundle:
+        try:
+            os.makedirs(os.path.dirname(output_dir))
+        except OSError:
+            pass
+        json_texts = dict((aggregate_name, dumps_aggregate(aggregate, indent=indent))
+                          for aggregate_name, aggregate in subtotal.items())
+        if intermediate_format == 'pickle':
+            statsrunner.intermediate.dump_pickle_bundle(json_texts, output_dir)
+        else:
+            with open(output_dir, 'w') as fp:
+                fp.write(statsrunner.intermediate.dumps_json_bundle(json_texts))
+        return subtotal
 
     try:
         os.makedirs(output_dir)
     except OSError:
         pass
     for aggregate_name, aggregate in subtotal.items():
-        with open(os.path.join(output_dir, aggregate_name + '.json'), 'w') as fp:
-            try:
-                json.dump(aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
-            except TypeError:
-                fp.seek(0)
-                try:
-                    date_aggregate = date_dict_builder(aggregate)
-                    null_aggregate = null_dict(date_aggregate)
-                    json.dump(null_aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
-                except (AttributeError, TypeError):
-                    null_aggregate = null_dict(aggregate)
-                    json.dump(null_sorter(null_aggregate), fp, indent=2, default=decimal_default)
+        path = os.path.join(output_dir, statsrunner.intermediate.stat_filename(aggregate_name, intermediate_format))
+        if intermediate_format == 'pickle':
+            statsrunner.intermediate.dump_pickle(dumps_aggregate(aggregate, indent=indent), path)
+        else:
+            with open(path, 'w') as fp:
+                fp.write(dumps_aggregate(aggregate, indent=indent))
     return subtotal
 
 
-def aggregate(args):
-    import importlib
-    stats_module = importlib.import_module(args.stats_module)
+def dump_publisher_aggregate(aggregate, fp):
+    """Write the JSON for a publisher level aggregate to fp."""
+    try:
+        json.dump(aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
+    except TypeError:
+        fp.seek(0)
+        date_aggregate = recursive_date_dict(aggregate)
+        json.dump(date_aggregate, fp, sort_keys=True, indent=2)
+
+
+def dump_all_aggregate(aggregate, fp):
+    """Write the JSON for an all data level aggregate to fp."""
+    try:
+        json.dump(aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
+    except TypeError:
+        fp.seek(0)
+        date_aggregate = date_dict_builder(aggregate)
+        json.dump(date_aggregate, fp, sort_keys=True, indent=2)
+
+
+def dumps_database_aggregate(aggregate, dump):
+    """Return the value of the JSON for an aggregate, as written by dump, for the stats database."""
+    fp = io.StringIO()
+    dump(aggregate, fp)
+    return json.loads(fp.getvalue())
+
+
+def plain_dicts(obj):
+    """Return obj with any defaultdicts (whose default factories are often lambdas, which can't be pickled) replaced by dicts."""
+    if type(obj) in [dict, defaultdict]:
+        return dict((k, plain_dicts(v)) for k, v in obj.items())
+    return obj
+
+
+def sum_publisher_files(stats_module, accumulators, base_folder, folder, args, write_database=None):
+    """Return the total of the stats for the files of a publisher."""
+    publisher_total = blank_stats(accumulators)
+
+    for jsonfilefolder in os.listdir(os.path.join(base_folder, folder)):
+        if args.verbose_loop:
+            with open(os.path.join(base_folder, folder, jsonfilefolder)) as jsonfp:
+                stats_json = json.load(jsonfp, parse_float=decimal.Decimal)
+                subtotal = aggregate_file(stats_module,
+                                          stats_json,
+                                          statsrunner.intermediate.file_output_path(
+                                              os.path.join(args.output, 'aggregated-file', folder),
+                                              jsonfilefolder,
+                                              args.intermediate_format,
+                                              args.bundle),
+                                          args.intermediate_format,
+                                          args.bundle)
+            file_name = jsonfilefolder
+            file_stats = dict((aggregate_name, json.loads(dumps_aggregate(aggregate), parse_float=decimal.Decimal))
+                              for aggregate_name, aggregate in subtotal.items()) if write_database else {}
+        elif statsrunner.intermediate.split_bundle_filename(jsonfilefolder)[0] is not None:
+            # A bundle of all the stats for the file
+            file_name = statsrunner.intermediate.split_bundle_filename(jsonfilefolder)[0]
+            file_stats = statsrunner.intermediate.load(os.path.join(base_folder, folder, jsonfilefolder),
+                                                       parse_float=decimal.Decimal)
+            subtotal = file_stats
+        else:
+            file_name = jsonfilefolder
+            file_stats = subtotal = {}
+            for jsonfile in os.listdir(os.path.join(base_folder,
+                                                    folder,
+                                                    jsonfilefolder)):
+                stat_name, intermediate_format = statsrunner.intermediate.split_filename(jsonfile)
+                try:
+                    stats_json = statsrunner.intermediate.load(os.path.join(base_folder,
+                                                                            folder,
+                                                                            jsonfilefolder,
+                                                                            jsonfile),
+                                                               parse_float=decimal.Decimal)
+                except json.decoder.JSONDecodeError as e:
+                    print(e)
+                file_stats[stat_name] = stats_json
+
+        if write_database:
+            for stat_name, stats_json in sorted(file_stats.items()):
+                write_database(('aggregated-file', folder, file_name, stat_name, stats_json))
+        merge_stats(accumulators, publisher_total, subtotal)
+    return publisher_total
 
-    for newdir in ['aggregated-publisher', 'aggregated-file', 'aggregated']:
-        try:
-            os.mkdir(os.path.join(args.output, newdir))
-        except OSError:
-            pass
 
-    blank = make_blank(stats_module)
+def aggregate_publisher(stats_module, accumulators, folder, args, write_database=None, reuse=False):
+    """Sum the stats for the files of a publisher, add the PublisherStats and write the publisher's stats.
 
+    With the sqlite backend, the stats for each file and the publisher are
+    passed to write_database as (level, publisher, file, stat, value) rather
+    than written as JSON. With --incremental, the total of the files is
+    stored, and if reuse is True, the stored total is used rather than
+    summing the files again. Returns the publisher total.
+    """
     if args.verbose_loop:
         base_folder = os.path.join(args.output, 'loop')
     else:
         base_folder = os.path.join(args.output, 'aggregated-file')
-    total = copy.deepcopy(blank)
-    for folder in os.listdir(base_folder):
-        publisher_total = copy.deepcopy(blank)
-
-        for jsonfilefolder in os.listdir(os.path.join(base_folder, folder)):
-            if args.verbose_loop:
-                with open(os.path.join(base_folder, folder, jsonfilefolder)) as jsonfp:
-                    stats_json = json.load(jsonfp, parse_float=decimal.Decimal)
-                    subtotal = aggregate_file(stats_module,
-                                              stats_json,
-                                              os.path.join(args.output,
-                                                           'aggregated-file',
-                                                           folder,
-                                                           jsonfilefolder))
-            else:
-                subtotal = copy.deepcopy(blank)
-                for jsonfile in os.listdir(os.path.join(base_folder,
-                                                        folder,
-                                                        jsonfilefolder)):
-                    with open(os.path.join(base_folder,
-                                           folder,
-                                           jsonfilefolder,
-                                           jsonfile)) as jsonfp:
-                        try:
-                            stats_json = json.load(jsonfp, parse_float=decimal.Decimal)
-                        except json.decoder.JSONDecodeError as e:
-                            print(e)
-                        subtotal[jsonfile[:-5]] = stats_json
-
-            dict_sum_inplace(publisher_total, subtotal)
-
-        publisher_stats = stats_module.PublisherStats()
-        publisher_stats.aggregated = publisher_total
-        publisher_stats.folder = folder
-        publisher_stats.today = args.today
-        for name, function in inspect.getmembers(publisher_stats, predicate=inspect.ismethod):
-            if not statsrunner.shared.use_stat(publisher_stats, name):
-                continue
-            publisher_total[name] = function()
-
-        dict_sum_inplace(total, publisher_total)
-        for aggregate_name, aggregate in publisher_total.items():
+    if args.incremental:
+        cache_dir = statsrunner.incremental.cache_dir(args)
+    if reuse:
+        publisher_total = blank_stats(accumulators)
+        merge_stats(accumulators, publisher_total, statsrunner.incremental.load_total(cache_dir, folder))
+    elif args.incremental:
+        # The manifest is made before reading the files, so that a file changed while they are read is read again next time
+        manifest = statsrunner.incremental.publisher_manifest(
+            base_folder, folder, statsrunner.incremental.stored_manifest(cache_dir, folder, args.incremental_version))
+        publisher_total = sum_publisher_files(stats_module, accumulators, base_folder, folder, args, write_database)
+        statsrunner.incremental.store_total(cache_dir, folder, args.incremental_version, manifest,
+                                            plain_dicts(publisher_total))
+    else:
+        publisher_total = sum_publisher_files(stats_module, accumulators, base_folder, folder, args, write_database)
+
+    publisher_stats = stats_module.PublisherStats()
+    publisher_stats.aggregated = publisher_total
+    publisher_stats.folder = folder
+    publisher_stats.today = args.today
+    for name, function in statsrunner.shared.stat_plan(publisher_stats):
+        publisher_total[name] = function(publisher_stats)
+
+    for aggregate_name, aggregate in publisher_total.items():
+        if write_database:
+            write_database(('aggregated-publisher', folder, '', aggregate_name,
+                            dumps_database_aggregate(aggregate, dump_publisher_aggregate)))
+        else:
             try:
                 os.mkdir(os.path.join(args.output, 'aggregated-publisher', folder))
             except OSError:
@@ -152,30 +279,122 @@ def aggregate(args):
                                    'aggregated-publisher',
                                    folder,
                                    aggregate_name + '.json'), 'w') as fp:
-                try:
-                    json.dump(aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
-                except TypeError:
-                    fp.seek(0)
-                    date_aggregate = recursive_date_dict(aggregate)
-                    json.dump(date_aggregate, fp, sort_keys=True, indent=2)
+                dump_publisher_aggregate(aggregate, fp)
+    return publisher_total
+
+
+# The stats module, accumulators, args and reused publishers of an aggregate worker process, set by init_aggregate_worker()
+aggregate_worker = {}
+
+
+def init_aggregate_worker(args, reused=frozenset()):
+    """Prepare a process for running aggregate_publisher_worker()."""
+    import importlib
+    stats_module = importlib.import_module(args.stats_module)
+    aggregate_worker.update(args=args, stats_module=stats_module, accumulators=make_accumulators(stats_module),
+                            reused=reused)
+
+
+def aggregate_publisher_worker(folder):
+    """Run aggregate_publisher() in a worker process.
+
+    Returns the publisher total, in a form that can be pickled, and the rows
+    for the stats database, which is only written to by the parent process.
+    The rows are made as each stat is passed to write_database, as its value
+    may then be merged into the publisher total.
+    """
+    args = aggregate_worker['args']
+    rows = []
+
+    def write_database(row):
+        rows.extend(statsrunner.database.value_rows(*row))
+
+    publisher_total = aggregate_publisher(aggregate_worker['stats_module'], aggregate_worker['accumulators'], folder, args,
+                                          write_database if args.output_backend == 'sqlite' else None,
+                                          folder in aggregate_worker['reused'])
+    return plain_dicts(publisher_total), rows
+
+
+def aggregate(args):
+    import importlib
+    stats_module = importlib.import_module(args.stats_module)
+
+    for newdir in ['aggregated-publisher', 'aggregated-file', 'aggregated']:
+        try:
+            os.mkdir(os.path.join(args.output, newdir))
+        except OSError:
+            pass
+
+    accumulators = make_accumulators(stats_module)
+
+    if args.verbose_loop:
+        base_folder = os.path.join(args.output, 'loop')
+    else:
+        base_folder = os.path.join(args.output, 'aggregated-file')
+    folders = os.listdir(base_folder)
+
+    # With the sqlite backend, the aggregated stats (including the stats for each file) are written to the stats database
+    if args.output_backend == 'sqlite':
+        database = statsrunner.database.connect(args.output)
+
+        def write_database(row):
+            statsrunner.database.write_value(database, *row)
+    else:
+        database = write_database = None
+
+    # With --incremental, the publishers whose files are unchanged since the last run aren't summed again
+    if args.incremental:
+        args.incremental_version = statsrunner.incremental.version(stats_module, args)
+        cache_dir = statsrunner.incremental.cache_dir(args)
+        reused = set(folder for folder in folders
+                     if statsrunner.incremental.unchanged(cache_dir, base_folder, folder, args.incremental_version))
+        statsrunner.incremental.remove_stale(cache_dir, folders)
+    else:
+        reused = set()
+    if database:
+        # The stats for the files of the reused publishers are kept in the database, if they are there
+        reused &= set(statsrunner.database.publishers(database, 'aggregated-file'))
+        statsrunner.database.clear_levels(database, ['aggregated-publisher', 'aggregated'])
+        statsrunner.database.clear_publishers(
+            database, 'aggregated-file', set(statsrunner.database.publishers(database, 'aggregated-file')) - reused)
+    if args.incremental:
+        print('Summing the files of {0} of {1} publishers'.format(len(folders) - len(reused), len(folders)))
+
+    total = blank_stats(accumulators)
+    if args.multi > 1:
+        import multiprocessing
+        # Hand out the publishers with the most files to sum first, so that a large publisher isn't left until last
+        folders.sort(key=lambda folder: (folder not in reused, len(os.listdir(os.path.join(base_folder, folder)))), reverse=True)
+        pool = multiprocessing.Pool(args.multi, initializer=init_aggregate_worker, initargs=(args, frozenset(reused)))
+        # Only the AllDataStats need the total of every publisher, so fold each publisher in as it is finished
+        for publisher_total, rows in pool.imap_unordered(aggregate_publisher_worker, folders):
+            if rows:
+                statsrunner.database.write_rows(database, rows)
+            merge_stats(accumulators, total, publisher_total)
+        pool.close()
+        pool.join()
+    else:
+        for folder in folders:
+            merge_stats(accumulators, total, aggregate_publisher(stats_module, accumulators, folder, args, write_database,
+                                                                 folder in reused))
 
     all_stats = stats_module.AllDataStats()
     all_stats.aggregated = total
-    for name, function in inspect.getmembers(all_stats, predicate=inspect.ismethod):
-        if not statsrunner.shared.use_stat(all_stats, name):
-            continue
-        total[name] = function()
+    for name, function in statsrunner.shared.stat_plan(all_stats):
+        total[name] = function(all_stats)
 
     for aggregate_name, aggregate in total.items():
-        with open(os.path.join(args.output,
-                               'aggregated',
-                               aggregate_name + '.json'), 'w') as fp:
-            try:
-                json.dump(aggregate, fp, sort_keys=True, indent=2, default=decimal_default)
-            except TypeError:
-                fp.seek(0)
-                date_aggregate = date_dict_builder(aggregate)
-                json.dump(date_aggregate, fp, sort_keys=True, indent=2)
+        if database:
+            write_database(('aggregated', '', '', aggregate_name, dumps_database_aggregate(aggregate, dump_all_aggregate)))
+        else:
+            with open(os.path.join(args.output,
+                                   'aggregated',
+                                   aggregate_name + '.json'), 'w') as fp:
+                dump_all_aggregate(aggregate, fp)
+
+    if database:
+        database.commit()
+        database.close()
 
 
 def date_dict_builder(obj):
@@ -209,7 +428,8 @@ def recursive_date_dict(obj):
 
 
 def null_dict(obj):
-    for key, agg in obj.items():
+    # Over a copy of the keys, as the None key is replaced while looping
+    for key in list(obj):
         if key is None:
             obj['null'] = obj.pop(key)
     return obj
@@ -0,0 +1,151 @@
+"""
+A content addressed cache of the per file output of the loop.
+
+Each file's output is stored under a key made from a hash of the input file's
+contents and its path in the data directory (some stats use the file's name,
+eg. wrong_roots looks it up in ckan.json), along with the stats module, a hash
+of the stats code, a hash of the reference data in helpers/, the options that
+change the output (--strict, --stream and the intermediate format) and (for
+stats modules that use it) the --today date.
+When the key matches, the loop copies the cached output rather than parsing the
+file again.
+
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Reference data read by the stats modules, relative to the current directory
+REFERENCE_DATA_PATHS = [
+    'helpers/mapping-1.xml',
+    'helpers/mapping-2.xml',
+    'helpers/codelists',
+    'helpers/rulesets',
+    'helpers/schemas',
+    'helpers/transparency_indicator',
+    'helpers/currency_conversion',
+    'helpers/registry_id_relationships.csv',
+    'helpers/ckan.json',
+]
+
+
+def hash_file(path, hasher):
+    """Update hasher with the contents of the file at path (read in binary mode)."""
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            hasher.update(chunk)
+
+
+def hash_paths(paths, hasher, extensions=None):
+    """Update hasher with the names and contents of all the files in paths.
+
+    Directories are walked recursively, skipping hidden directories (eg. .git).
+    If extensions is given, only files with those extensions are included.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            filenames = []
+            for dirname, dirs, files in os.walk(path, followlinks=True):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                filenames += [os.path.join(dirname, f) for f in files]
+        else:
+            filenames = [path]
+        for filename in sorted(filenames):
+            if extensions and not filename.endswith(extensions):
+                continue
+            hasher.update(filename.encode('utf-8'))
+            if os.path.exists(filename):
+                hash_file(filename, hasher)
+
+
+def hash_code(stats_module, hasher):
+    """Update hasher with the name of stats_module and the code of the stats and statsrunner packages."""
+    hasher.update(stats_module.__name__.encode('utf-8'))
+    stats_package = os.path.dirname(os.path.abspath(stats_module.__file__))
+    statsrunner_package = os.path.dirname(os.path.abspath(__file__))
+    hash_paths([stats_package, statsrunner_package, 'helpers'], hasher, extensions=('.py',))
+
+
+def run_version(stats_module, args):
+    """Return a hash of everything other than the input file that a file's output depends on."""
+    hasher = hashlib.sha256()
+    # Stats code version
+    hash_code(stats_module, hasher)
+    # Reference data version
+    hash_paths(REFERENCE_DATA_PATHS, hasher)
+    # Stats modules that don't use self.today can say so, so that their output
+    # can be reused between runs for different dates
+    if getattr(stats_module, 'uses_today', True):
+        hasher.update(args.today.isoformat().encode('utf-8'))
+    # The cached output is in the intermediate format and layout it was written in
+    if args.intermediate_format != 'json':
+        hasher.update(args.intermediate_format.encode('utf-8'))
+    if args.bundle:
+        hasher.update(b'bundle')
+    # Options that change the stats of a file: --strict is passed to the stats,
+    # and --stream calculates them for files that would otherwise be too large
+    if args.strict:
+        hasher.update(b'strict')
+    if args.stream:
+        hasher.update(b'stream')
+    return hasher.hexdigest()
+
+
+def file_key(inputfile, path, version):
+    """Return the cache key for inputfile, at path (folder/xmlfile) in the data directory, given the run_version()."""
+    hasher = hashlib.sha256()
+    hash_file(inputfile, hasher)
+    hasher.update(path.encode('utf-8'))
+    hasher.update(version.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def fetch(cache_dir, key, outputfile):
+    """Copy the cached output for key to outputfile.
+
+    Returns True if there was a cached output, False otherwise.
+    """
+    cached = cache_path(cache_dir, key)
+    if not os.path.exists(cached):
+        return False
+    if os.path.isdir(outputfile):
+        shutil.rmtree(outputfile)
+    if os.path.isdir(cached):
+        shutil.copytree(cached, outputfile)
+    else:
+        # A bundle
+        try:
+            os.makedirs(os.path.dirname(outputfile))
+        except OSError:
+            pass
+        # Keeping the modification time, so that aggregate --incremental doesn't need to read an unchanged file again
+        shutil.copy2(cached, outputfile)
+    return True
+
+
+def store(cache_dir, key, outputfile):
+    """Add the output at outputfile to the cache under key."""
+    cached = cache_path(cache_dir, key)
+    if os.path.exists(cached) or not os.path.exists(outputfile):
+        return
+    try:
+        os.makedirs(os.path.dirname(cached))
+    except OSError:
+        pass
+    # Copy to a temporary directory and then rename, so that other processes never see a partial entry
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(cached))
+    if os.path.isdir(outputfile):
+        shutil.copytree(outputfile, os.path.join(tmp_dir, 'out'))
+    else:
+        shutil.copyfile(outputfile, os.path.join(tmp_dir, 'out'))
+    try:
+        os.rename(os.path.join(tmp_dir, 'out'), cached)
+    except OSError:
+        # Another process has stored this key in the meantime
+        pass
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,225 @@
+"""
+An SQLite database of the aggregated and inverted stats, for --output-backend sqlite.
+
+Rather than a JSON file for each stat, aggregate and invert then write every
+level of the stats into stats.sqlite in the output directory. There is one row
+for each value in the JSON, keyed by the level (the name of the folder it would
+be written to, eg. aggregated-publisher), the publisher and file (or '' where
+they don't apply), the stat, and the key path: the JSON list of keys leading
+to the value. eg. the activities of each publisher are
+
+    SELECT publisher, value FROM stats
+    WHERE level = 'aggregated-publisher' AND stat = 'activities' AND key_path = '[]'
+    ORDER BY value DESC LIMIT 20
+
+Numbers and strings are stored in the value column. Other values (true,
+false, null, lists and empty dictionaries) are stored as JSON in the
+json_value column instead. The rows for each stat are in the order of the
+keys in its JSON, so that the export command can write the same JSON files
+that the json backend does.
+
+"""
+import decimal
+import functools
+import itertools
+import json
+import os
+import sqlite3
+
+import statsrunner.intermediate
+
+DATABASE_FILENAME = 'stats.sqlite'
+
+AGGREGATE_LEVELS = ['aggregated-file', 'aggregated-publisher', 'aggregated']
+INVERTED_LEVELS = ['inverted-publisher', 'inverted-file', 'inverted-file-publisher']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stats (
+    level TEXT NOT NULL,
+    publisher TEXT NOT NULL,
+    file TEXT NOT NULL,
+    stat TEXT NOT NULL,
+    key_path TEXT NOT NULL,
+    value,
+    json_value TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS stats_key ON stats (level, publisher, file, stat, key_path);
+CREATE INDEX IF NOT EXISTS stats_stat ON stats (level, stat, key_path);
+'''
+
+# The largest integer that SQLite can store as a number
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def connect(output_dir, filename=DATABASE_FILENAME):
+    """Return a connection to the stats database in output_dir, creating it if needed."""
+    database = sqlite3.connect(os.path.join(output_dir, filename))
+    # The database can be rebuilt from the loop output, so durability isn't needed
+    database.execute('PRAGMA synchronous = OFF')
+    database.executescript(SCHEMA)
+    return database
+
+
+def clear_levels(database, levels):
+    """Delete the rows for levels, before they are written again."""
+    with database:
+        database.executemany('DELETE FROM stats WHERE level = ?', [(level,) for level in levels])
+
+
+def clear_publishers(database, level, publishers):
+    """Delete the rows for publishers in level, before they are written again."""
+    with database:
+        database.executemany('DELETE FROM stats WHERE level = ? AND publisher = ?',
+                             [(level, publisher) for publisher in publishers])
+
+
+# Most key paths (eg. the years and codes in the stats) are repeated many times
+@functools.lru_cache(maxsize=65536)
+def encode_key_path(key_path):
+    return json.dumps(key_path)
+
+
+@functools.lru_cache(maxsize=65536)
+def decode_key_path(key_path):
+    return tuple(json.loads(key_path))
+
+
+def flatten(value, key_path=()):
+    """Yield (key path, value, json_value) for each value in the JSON value."""
+    if type(value) == dict and value:
+        for k, v in value.items():
+            for row in flatten(v, key_path + (k,)):
+                yield row
+    elif type(value) == decimal.Decimal:
+        # As written to the JSON, by statsrunner.common.decimal_default
+        yield key_path, float(value), None
+    elif type(value) in [str, float] or (type(value) == int and abs(value) <= MAX_INTEGER):
+        yield key_path, value, None
+    else:
+        yield key_path, None, json.dumps(value)
+
+
+def value_rows(level, publisher, file, stat, value):
+    """Return the rows for a stat's value, as parsed from its JSON."""
+    return [(level, publisher, file, stat, encode_key_path(key_path), v, json_value)
+            for key_path, v, json_value in flatten(value)]
+
+
+def write_rows(database, rows):
+    """Write rows made by value_rows()."""
+    database.executemany(
+        'INSERT INTO stats (level, publisher, file, stat, key_path, value, json_value) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        rows)
+
+
+def copy_rows(database, path):
+    """Copy all the rows of the stats database at path into database, in order."""
+    database.execute('ATTACH DATABASE ? AS part', (path,))
+    database.execute('INSERT INTO stats (level, publisher, file, stat, key_path, value, json_value) '
+                     'SELECT level, publisher, file, stat, key_path, value, json_value FROM part.stats ORDER BY rowid')
+    # A database can't be detached during a transaction
+    database.commit()
+    database.execute('DETACH DATABASE part')
+
+
+def write_value(database, level, publisher, file, stat, value):
+    """Write the rows for a stat's value, as parsed from its JSON."""
+    write_rows(database, value_rows(level, publisher, file, stat, value))
+
+
+def write_json(database, level, publisher, file, stat, json_text):
+    """Write the rows for a stat, given its JSON."""
+    write_value(database, level, publisher, file, stat, json.loads(json_text))
+
+
+def unflatten(rows):
+    """Return the JSON value for a stat, from its (key path, value, json_value) rows, in order."""
+    out = None
+    for key_path, value, json_value in rows:
+        if json_value is not None:
+            value = json.loads(json_value)
+        key_path = decode_key_path(key_path)
+        if not key_path:
+            out = value
+            continue
+        if out is None:
+            out = {}
+        parent = out
+        for k in key_path[:-1]:
+            parent = parent.setdefault(k, {})
+        parent[key_path[-1]] = value
+    return out
+
+
+def read_values(database, level, publisher=None, stats=None):
+    """Yield (publisher, file, stat, value) for each stat in level (limited to publisher and the list of stats, if given)."""
+    query = 'SELECT publisher, file, stat, key_path, value, json_value FROM stats WHERE level = ?'
+    params = [level]
+    if publisher is not None:
+        query += ' AND publisher = ?'
+        params.append(publisher)
+    if stats is not None:
+        query += ' AND stat IN ({0})'.format(', '.join('?' * len(stats)))
+        params += stats
+    query += ' ORDER BY publisher, file, stat, rowid'
+    current = None
+    rows = []
+    for row in database.execute(query, params):
+        if row[:3] != current:
+            if rows:
+                yield current + (unflatten(rows),)
+            current = row[:3]
+            rows = []
+        rows.append(row[3:])
+    if rows:
+        yield current + (unflatten(rows),)
+
+
+def publishers(database, level):
+    """Return the publishers that have stats in level."""
+    return [row[0] for row in database.execute('SELECT DISTINCT publisher FROM stats WHERE level = ?', (level,))]
+
+
+def stats_names(database, levels):
+    """Return the names of the stats in levels."""
+    return sorted(set(row[0] for level in levels
+                      for row in database.execute('SELECT DISTINCT stat FROM stats WHERE level = ?', (level,))))
+
+
+def export_path(output_dir, level, publisher, file, stat):
+    """Return the path of the JSON file for a stat in the JSON layout."""
+    return os.path.join(*[part for part in [output_dir, level, publisher, file, stat + '.json'] if part])
+
+
+def write_export(path, value):
+    """Write the JSON for value to path, creating its directory if needed."""
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    with open(path, 'w') as fp:
+        # The keys are already in the order that they were written in
+        json.dump(value, fp, indent=2)
+
+
+def export(args):
+    """Write the JSON layout from the stats database in the output directory.
+
+    With --bundle, the stats for each file are written as a bundle.
+    """
+    database = connect(args.output)
+    for level in AGGREGATE_LEVELS + INVERTED_LEVELS:
+        try:
+            os.mkdir(os.path.join(args.output, level))
+        except OSError:
+            pass
+        if level == 'aggregated-file' and args.bundle:
+            bundles = itertools.groupby(read_values(database, level), key=lambda row: row[:2])
+            for (publisher, file), stats in bundles:
+                bundle = dict((stat, value) for publisher, file, stat, value in stats)
+                write_export(os.path.join(args.output, level, publisher,
+                                          statsrunner.intermediate.bundle_filename(file, 'json')), bundle)
+        else:
+            for publisher, file, stat, value in read_values(database, level):
+                write_export(export_path(args.output, level, publisher, file, stat), value)
+    database.close()
@@ -23,6 +23,8 @@ whitelisted_stats_files = [
     'organisation_files',
     'publisher_unique_identifiers',
     'toolarge',
+    'memoryexceeded',
+    'timeout',
     'validation',
     'versions',
     'activities_with_future_transactions',
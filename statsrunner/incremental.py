@@ -0,0 +1,146 @@
+"""
+The total of each publisher's files, kept between runs of aggregate --incremental.
+
+After summing the stats for a publisher's files (before the PublisherStats are
+added), aggregate stores the total in <publisher>.pickle in the cache
+directory, along with a manifest of the files that went into it: the size,
+modification time and a hash of the contents of each file in the publisher's
+folder. On the next run, a publisher whose files have the same contents (and
+whose total was made by the same stats code) is not summed again, and the
+stored total is used instead. The PublisherStats and AllDataStats are still
+worked out for every publisher, as they can depend on --today.
+
+The cache directory is --incremental-cache-dir, or aggregate-cache in the
+output directory. git.sh keeps it in $GITOUT_DIR, as the output directory is
+removed between runs.
+
+Files are compared by their contents, so a publisher is reused even when the
+loop has written its files again. A file with the same size and modification
+time as in the stored manifest is taken to be unchanged without reading it,
+which is the case for the files that loop --cache-dir copies from its cache.
+
+"""
+import hashlib
+import os
+import pickle
+
+import statsrunner.cache
+
+CACHE_DIRNAME = 'aggregate-cache'
+
+
+def version(stats_module, args):
+    """Return a hash of what a publisher's total depends on, other than its files."""
+    hasher = hashlib.sha256()
+    statsrunner.cache.hash_code(stats_module, hasher)
+    # Which files the totals are read from
+    hasher.update(repr((args.verbose_loop, args.intermediate_format, args.bundle)).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def cache_dir(args):
+    """Return the directory that the publisher totals are kept in."""
+    return args.incremental_cache_dir or os.path.join(args.output, CACHE_DIRNAME)
+
+
+def publisher_files(base_folder, folder):
+    """Yield the path in the publisher's folder and os.DirEntry of each of the publisher's files.
+
+    The files in the folder for each input file (ie. when not using --bundle) are included by their path in the folder.
+    """
+    for entry in os.scandir(os.path.join(base_folder, folder)):
+        if entry.is_dir():
+            for stat_entry in os.scandir(entry.path):
+                yield entry.name + '/' + stat_entry.name, stat_entry
+        else:
+            yield entry.name, entry
+
+
+def manifest_entry(entry, previous=None):
+    """Return the (size, modification time, hash of the contents) of a file, from its os.DirEntry.
+
+    If the size and modification time are those in previous (the file's entry in a stored manifest), previous is returned
+    without reading the file.
+    """
+    stat_result = entry.stat()
+    if previous is not None and previous[:2] == (stat_result.st_size, stat_result.st_mtime_ns):
+        return previous
+    hasher = hashlib.sha256()
+    statsrunner.cache.hash_file(entry.path, hasher)
+    return (stat_result.st_size, stat_result.st_mtime_ns, hasher.hexdigest())
+
+
+def publisher_manifest(base_folder, folder, previous=None):
+    """Return a dictionary of the manifest_entry() of each file in the publisher's folder, keyed by its path in the folder.
+
+    Files whose size and modification time are the same as in previous (a stored manifest) aren't read.
+    """
+    previous = previous or {}
+    return dict((path, manifest_entry(entry, previous.get(path))) for path, entry in publisher_files(base_folder, folder))
+
+
+def cache_path(cache_dir, folder):
+    return os.path.join(cache_dir, folder + '.pickle')
+
+
+def stored_manifest(cache_dir, folder, run_version):
+    """Return the manifest stored with the publisher's total, or None if there isn't one made by the same code."""
+    try:
+        with open(cache_path(cache_dir, folder), 'rb') as fp:
+            # Just the version and manifest, which are stored before the total
+            stored_version, manifest = pickle.load(fp)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if stored_version != run_version:
+        return None
+    return manifest
+
+
+def unchanged(cache_dir, base_folder, folder, run_version):
+    """Return True if there is a stored total for the publisher, made from files with the same contents by the same code."""
+    manifest = stored_manifest(cache_dir, folder, run_version)
+    if manifest is None:
+        return False
+    paths = set()
+    for path, entry in publisher_files(base_folder, folder):
+        # Stop at the first file that differs, rather than reading the rest
+        if path not in manifest or manifest_entry(entry, manifest[path])[2] != manifest[path][2]:
+            return False
+        paths.add(path)
+    return len(paths) == len(manifest)
+
+
+def load_total(cache_dir, folder):
+    """Return the stored total for the publisher."""
+    with open(cache_path(cache_dir, folder), 'rb') as fp:
+        pickle.load(fp)
+        return pickle.load(fp)
+
+
+def store_total(cache_dir, folder, run_version, manifest, total):
+    """Store the total for the publisher, made from the files in manifest.
+
+    The total must be picklable (see statsrunner.aggregate.plain_dicts).
+    """
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        pass
+    # Write to a temporary file and then rename, so that an interrupted run never leaves a partial total
+    path = cache_path(cache_dir, folder)
+    with open(path + '.tmp', 'wb') as fp:
+        pickle.dump((run_version, manifest), fp, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(total, fp, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def remove_stale(cache_dir, folders):
+    """Remove the stored totals of publishers that aren't in folders."""
+    try:
+        filenames = os.listdir(cache_dir)
+    except OSError:
+        return
+    folders = set(folders)
+    for filename in filenames:
+        if filename.endswith('.pickle') and filename[:-len('.pickle')] not in folders:
+            os.remove(os.path.join(cache_dir, filename))
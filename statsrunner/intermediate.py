@@ -0,0 +1,129 @@
+"""
+Formats for the per file output of the loop, which aggregate and invert read.
+
+The loop writes the stats for each file to aggregated-file/<publisher>/<file>/,
+one file per stat. With the default json format these are the public JSON
+files, pretty printed. With the pickle format each stat is instead pickled,
+as the value that aggregate would otherwise read back from the JSON (the same
+keys, with numbers as Decimals), so the output of aggregate and invert is the
+same for both formats. aggregate and invert read either format, choosing by the
+file extension. invert then exports the pickled stats to the public JSON
+(export_json), so the pretty printing is only done once, at the end, and not at
+all for runs (eg. of older commits) that only keep the aggregated stats.
+
+With --bundle, the stats for each file are instead written as a single bundle,
+aggregated-file/<publisher>/<file>.bundle.json (or .bundle.pickle), holding a
+dictionary of all the stats. This needs one file per input file rather than
+one per stat, which is most of the cost of writing, reading, moving and
+archiving the output.
+
+"""
+import decimal
+import json
+import os
+import pickle
+
+from statsrunner.common import decimal_default
+
+FORMATS = {
+    'json': '.json',
+    'pickle': '.pickle',
+}
+
+# Creating a decoder for each call of json.loads(parse_float=...) is a noticeable part of the cost for small stats
+decimal_decoder = json.JSONDecoder(parse_float=decimal.Decimal)
+
+BUNDLE_SUFFIX = '.bundle'
+
+
+def stat_filename(stat_name, intermediate_format):
+    """Return the name of the file for stat_name in the given format."""
+    return stat_name + FORMATS[intermediate_format]
+
+
+def split_filename(filename):
+    """Return the stat name and format of an intermediate file, or (None, None) if it isn't one."""
+    stat_name, extension = os.path.splitext(filename)
+    for intermediate_format, format_extension in FORMATS.items():
+        if extension == format_extension:
+            return stat_name, intermediate_format
+    return None, None
+
+
+def bundle_filename(xmlfile, intermediate_format):
+    """Return the name of the bundle for xmlfile in the given format."""
+    return xmlfile + BUNDLE_SUFFIX + FORMATS[intermediate_format]
+
+
+def split_bundle_filename(filename):
+    """Return the input file name and format of a bundle, or (None, None) if it isn't one."""
+    name, intermediate_format = split_filename(filename)
+    if name is not None and name.endswith(BUNDLE_SUFFIX):
+        return name[:-len(BUNDLE_SUFFIX)], intermediate_format
+    return None, None
+
+
+def file_output_path(dirname, xmlfile, intermediate_format, bundle):
+    """Return the path of the output for xmlfile: a bundle if bundle is True, otherwise a folder with a file per stat."""
+    if bundle:
+        return os.path.join(dirname, bundle_filename(xmlfile, intermediate_format))
+    else:
+        return os.path.join(dirname, xmlfile)
+
+
+def dumps_json_bundle(json_texts):
+    """Return the JSON for a bundle, given a dictionary of the pretty printed JSON of each stat.
+
+    This is the same as pretty printing the dictionary of stats, without
+    encoding each stat again.
+    """
+    if not json_texts:
+        return '{}'
+    return '{\n' + ',\n'.join(
+        '  {0}: {1}'.format(json.dumps(stat_name), json_text.replace('\n', '\n  '))
+        for stat_name, json_text in sorted(json_texts.items())
+    ) + '\n}'
+
+
+def dump_pickle(json_text, path):
+    """Write the value of the JSON text to path in the pickle format."""
+    with open(path, 'wb') as fp:
+        pickle.dump(decimal_decoder.decode(json_text), fp, pickle.HIGHEST_PROTOCOL)
+
+
+def dump_pickle_bundle(json_texts, path):
+    """Write a bundle to path in the pickle format, given a dictionary of the JSON of each stat."""
+    # Sorted, so that export_json writes the stats in the same order as dumps_json_bundle
+    bundle = dict((stat_name, decimal_decoder.decode(json_text))
+                  for stat_name, json_text in sorted(json_texts.items()))
+    with open(path, 'wb') as fp:
+        pickle.dump(bundle, fp, pickle.HIGHEST_PROTOCOL)
+
+
+def load(path, parse_float=float):
+    """Return the stats value in the intermediate file at path.
+
+    Numbers in the json format are parsed with parse_float, as json.load
+    does. Numbers in the pickle format are always Decimals.
+    """
+    if path.endswith(FORMATS['pickle']):
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)
+    else:
+        with open(path) as fp:
+            return json.load(fp, parse_float=parse_float)
+
+
+def export_json(dirname):
+    """Replace each pickled stat or bundle under dirname with the same JSON that the json format writes."""
+    for dirpath, dirs, files in os.walk(dirname, followlinks=True):
+        for f in files:
+            name, intermediate_format = split_filename(f)
+            if intermediate_format != 'pickle':
+                continue
+            path = os.path.join(dirpath, f)
+            # The keys are already in the order that they were written in
+            json_text = json.dumps(load(path), indent=2, default=decimal_default)
+            with open(os.path.join(dirpath, stat_filename(name, 'json')), 'w') as fp:
+                fp.write(json_text)
+            os.remove(path)
@@ -1,62 +1,264 @@
+import functools
 import json
 import os
+import tempfile
+import zlib
 from collections import defaultdict
 
+import statsrunner.database
+import statsrunner.intermediate
+from statsrunner.common import decimal_default
 
-def invert_dir(basedirname, out_filename, output_dir):
-    """
-    This 'inverts' the aggregated json files produced by aggregate.py
-    ie. it creates a json file of the stats grouped by value, and then by
-    publisher.
 
+def invert_stat(out, stats_name, stats_values, parent_folder):
+    """Add the values of a stat for parent_folder (a publisher or file) to out."""
+    if type(stats_values) == dict:
+        if stats_name not in out:
+            out[stats_name] = defaultdict(dict)
+
+        for k, v in stats_values.items():
+            if type(v) == dict:
+                if k not in out[stats_name]:
+                    out[stats_name][k] = defaultdict(dict)
+                for k2, v2 in v.items():
+                    out[stats_name][k][k2][parent_folder] = v2
+            else:
+                out[stats_name][k][parent_folder] = v
+
+    elif type(stats_values) == int:
+        if stats_name not in out:
+            out[stats_name] = defaultdict(int)
+
+        out[stats_name][parent_folder] += stats_values
+
+
+def in_stats_group(stats_name, stats_group):
+    """Return True if the stat is in stats_group, a (group, number of groups) tuple, or if stats_group is None.
+
+    Stats are put in groups by a hash of their name, which is the same in every process.
     """
-    out = {}
+    if stats_group is None:
+        return True
+    group, groups = stats_group
+    return zlib.crc32(str(stats_name).encode('utf-8')) % groups == group
+
 
-    for dirname, dirs, files in os.walk(os.path.join(output_dir, basedirname), followlinks=True):
+def walk_stats(dirname, stats_group=None):
+    """Yield (parent folder, stat name, values) for each of the aggregated stats in dirname, for the stats in stats_group.
+
+    The stats for a file may be a folder with a file per stat, or a bundle. The
+    parent folder is the name of the file for a bundle, and the folder that the
+    stat is in otherwise.
+    """
+    for dirname, dirs, files in os.walk(dirname, followlinks=True):
         parent_folder = os.path.basename(dirname)
         for f in files:
-            with open(os.path.join(dirname, f)) as fp:
-                stats_name = f[:-5]
-                stats_values = json.load(fp)
-                if type(stats_values) == dict:
-                    if stats_name not in out:
-                        out[stats_name] = defaultdict(dict)
-
-                    for k, v in stats_values.items():
-                        if type(v) == dict:
-                            if k not in out[stats_name]:
-                                out[stats_name][k] = defaultdict(dict)
-                            for k2, v2 in v.items():
-                                out[stats_name][k][k2][parent_folder] = v2
-                        else:
-                            out[stats_name][k][parent_folder] = v
-
-                elif type(stats_values) == int:
-                    if stats_name not in out:
-                        out[stats_name] = defaultdict(int)
-
-                    out[stats_name][parent_folder] += stats_values
+            bundle_name, intermediate_format = statsrunner.intermediate.split_bundle_filename(f)
+            if bundle_name is not None:
+                for stats_name, stats_values in statsrunner.intermediate.load(os.path.join(dirname, f)).items():
+                    if in_stats_group(stats_name, stats_group):
+                        yield bundle_name, stats_name, stats_values
+            else:
+                stats_name, intermediate_format = statsrunner.intermediate.split_filename(f)
+                # Only the files for the stats in the group are read
+                if in_stats_group(stats_name, stats_group):
+                    yield parent_folder, stats_name, statsrunner.intermediate.load(os.path.join(dirname, f))
 
+
+def write_inverted(out, dirname):
+    """Write the JSON for each of the inverted stats in out to dirname."""
     for statname, inverted in out.items():
         try:
-            os.mkdir(os.path.join(output_dir, out_filename))
+            os.mkdir(dirname)
         except OSError:
             pass
-        with open(os.path.join(output_dir, out_filename, statname + '.json'), 'w') as fp:
-            json.dump(inverted, fp, sort_keys=True, indent=2)
+        with open(os.path.join(dirname, statname + '.json'), 'w') as fp:
+            # Pickled stats have Decimals, where the JSON has floats
+            json.dump(inverted, fp, sort_keys=True, indent=2, default=decimal_default)
+
+
+def invert_dir(basedirname, out_filename, output_dir, stats_group=None):
+    """
+    This 'inverts' the aggregated json files produced by aggregate.py
+    ie. it creates a json file of the stats grouped by value, and then by
+    publisher.
+
+    The stats for a file may be a folder with a file per stat, or a bundle.
+
+    """
+    out = {}
+    for parent_folder, stats_name, stats_values in walk_stats(os.path.join(output_dir, basedirname), stats_group):
+        invert_stat(out, stats_name, stats_values, parent_folder)
+    write_inverted(out, os.path.join(output_dir, out_filename))
+
+
+def merge_inverted(total, out):
+    """Merge out, the inverted stats of some publishers, into total, as if they had been inverted into total.
+
+    The parts of out are taken into total rather than copied.
+    """
+    for stats_name, inverted in out.items():
+        if stats_name not in total:
+            total[stats_name] = inverted
+        elif inverted.default_factory is int:
+            for parent_folder, v in inverted.items():
+                total[stats_name][parent_folder] += v
+        else:
+            for k, values in inverted.items():
+                if k not in total[stats_name]:
+                    total[stats_name][k] = values
+                    continue
+                for k2, v in values.items():
+                    # A dictionary of the values of each parent folder for k2, or the value of a parent folder
+                    if type(v) == dict and type(total[stats_name][k].get(k2)) == dict:
+                        total[stats_name][k][k2].update(v)
+                    else:
+                        total[stats_name][k][k2] = v
+
+
+def invert_publisher_files(output_dir, folder, stats_group=None):
+    """Write the inverted-file-publisher of a publisher, for the stats in stats_group.
+
+    Returns the publisher's inverted stats, for merging into inverted-file with merge_inverted().
+    """
+    try:
+        os.mkdir(os.path.join(output_dir, 'inverted-file-publisher', folder))
+    except OSError:
+        pass
+    out = {}
+    for parent_folder, stats_name, stats_values in walk_stats(os.path.join(output_dir, 'aggregated-file', folder),
+                                                              stats_group):
+        invert_stat(out, stats_name, stats_values, parent_folder)
+    write_inverted(out, os.path.join(output_dir, 'inverted-file-publisher', folder))
+    return out
+
+
+def invert_json(output_dir, stats_group=None):
+    """Write inverted-publisher, inverted-file and inverted-file-publisher for the stats in stats_group.
+
+    Each aggregated file is read once, for both inverted-file and the
+    inverted-file-publisher of its publisher, which is written as soon as the
+    publisher's files have been read.
+    """
+    invert_dir('aggregated-publisher', 'inverted-publisher', output_dir, stats_group)
+    file_out = {}
+    for folder in os.listdir(os.path.join(output_dir, 'aggregated-file')):
+        merge_inverted(file_out, invert_publisher_files(output_dir, folder, stats_group))
+    write_inverted(file_out, os.path.join(output_dir, 'inverted-file'))
+
+
+def invert_json_by_publisher(output_dir, pool):
+    """Write the inverted stats as invert_json() does, with the publishers' files split between the processes in pool.
+
+    Used for bundles, which have all the stats of a file, so that each is only
+    read once. The inverted-file-publisher of each publisher is written by a
+    worker, and inverted-file by this process, merging the publishers in the
+    same order as invert_json().
+    """
+    invert_dir('aggregated-publisher', 'inverted-publisher', output_dir)
+    file_out = {}
+    for publisher_out in pool.imap(functools.partial(invert_publisher_files, output_dir),
+                                   os.listdir(os.path.join(output_dir, 'aggregated-file'))):
+        merge_inverted(file_out, publisher_out)
+    write_inverted(file_out, os.path.join(output_dir, 'inverted-file'))
+
+
+def inverted_rows(out, out_level, publisher=''):
+    """Return the stats database rows for the inverted stats in out."""
+    rows = []
+    for statname, inverted in out.items():
+        rows += statsrunner.database.value_rows(out_level, publisher, '', statname,
+                                                json.loads(json.dumps(inverted, sort_keys=True, default=decimal_default)))
+    return rows
+
+
+def invert_database(database, write_rows, stats=None):
+    """Invert the stats in the stats database, as invert_json does for the JSON layout.
+
+    The rows for the inverted levels are passed to write_rows as they are
+    made: for inverted-publisher, then for the inverted-file-publisher of each
+    publisher, and then for inverted-file. Each publisher's files are read in
+    a query of their own, which has finished before its rows are written. If
+    stats is given, only those stats are inverted.
+    """
+    out = {}
+    for stats_publisher, stats_file, stats_name, stats_values in statsrunner.database.read_values(
+            database, 'aggregated-publisher', stats=stats):
+        invert_stat(out, stats_name, stats_values, stats_file or stats_publisher)
+    write_rows(inverted_rows(out, 'inverted-publisher'))
+
+    file_out = {}
+    for publisher in sorted(statsrunner.database.publishers(database, 'aggregated-file')):
+        publisher_out = {}
+        for stats_publisher, stats_file, stats_name, stats_values in statsrunner.database.read_values(
+                database, 'aggregated-file', publisher, stats):
+            invert_stat(publisher_out, stats_name, stats_values, stats_file or stats_publisher)
+        write_rows(inverted_rows(publisher_out, 'inverted-file-publisher', publisher))
+        merge_inverted(file_out, publisher_out)
+    write_rows(inverted_rows(file_out, 'inverted-file'))
+
+
+def invert_database_worker(output_dir, stats):
+    """Run invert_database() for stats in a worker process.
+
+    The rows are written to a database of their own, as they are made, whose
+    path is returned. They are copied into the stats database once every
+    process has finished reading it.
+    """
+    database = statsrunner.database.connect(output_dir)
+    fd, part_path = tempfile.mkstemp(dir=output_dir, prefix='.invert-', suffix='.sqlite')
+    os.close(fd)
+    part = statsrunner.database.connect(output_dir, os.path.basename(part_path))
+    invert_database(database, functools.partial(statsrunner.database.write_rows, part), stats)
+    part.commit()
+    part.close()
+    database.close()
+    return part_path
 
 
 def invert(args):
+    """Invert the aggregated stats.
+
+    With --multi, the stats are split between the processes by name, except
+    for bundles, where the publishers are split between them instead.
+    """
+    if args.output_backend == 'sqlite':
+        database = statsrunner.database.connect(args.output)
+        statsrunner.database.clear_levels(database, statsrunner.database.INVERTED_LEVELS)
+        if args.multi > 1:
+            import multiprocessing
+            stats_names = statsrunner.database.stats_names(database, ['aggregated-publisher', 'aggregated-file'])
+            stats_groups = [[stats_name for stats_name in stats_names if in_stats_group(stats_name, (group, args.multi))]
+                            for group in range(args.multi)]
+            pool = multiprocessing.Pool(args.multi)
+            # The rows are copied in once all the processes have finished reading the database
+            part_paths = pool.starmap(invert_database_worker, [(args.output, stats) for stats in stats_groups])
+            pool.close()
+            pool.join()
+            for part_path in part_paths:
+                statsrunner.database.copy_rows(database, part_path)
+                os.remove(part_path)
+        else:
+            invert_database(database, functools.partial(statsrunner.database.write_rows, database))
+        database.commit()
+        database.close()
+        return
+
     for dirname in ['inverted-publisher', 'inverted-file', 'inverted-file-publisher']:
         try:
             os.mkdir(os.path.join(args.output, dirname))
         except OSError:
             pass
-    invert_dir('aggregated-publisher', 'inverted-publisher', args.output)
-    invert_dir('aggregated-file', 'inverted-file', args.output)
-    for folder in os.listdir(os.path.join(args.output, 'aggregated-file')):
-        try:
-            os.mkdir(os.path.join(args.output, 'inverted-file-publisher', folder))
-        except OSError:
-            pass
-        invert_dir(os.path.join('aggregated-file', folder), os.path.join('inverted-file-publisher', folder), args.output)
+    if args.multi > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(args.multi)
+        if args.bundle:
+            invert_json_by_publisher(args.output, pool)
+        else:
+            pool.starmap(invert_json, [(args.output, (group, args.multi)) for group in range(args.multi)])
+        pool.close()
+        pool.join()
+    else:
+        invert_json(args.output)
+    # Only now that everything has been read, write the public JSON for any stats in the pickle format
+    statsrunner.intermediate.export_json(os.path.join(args.output, 'aggregated-file'))
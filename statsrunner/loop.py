@@ -1,32 +1,73 @@
+import gc
+import importlib
 import os
+import signal
 from lxml import etree
-import inspect
 import json
 import sys
+import time
 import traceback
 import statsrunner.shared
 import statsrunner.aggregate
+import statsrunner.cache
+import statsrunner.intermediate
+import statsrunner.profiling
+import statsrunner.resources
+import statsrunner.scheduling
 from statsrunner.common import decimal_default
 
+# Stats modules imported by this process, keyed by name
+stats_modules = {}
+# When running with --multi and --timeout, a dictionary shared with the parent process of the
+# (chunk id, index in chunk, start time) of the file each worker process is on, keyed by pid
+progress = None
 
-def call_stats(this_stats, args):
+
+class FileTimeout(BaseException):
+    """Raised when a file takes longer than the --timeout.
+
+    This is not an Exception, so that the error handling of call_stats() and the stats themselves doesn't catch it.
+    """
+    pass
+
+
+def raise_file_timeout(signum, frame):
+    raise FileTimeout()
+
+
+def set_deadline(seconds):
+    """Raise FileTimeout in this process after seconds (and then every second, in case it is caught), or cancel that if seconds is 0."""
+    signal.setitimer(signal.ITIMER_REAL, seconds, 1 if seconds else 0)
+
+
+def call_stats(this_stats, args, profile=None):
     """Create dictionary of enabled stats for this_stats object.
 
     Args:
       this_stats (cls): stats_module that specifies calculations for relevant input, processed by internal methods of process_file().
 
       args: Object containing program run options (set by CLI arguments at runtime. See __init__ for more details).
+
+      profile (dict): If given, the time taken by each stat is recorded in this dictionary (see statsrunner.profiling).
     """
     this_out = {}
-    # For each method within this_stats object check the method is an enabled stat, if it is not enabled continue to next method.
-    for name, function in inspect.getmembers(this_stats, predicate=inspect.ismethod):
-        # If method is an enabled stat, add the method to the this_out dictionary, unless the exception criteria are met.
-        if not statsrunner.shared.use_stat(this_stats, name):
-            continue
+    class_name = type(this_stats).__name__
+    # For each enabled stat of this_stats object, add the result to the this_out dictionary, unless the exception criteria are met.
+    for name, function in statsrunner.shared.stat_plan(this_stats):
         try:
-            this_out[name] = function()
+            if profile is None:
+                this_out[name] = function(this_stats)
+            else:
+                start = time.perf_counter()
+                try:
+                    this_out[name] = function(this_stats)
+                finally:
+                    statsrunner.profiling.record(profile, (class_name, name), time.perf_counter() - start)
         except KeyboardInterrupt:
             exit()
+        except MemoryError:
+            # Let process_file() record the file as exceeding the memory limit
+            raise
         except Exception:
             traceback.print_exc(file=sys.stdout)
     if args.debug:
@@ -34,6 +75,105 @@ def call_stats(this_stats, args):
     return this_out
 
 
+def iter_root_children(inputfile):
+    """Incrementally parse inputfile, yielding each child of the root element once it has been fully parsed.
+
+    Each child is cleared and removed from the tree after it has been yielded, so
+    memory use is bounded by the largest child (eg. an iati-activity) rather than
+    by the whole document. The root element keeps its tag and attributes.
+    """
+    root = None
+    depth = 0
+    for event, element in etree.iterparse(inputfile, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            # Drop the previous siblings (earlier children and comments), so the root doesn't accumulate children
+            while element.getprevious() is not None:
+                del root[0]
+            yield element
+            element.clear()
+
+
+def scan_file(inputfile):
+    """Stream through inputfile without keeping its elements in memory.
+
+    Raises etree.ParseError if the file is not well formed XML.
+
+    Returns:
+        A tuple of the (emptied) root element, and a list of the distinct
+        iati-activity/@version values in the file.
+    """
+    root = None
+    element_versions = set()
+    for event, element in etree.iterparse(inputfile, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            continue
+        if element.tag == 'iati-activity' and element.get('version') is not None:
+            element_versions.add(element.get('version'))
+        if element.getparent() is root:
+            element.clear()
+            while element.getprevious() is not None:
+                del root[0]
+    return root, list(element_versions)
+
+
+def get_stats_module(args):
+    """Return the stats module, importing it (and so loading its reference data) the first time it is needed in this process."""
+    if args.stats_module not in stats_modules:
+        stats_modules[args.stats_module] = importlib.import_module(args.stats_module)
+    return stats_modules[args.stats_module]
+
+
+def init_worker(args, worker_progress=None):
+    """Prepare a process for running process_file(), by loading the stats module and warming its caches."""
+    global progress
+    progress = worker_progress
+    if args.timeout:
+        signal.signal(signal.SIGALRM, raise_file_timeout)
+    if args.max_memory:
+        statsrunner.resources.set_memory_limit(args.max_memory)
+    stats_module = get_stats_module(args)
+    if hasattr(stats_module, 'warm_caches'):
+        stats_module.warm_caches()
+
+
+def worker_status(stats_module, status):
+    """Add information about the current process to the status of a file, for loop() to report once all files have been processed."""
+    status['end'] = time.time()
+    status['pid'] = os.getpid()
+    status['peak_rss_kb'] = statsrunner.resources.peak_rss()
+    status['cache_info'] = stats_module.cache_info() if hasattr(stats_module, 'cache_info') else {}
+    return status
+
+
+def sum_cache_info(statuses):
+    """Return the cache counters of the stats module, summed over all the processes used."""
+    latest = {}
+    # The counters in each process are cumulative, so take the last status from each process
+    for status in statuses:
+        latest[status['pid']] = status['cache_info']
+    totals = {}
+    for cache_info in latest.values():
+        for cache_name, counters in cache_info.items():
+            for counter, value in counters.items():
+                totals.setdefault(cache_name, {}).setdefault(counter, 0)
+                totals[cache_name][counter] += value
+    return totals
+
+
+def report_cache_info(statuses):
+    """Print the cache counters of the stats module, summed over all the processes used."""
+    for cache_name, counters in sorted(sum_cache_info(statuses).items()):
+        print('{0} cache: {1}'.format(cache_name, ', '.join('{0} {1}'.format(k, v) for k, v in sorted(counters.items()))))
+
+
 def process_file(*args):
     """Create output file path or write output file."""
     args = args[0]
@@ -42,90 +182,158 @@ def process_file(*args):
     folder = args[2]
     xmlfile = args[3]
     args = args[4]
-    import importlib
+    status = {'file': os.path.join(folder, xmlfile), 'start': time.time(), 'processed': False}
+    if args.profile_stats:
+        status['profile'] = {}
+    statsrunner.resources.reset_peak_rss()
     # Python module to import stats from defaults to stats.dashboard
-    stats_module = importlib.import_module(args.stats_module)
+    stats_module = get_stats_module(args)
+    outputfile = output_path(output_dir, folder, xmlfile, args)
+
+    # If default args is set to only create new files, check for existing file and return early.
+    if args.new:
+        if os.path.exists(outputfile):
+            return worker_status(stats_module, status)
+
+    # If there is a cached output for this file's contents and path, use that rather than parsing it again.
+    if args.cache_dir and not args.verbose_loop:
+        cache_key = statsrunner.cache.file_key(inputfile, folder + '/' + xmlfile, args.cache_version)
+        if statsrunner.cache.fetch(args.cache_dir, cache_key, outputfile):
+            return worker_status(stats_module, status)
+
+    # The deadline is armed inside the try, and disarmed first thing in each handler (and finally, whichever
+    # way this is left), so that it can't go off while handling an error, outside of the FileTimeout handler.
+    failure = None
+    try:
+        try:
+            if args.timeout:
+                set_deadline(args.timeout)
+
+            # If default args are not set to only create new files try setting file_size to size of file in bytes.
+            file_size = os.stat(inputfile).st_size
+            # If the file size is greater than the registry limit, set stats_json file value to 'too large'.
+            # Registry limit: https://github.com/okfn/ckanext-iati/blob/606e0919baf97552a14b7c608529192eb7a04b19/ckanext/iati/archiver.py#L23
+            # When streaming, memory use is bounded by the largest element rather than the file, so no limit is needed.
+            if file_size > 50000000 and not args.stream:
+                stats_json = {'file': {'toolarge': 1, 'file_size': file_size}, 'elements': []}
+            # If file size is within limit, set doc to the value of the complete inputfile document, and set root to the root of element tree for doc.
+            else:
+                if args.stream:
+                    # Check the file is well formed (raising ParseError otherwise) and collect what the file stats need from a first pass,
+                    # since the element stats are consumed lazily, after this function's error handling.
+                    doc = None
+                    root, element_versions = scan_file(inputfile)
+                else:
+                    doc = etree.parse(inputfile)
+                    root = doc.getroot()
+
+                def process_stats_file(FileStats):
+                    """Set object elements and pass to call_stats()."""
+                    file_stats = FileStats()
+                    file_stats.doc = doc
+                    file_stats.root = root
+                    if args.stream:
+                        file_stats.streamed_element_versions = element_versions
+                    file_stats.strict = args.strict
+                    file_stats.context = 'in ' + inputfile
+                    file_stats.fname = os.path.basename(inputfile)
+                    file_stats.inputfile = inputfile
+                    return call_stats(file_stats, args, status.get('profile'))
+
+                def process_stats_element(ElementStats, tagname=None):
+                    """Generate object elements and yield to call_stats()."""
+                    for element in (iter_root_children(inputfile) if args.stream else root):
+                        if tagname and tagname != element.tag:
+                            continue
+                        element_stats = statsrunner.shared.reset_stats_object(
+                            ElementStats,
+                            element=element,
+                            strict=args.strict,
+                            context='in ' + inputfile,
+                            today=args.today)
+                        yield call_stats(element_stats, args, status.get('profile'))
+
+                def process_stats(FileStats, ElementStats, tagname=None):
+                    """Create dictionary with processed stats_module objects.
+
+                    Args:
+                        FileStats (cls): stats_module that contains calculations for an organisation or activity XML file.
+                        ElementStats (cls): stats_module that contains raw stats calculations for a single organisation or activity.
+                        tagname: Label for type of stats_module.
+
+                    Returns:
+                        Dictionary with values that are dictionaries of the enabled stats for the file and elements being processed.
+                    """
+                    file_out = process_stats_file(FileStats)
+                    out = process_stats_element(ElementStats, tagname)
+                    return {'file': file_out, 'elements': out}
+
+                if root.tag == 'iati-activities':
+                    stats_json = process_stats(stats_module.ActivityFileStats, stats_module.ActivityStats, 'iati-activity')
+                elif root.tag == 'iati-organisations':
+                    stats_json = process_stats(stats_module.OrganisationFileStats, stats_module.OrganisationStats, 'iati-organisation')
+                else:
+                    stats_json = {'file': {'nonstandardroots': 1}, 'elements': []}
+
+        # If there is a ParseError print statement, then set stats_json file value according to whether the file size is zero.
+        except etree.ParseError as e:
+            if args.timeout:
+                set_deadline(0)
+            if getattr(e, 'code', None) == etree.ErrorTypes.ERR_NO_MEMORY:
+                # libxml2 reports failing to allocate memory as a parse error
+                failure = 'memoryexceeded'
+            else:
+                print('Could not parse file {0}'.format(inputfile))
+                if os.path.getsize(inputfile) == 0:
+                    # Assume empty files are download errors, not invalid XML
+                    stats_json = {'file': {'emptyfile': 1}, 'elements': []}
+                else:
+                    stats_json = {'file': {'invalidxml': 1}, 'elements': []}
+
+        # The element stats are calculated lazily as the output is written, so can also run out of memory or time here
+        if not failure:
+            write_output(stats_module, stats_json, outputfile, args)
+    except MemoryError:
+        if args.timeout:
+            set_deadline(0)
+        failure = 'memoryexceeded'
+    except FileTimeout:
+        if args.timeout:
+            set_deadline(0)
+        failure = 'timeout'
+    finally:
+        if args.timeout:
+            set_deadline(0)
+    if failure:
+        # Drop the parsed document (outside the except block, whose traceback refers to it) before writing the output again
+        stats_json = doc = root = None
+        gc.collect()
+        write_output(stats_module, resource_failure(inputfile, status, failure), outputfile, args)
+    # Don't cache a result that depends on the memory limit or deadline
+    if args.cache_dir and not args.verbose_loop and not status.get('memoryexceeded') and not status.get('timeout'):
+        statsrunner.cache.store(args.cache_dir, cache_key, outputfile)
+
+    status['processed'] = True
+    return worker_status(stats_module, status)
+
+
+def output_path(output_dir, folder, xmlfile, args):
+    """Return the path of the output for a file, creating its directory if needed."""
     # When args.verbose_loop is true, create directory and set outputfile according to loop path.
     if args.verbose_loop:
         try:
             os.makedirs(os.path.join(output_dir, 'loop', folder))
         except OSError:
             pass
-        outputfile = os.path.join(output_dir, 'loop', folder, xmlfile)
+        return os.path.join(output_dir, 'loop', folder, xmlfile)
     # If args.verbose_loop is false, set outputfile according to aggregated-file path.
     else:
-        outputfile = os.path.join(output_dir, 'aggregated-file', folder, xmlfile)
+        return statsrunner.intermediate.file_output_path(os.path.join(output_dir, 'aggregated-file', folder),
+                                                         xmlfile, args.intermediate_format, args.bundle)
 
-    # If default args is set to only create new files, check for existing file and return early.
-    if args.new:
-        if os.path.exists(outputfile):
-            return
-    # If default args are not set to only create new files try setting file_size to size of file in bytes.
-    try:
-        file_size = os.stat(inputfile).st_size
-        # If the file size is greater than the registry limit, set stats_json file value to 'too large'.
-        # Registry limit: https://github.com/okfn/ckanext-iati/blob/606e0919baf97552a14b7c608529192eb7a04b19/ckanext/iati/archiver.py#L23
-        if file_size > 50000000:
-            stats_json = {'file': {'toolarge': 1, 'file_size': file_size}, 'elements': []}
-        # If file size is within limit, set doc to the value of the complete inputfile document, and set root to the root of element tree for doc.
-        else:
-            doc = etree.parse(inputfile)
-            root = doc.getroot()
-
-            def process_stats_file(FileStats):
-                """Set object elements and pass to call_stats()."""
-                file_stats = FileStats()
-                file_stats.doc = doc
-                file_stats.root = root
-                file_stats.strict = args.strict
-                file_stats.context = 'in ' + inputfile
-                file_stats.fname = os.path.basename(inputfile)
-                file_stats.inputfile = inputfile
-                return call_stats(file_stats, args)
-
-            def process_stats_element(ElementStats, tagname=None):
-                """Generate object elements and yield to call_stats()."""
-                for element in root:
-                    if tagname and tagname != element.tag:
-                        continue
-                    element_stats = ElementStats()
-                    element_stats.element = element
-                    element_stats.strict = args.strict
-                    element_stats.context = 'in ' + inputfile
-                    element_stats.today = args.today
-                    yield call_stats(element_stats, args)
-
-            def process_stats(FileStats, ElementStats, tagname=None):
-                """Create dictionary with processed stats_module objects.
-
-                Args:
-                    FileStats (cls): stats_module that contains calculations for an organisation or activity XML file.
-                    ElementStats (cls): stats_module that contains raw stats calculations for a single organisation or activity.
-                    tagname: Label for type of stats_module.
-
-                Returns:
-                    Dictionary with values that are dictionaries of the enabled stats for the file and elements being processed.
-                """
-                file_out = process_stats_file(FileStats)
-                out = process_stats_element(ElementStats, tagname)
-                return {'file': file_out, 'elements': out}
-
-            if root.tag == 'iati-activities':
-                stats_json = process_stats(stats_module.ActivityFileStats, stats_module.ActivityStats, 'iati-activity')
-            elif root.tag == 'iati-organisations':
-                stats_json = process_stats(stats_module.OrganisationFileStats, stats_module.OrganisationStats, 'iati-organisation')
-            else:
-                stats_json = {'file': {'nonstandardroots': 1}, 'elements': []}
-
-    # If there is a ParseError print statement, then set stats_json file value according to whether the file size is zero.
-    except etree.ParseError:
-        print('Could not parse file {0}'.format(inputfile))
-        if os.path.getsize(inputfile) == 0:
-            # Assume empty files are download errors, not invalid XML
-            stats_json = {'file': {'emptyfile': 1}, 'elements': []}
-        else:
-            stats_json = {'file': {'invalidxml': 1}, 'elements': []}
 
+def write_output(stats_module, stats_json, outputfile, args):
+    """Write the stats_json for a file to outputfile."""
     # If args.verbose_loop is true, assign value of list of stats_json element keys to stats_json elements key and write to json file.
     if args.verbose_loop:
         with open(outputfile, 'w') as outfp:
@@ -133,7 +341,92 @@ def process_file(*args):
             json.dump(stats_json, outfp, sort_keys=True, indent=2, default=decimal_default)
     # If args.verbose_loop is not true, create aggregated-file json and return the subtotal dictionary of statsrunner.aggregate.aggregate_file().
     else:
-        statsrunner.aggregate.aggregate_file(stats_module, stats_json, os.path.join(output_dir, 'aggregated-file', folder, xmlfile))
+        statsrunner.aggregate.aggregate_file(stats_module, stats_json, outputfile, args.intermediate_format, args.bundle)
+
+
+def resource_failure(inputfile, status, failure):
+    """Return the stats_json for a file that could not be processed within the --max-memory limit (failure 'memoryexceeded') or --timeout (failure 'timeout')."""
+    if failure == 'timeout':
+        print('Timed out processing file {0}'.format(inputfile))
+    else:
+        print('Memory limit exceeded processing file {0}'.format(inputfile))
+    status[failure] = True
+    return {'file': {failure: 1, 'file_size': os.path.getsize(inputfile)}, 'elements': []}
+
+
+def process_chunk(chunk, chunk_id=None):
+    """Run process_file() for each of a list of files, returning a list of their statuses."""
+    statuses = []
+    for index, f in enumerate(chunk):
+        if progress is not None:
+            progress[os.getpid()] = (chunk_id, index, time.time())
+        statuses.append(process_file(f))
+    if progress is not None:
+        progress.pop(os.getpid(), None)
+    return statuses
+
+
+def kill_timed_out_workers(pending, progress, args):
+    """Kill any worker that has been on the same file for twice the --timeout, and write a timeout output for that file.
+
+    This catches files that don't respond to the deadline set in the worker, eg. because
+    they are stuck in a single call to lxml. The pool starts a new worker in place of each
+    one killed.
+
+    Returns:
+        A list of the statuses of the files in the chunks that were lost, and a list of
+        chunks of the files that still need processing.
+    """
+    statuses = []
+    new_chunks = []
+    for pid, worker_progress in list(progress.items()):
+        chunk_id, index, start = worker_progress
+        if chunk_id not in pending or time.time() - start < 2 * args.timeout:
+            continue
+        # Check the worker hasn't moved on since the list was taken
+        if progress.get(pid) != worker_progress:
+            continue
+        os.kill(pid, signal.SIGKILL)
+        progress.pop(pid, None)
+        chunk = pending.pop(chunk_id)[0]
+        inputfile, output_dir, folder, xmlfile, _ = chunk[index]
+        status = {'file': os.path.join(folder, xmlfile), 'start': start, 'processed': True, 'pid': pid, 'peak_rss_kb': None, 'cache_info': {}}
+        stats_json = resource_failure(inputfile, status, 'timeout')
+        write_output(get_stats_module(args), stats_json, output_path(output_dir, folder, xmlfile, args), args)
+        status['end'] = time.time()
+        statuses.append(status)
+        # The earlier files in the chunk have their output, but their statuses were lost with the worker
+        for inputfile, output_dir, folder, xmlfile, _ in chunk[:index]:
+            statuses.append({'file': os.path.join(folder, xmlfile), 'start': start, 'end': start, 'pid': pid,
+                             'processed': False, 'peak_rss_kb': None, 'cache_info': {}})
+        if chunk[index + 1:]:
+            new_chunks.append(chunk[index + 1:])
+    return statuses, new_chunks
+
+
+def run_supervised(pool, chunks, args, progress):
+    """Run process_chunk() for each chunk in the pool, restarting workers that pass the --timeout. Returns a list of the statuses of all files."""
+    pending = {}
+    chunk_ids = iter(range(sys.maxsize))
+
+    def submit(chunk):
+        chunk_id = next(chunk_ids)
+        pending[chunk_id] = (chunk, pool.apply_async(process_chunk, (chunk, chunk_id)))
+
+    for chunk in chunks:
+        submit(chunk)
+    statuses = []
+    while pending:
+        for chunk_id, (chunk, result) in list(pending.items()):
+            if result.ready():
+                statuses += result.get()
+                del pending[chunk_id]
+        lost_statuses, new_chunks = kill_timed_out_workers(pending, progress, args)
+        statuses += lost_statuses
+        for chunk in new_chunks:
+            submit(chunk)
+        time.sleep(0.05)
+    return statuses
 
 
 def loop_folder(folder, args, data_dir, output_dir):
@@ -164,9 +457,44 @@ def loop(args):
         for folder in os.listdir(args.data):
             files += loop_folder(folder, args, data_dir=args.data, output_dir=args.output)
 
+    if args.cache_dir:
+        # Hash the stats code and reference data once here, rather than in every process
+        args.cache_version = statsrunner.cache.run_version(get_stats_module(args), args)
+
     if args.multi > 1:
-        from multiprocessing import Pool
-        pool = Pool(args.multi)
-        pool.map(process_file, files)
+        import multiprocessing
+        if multiprocessing.get_start_method() == 'fork':
+            # Load the stats module and its reference data before the workers are forked, so that they share
+            # those pages copy-on-write. Freezing the garbage collector stops it touching (and so copying) them.
+            get_stats_module(args)
+            gc.freeze()
+        # Hand out the most expensive files first, in chunks of similar cost
+        timings = statsrunner.scheduling.load_timings(args.timings_file)
+        costs = statsrunner.scheduling.estimate_costs(files, timings)
+        chunks = statsrunner.scheduling.make_chunks(files, costs, args.multi)
+        if args.timeout:
+            manager = multiprocessing.Manager()
+            worker_progress = manager.dict()
+            pool = multiprocessing.Pool(args.multi, initializer=init_worker, initargs=(args, worker_progress), maxtasksperchild=args.max_tasks_per_child)
+            statuses = run_supervised(pool, chunks, args, worker_progress)
+            # The tasks of any killed workers never complete, which close() would wait for, so stop the (now idle) workers
+            pool.terminate()
+            manager.shutdown()
+        else:
+            pool = multiprocessing.Pool(args.multi, initializer=init_worker, initargs=(args,), maxtasksperchild=args.max_tasks_per_child)
+            statuses = []
+            for chunk_statuses in pool.imap_unordered(process_chunk, chunks):
+                statuses += chunk_statuses
+            pool.close()
+        pool.join()
+        print('Tail time: {0:.2f}s (last process finish minus first idle process)'.format(
+            statsrunner.scheduling.tail_time(statuses)))
     else:
-        list(map(process_file, files))
+        init_worker(args)
+        statuses = list(map(process_file, files))
+    report_cache_info(statuses)
+    statsrunner.resources.write_resources(os.path.join(args.output, 'loop_resources.json'), statuses)
+    if args.profile_stats:
+        statsrunner.profiling.write_profile(os.path.join(args.output, 'profile', 'stats_timing.json'), statuses, sum_cache_info(statuses))
+    if args.timings_file:
+        statsrunner.scheduling.save_timings(args.timings_file, statsrunner.scheduling.load_timings(args.timings_file), statuses)
@@ -0,0 +1,99 @@
+"""
+Timing of the stats functions, for the loop's --profile-stats option.
+
+Each process records, for every (stats class, stat) pair, the number of calls,
+the total and maximum time, and a histogram of times with logarithmic buckets,
+so that profiles from different files and processes can be merged by adding
+them up, and percentiles estimated from the result.
+
+"""
+import json
+import math
+import os
+
+# Number of histogram buckets for each doubling of time
+BUCKETS_PER_DOUBLING = 8
+
+
+def record(profile, key, seconds):
+    """Add a single call taking seconds to the profile entry for key."""
+    if key not in profile:
+        profile[key] = {'calls': 0, 'total': 0.0, 'max': 0.0, 'histogram': {}}
+    entry = profile[key]
+    entry['calls'] += 1
+    entry['total'] += seconds
+    if seconds > entry['max']:
+        entry['max'] = seconds
+    bucket = int(math.floor(math.log2(seconds * 1e9) * BUCKETS_PER_DOUBLING)) if seconds > 0 else 0
+    entry['histogram'][bucket] = entry['histogram'].get(bucket, 0) + 1
+
+
+def merge(entry, other):
+    """Add the profile entry other into entry."""
+    entry['calls'] += other['calls']
+    entry['total'] += other['total']
+    entry['max'] = max(entry['max'], other['max'])
+    for bucket, count in other['histogram'].items():
+        entry['histogram'][bucket] = entry['histogram'].get(bucket, 0) + count
+
+
+def percentile(entry, fraction):
+    """Estimate the given percentile (as a fraction) of the call times in entry, from its histogram."""
+    target = fraction * entry['calls']
+    seen = 0
+    for bucket in sorted(entry['histogram']):
+        seen += entry['histogram'][bucket]
+        if seen >= target:
+            # Upper bound of the bucket, which can't be more than the largest time seen
+            return min(2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING) / 1e9, entry['max'])
+    return entry['max']
+
+
+def summarise(entry):
+    return {
+        'calls': entry['calls'],
+        'total': entry['total'],
+        'p50': percentile(entry, 0.5),
+        'p99': percentile(entry, 0.99),
+        'max': entry['max'],
+    }
+
+
+def write_profile(filename, statuses, cache_info):
+    """Merge the profiles of each file, and write a summary by stat, by stats class and by publisher to filename.
+
+    Args:
+        filename: The JSON file to write.
+        statuses: The statuses returned by process_file().
+        cache_info: Counters for the caches of the stats module, summed over all processes.
+    """
+    by_stat = {}
+    by_class = {}
+    by_publisher = {}
+    totals = {'calls': 0, 'total': 0.0, 'max': 0.0, 'histogram': {}}
+
+    def add(out, key, entry):
+        if key not in out:
+            out[key] = {'calls': 0, 'total': 0.0, 'max': 0.0, 'histogram': {}}
+        merge(out[key], entry)
+
+    for status in statuses:
+        publisher = status['file'].split(os.sep)[0]
+        for (class_name, stat_name), entry in status.get('profile', {}).items():
+            add(by_stat, class_name + '.' + stat_name, entry)
+            add(by_class, class_name, entry)
+            add(by_publisher, publisher, entry)
+            merge(totals, entry)
+
+    try:
+        os.makedirs(os.path.dirname(filename))
+    except OSError:
+        pass
+    with open(filename, 'w') as fp:
+        json.dump({
+            'totals': summarise(totals),
+            'by_stat': {k: summarise(v) for k, v in by_stat.items()},
+            'by_class': {k: summarise(v) for k, v in by_class.items()},
+            'by_publisher': {k: summarise(v) for k, v in by_publisher.items()},
+            'cache_info': cache_info,
+        }, fp, sort_keys=True, indent=2)
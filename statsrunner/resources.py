@@ -0,0 +1,74 @@
+"""
+Memory limits and peak memory measurement for the processes of the loop.
+
+With --max-memory, each process running the loop has its address space
+limited, so that a pathological file raises a MemoryError in its own process
+(and is recorded as memoryexceeded) rather than taking down the pool or
+sending the machine into swap. The peak resident memory of the process while
+processing each file is recorded in loop_resources.json in the output
+directory.
+
+"""
+import json
+import os
+import resource
+
+
+def set_memory_limit(megabytes):
+    """Limit the address space of the current process to megabytes."""
+    limit = megabytes * 1024 * 1024
+    hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of the current process, where the kernel supports it (Linux).
+
+    Returns True if the peak was reset, False otherwise.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """Return the peak resident memory of the current process in kilobytes.
+
+    This is since the last reset_peak_rss() where that is supported, and
+    otherwise since the process started.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss // 1024 if os.uname()[0] == 'Darwin' else maxrss
+
+
+def write_resources(filename, statuses):
+    """Write the time taken and peak resident memory for each file to filename, as JSON.
+
+    Args:
+        filename: The JSON file to write.
+        statuses: The statuses returned by process_file().
+    """
+    resources = {}
+    for status in statuses:
+        resources[status['file']] = {
+            'peak_rss_kb': status['peak_rss_kb'],
+            'seconds': round(status['end'] - status['start'], 4),
+            'processed': status['processed'],
+            'memoryexceeded': status.get('memoryexceeded', False),
+            'timeout': status.get('timeout', False),
+        }
+    with open(filename, 'w') as fp:
+        json.dump(resources, fp, sort_keys=True, indent=2)
@@ -0,0 +1,79 @@
+"""
+Scheduling of files across the processes of the loop.
+
+Files are sorted most expensive first, so that a single large file is not left
+running on its own at the end of the run, and then grouped into chunks of
+roughly equal cost, so that the many small files don't each cost a round trip
+to a worker. The cost of a file is estimated from the time it took in an
+earlier run, if known, or otherwise from its size.
+
+"""
+import json
+import os
+
+
+def load_timings(timings_file):
+    """Return a dictionary of seconds taken for each file (by folder/filename) in earlier runs."""
+    if timings_file and os.path.exists(timings_file):
+        with open(timings_file) as fp:
+            return json.load(fp)
+    return {}
+
+
+def save_timings(timings_file, timings, statuses):
+    """Update the timings file with the time taken for each file in this run.
+
+    Files that were not processed (eg. because their output was cached) keep their earlier timing.
+    """
+    for status in statuses:
+        if status['processed']:
+            timings[status['file']] = round(status['end'] - status['start'], 4)
+    with open(timings_file, 'w') as fp:
+        json.dump(timings, fp, sort_keys=True, indent=2)
+
+
+def estimate_costs(files, timings):
+    """Return a list of the estimated cost in seconds of each file.
+
+    Files without a timing are estimated from their size, at the average
+    seconds per byte of the files that have timings.
+    """
+    sizes = [os.stat(f[0]).st_size for f in files]
+    keys = [os.path.join(f[2], f[3]) for f in files]
+    timed_seconds = sum(timings[key] for key in keys if key in timings)
+    timed_bytes = sum(size for key, size in zip(keys, sizes) if key in timings)
+    seconds_per_byte = timed_seconds / timed_bytes if timed_seconds and timed_bytes else 1e-6
+    return [timings[key] if key in timings else size * seconds_per_byte for key, size in zip(keys, sizes)]
+
+
+def make_chunks(files, costs, processes):
+    """Sort files longest first, and group them into chunks to be handed to the workers.
+
+    Each chunk is filled until it reaches a fraction of the cost per process,
+    so expensive files get a chunk to themselves while cheap files are batched.
+    """
+    ordered = sorted(zip(costs, range(len(files))), reverse=True)
+    target = sum(costs) / (processes * 16)
+    chunks = []
+    chunk = []
+    chunk_cost = 0
+    for cost, i in ordered:
+        chunk.append(files[i])
+        chunk_cost += cost
+        if chunk_cost >= target:
+            chunks.append(chunk)
+            chunk = []
+            chunk_cost = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def tail_time(statuses):
+    """Return the time between the first process running out of work and the last process finishing."""
+    finishes = {}
+    for status in statuses:
+        finishes[status['pid']] = max(finishes.get(status['pid'], 0), status['end'])
+    if not finishes:
+        return 0
+    return max(finishes.values()) - min(finishes.values())
@@ -1,5 +1,48 @@
+import inspect
+
+# Enabled stats functions for each stats class, see stat_plan()
+stat_plans = {}
+# A reusable instance of each stats class, see reset_stats_object()
+stats_objects = {}
+
+
 def use_stat(stats, name):
     if hasattr(stats, 'enabled_stats'):
         return name in stats.enabled_stats
     else:
         return not name.startswith('_')
+
+
+def stat_plan(stats):
+    """Return a list of (name, function) tuples for the enabled stats of the stats object, in name order.
+
+    This is worked out once per stats class, rather than inspecting the object
+    every time its stats are called. Each function should be called with the
+    stats object as its only argument.
+    """
+    stats_class = type(stats)
+    if stats_class not in stat_plans:
+        stat_plans[stats_class] = [
+            (name, function.__func__)
+            for name, function in inspect.getmembers(stats, predicate=inspect.ismethod)
+            if use_stat(stats, name)
+        ]
+    return stat_plans[stats_class]
+
+
+def reset_stats_object(stats_class, **attributes):
+    """Return this process's instance of stats_class, reset as if newly created, with the given attributes set.
+
+    This avoids creating a new object for every activity/organisation. Any state
+    left from the previous use (eg. memoized values) is discarded.
+    """
+    if stats_class not in stats_objects:
+        stats_objects[stats_class] = stats_class()
+    else:
+        stats = stats_objects[stats_class]
+        stats.__dict__.clear()
+        if stats_class.__init__ is not object.__init__:
+            stats.__init__()
+    stats = stats_objects[stats_class]
+    stats.__dict__.update(attributes)
+    return stats
@@ -0,0 +1,142 @@
+import argparse
+import datetime
+import json
+import pickle
+from collections import defaultdict
+
+import stats.countonly
+import stats.transparency_indicator
+from . import aggregate as aggregate_module
+from .aggregate import aggregate, aggregate_file, blank_stats, dumps_aggregate, make_accumulators, merge_stats, plain_dicts
+
+
+def test_plain_dicts():
+    value = defaultdict(lambda: defaultdict(int))
+    value['a']['b'] += 1
+    plain = plain_dicts({'stat': value, 'count': 2})
+    assert plain == {'stat': {'a': {'b': 1}}, 'count': 2}
+    assert type(plain['stat']['a']) == dict
+    assert pickle.loads(pickle.dumps(plain)) == plain
+
+
+def test_dumps_aggregate_null_key():
+    # eg. activities_per_year, for activities with and without a start date
+    value = defaultdict(int, {2015: 1, None: 2})
+    assert json.loads(dumps_aggregate(value)) == {'2015': 1, 'null': 2}
+
+
+def test_merge_stats():
+    accumulators = make_accumulators(stats.countonly)
+    assert make_accumulators(stats.countonly) is accumulators
+    total = blank_stats(accumulators)
+    assert total == {'activities': 0}
+    for stats_values in [{'activities': 1}, {'activities': 2, 'other': {'a': 1}}, {'other': {'a': 2, 'b': 1}}]:
+        merge_stats(accumulators, total, stats_values)
+    assert total == {'activities': 3, 'other': {'a': 3, 'b': 1}}
+
+
+def test_aggregate_multi(tmpdir):
+    outputs = []
+    for multi in [1, 2]:
+        output = tmpdir.mkdir('out{}'.format(multi))
+        for publisher, files in [('pub1', 1), ('pub2', 3), ('pub3', 2)]:
+            for i in range(files):
+                stats_json = {'file': {}, 'elements': [{'activities': 1}] * (i + 1)}
+                aggregate_file(stats.countonly, stats_json, output.join('aggregated-file', publisher, '{}.xml'.format(i)).strpath)
+        args = argparse.Namespace(
+            stats_module='stats.countonly', output=output.strpath, verbose_loop=False, intermediate_format='json',
+            bundle=False, output_backend='json', multi=multi, today=datetime.date(2020, 1, 1), incremental=False)
+        aggregate(args)
+        outputs.append(output)
+    for output in outputs:
+        assert output.join('aggregated-publisher', 'pub2', 'activities.json').read() == '6'
+        assert output.join('aggregated', 'activities.json').read() == '10'
+
+
+def test_aggregate_incremental(tmpdir, monkeypatch):
+    output = tmpdir.mkdir('out')
+
+    def loop_output():
+        for publisher, files in [('pub1', 1), ('pub2', 3)]:
+            for i in range(files):
+                stats_json = {'file': {}, 'elements': [{'activities': 1}] * (i + 1)}
+                aggregate_file(stats.countonly, stats_json, output.join('aggregated-file', publisher, '{}.xml'.format(i)).strpath)
+    loop_output()
+    args = argparse.Namespace(
+        stats_module='stats.countonly', output=output.strpath, verbose_loop=False, intermediate_format='json',
+        bundle=False, output_backend='json', multi=1, today=datetime.date(2020, 1, 1), incremental=True,
+        incremental_cache_dir=None)
+    summed = []
+    sum_publisher_files = aggregate_module.sum_publisher_files
+    monkeypatch.setattr(aggregate_module, 'sum_publisher_files',
+                        lambda stats_module, accumulators, base_folder, folder, *rest: summed.append(folder) or
+                        sum_publisher_files(stats_module, accumulators, base_folder, folder, *rest))
+
+    aggregate(args)
+    assert sorted(summed) == ['pub1', 'pub2']
+    assert output.join('aggregated', 'activities.json').read() == '7'
+
+    # Only the publisher with a changed file is summed again
+    del summed[:]
+    aggregate_file(stats.countonly, {'file': {}, 'elements': [{'activities': 1}] * 12},
+                   output.join('aggregated-file', 'pub2', '0.xml').strpath)
+    aggregate(args)
+    assert summed == ['pub2']
+    assert output.join('aggregated-publisher', 'pub1', 'activities.json').read() == '1'
+    assert output.join('aggregated-publisher', 'pub2', 'activities.json').read() == '17'
+    assert output.join('aggregated', 'activities.json').read() == '18'
+
+    # A removed publisher's total is removed too
+    del summed[:]
+    output.join('aggregated-file', 'pub1').remove()
+    aggregate(args)
+    assert summed == []
+    assert output.join('aggregated', 'activities.json').read() == '17'
+    assert not output.join('aggregate-cache', 'pub1.pickle').check()
+
+    # The files are compared by their contents, so with the totals kept outside the output directory, they are
+    # reused when the output is removed and the files written again, as git.sh does
+    args.incremental_cache_dir = tmpdir.join('cache').strpath
+    for run in range(2):
+        del summed[:]
+        output.remove()
+        loop_output()
+        aggregate(args)
+    # Only summed in the first run
+    assert summed == []
+    assert output.join('aggregated-publisher', 'pub2', 'activities.json').read() == '6'
+    assert output.join('aggregated', 'activities.json').read() == '7'
+    assert tmpdir.join('cache', 'pub2.pickle').check()
+    assert not output.join('aggregate-cache').check()
+
+
+def test_aggregate_largest(tmpdir):
+    output = tmpdir.mkdir('out')
+    # aa is in helpers/transparency_indicator/Timeliness_Files_1.2.csv, publishing quarterly
+    for publisher, elements in [('aa', [{'hierarchy': '1', 'timelag_months': {'1': 2}},
+                                        {'hierarchy': '2', 'timelag_months': {'1-2': 1}}]),
+                                ('not-in-timeliness', [{'hierarchy': '', 'timelag_months': {'12': 1}}])]:
+        stats_json = {'file': {}, 'elements': elements}
+        aggregate_file(stats.transparency_indicator, stats_json, output.join('aggregated-file', publisher, '0.xml').strpath)
+    args = argparse.Namespace(
+        stats_module='stats.transparency_indicator', output=output.strpath, verbose_loop=False, intermediate_format='json',
+        bundle=False, output_backend='json', multi=1, today=datetime.date(2020, 1, 1), incremental=False)
+    aggregate(args)
+
+    def read(*path):
+        return json.loads(output.join(*path).read())
+    # The largest hierarchy of the activities, rather than 0
+    assert read('aggregated-file', 'aa', '0.xml', 'hierarchy.json') == 2
+    assert read('aggregated-publisher', 'aa', 'hierarchy.json') == 2
+    assert read('aggregated-publisher', 'not-in-timeliness', 'hierarchy.json') == 0
+    assert read('aggregated-publisher', 'aa', 'timelag.json') == 4
+    assert read('aggregated-publisher', 'aa', 'frequency.json') == 3
+    assert read('aggregated-publisher', 'not-in-timeliness', 'timelag.json') == 1
+    assert read('aggregated-publisher', 'not-in-timeliness', 'frequency.json') == -1
+    # There is no by_hierarchy stat to split the publisher's stats by hierarchy
+    assert read('aggregated-publisher', 'aa', 'bottom_hierarchy.json') == {}
+    assert read('aggregated-publisher', 'aa', 'top_hierarchy.json') == {}
+    # The largest of the publishers, rather than 0
+    assert read('aggregated', 'hierarchy.json') == 2
+    assert read('aggregated', 'timelag.json') == 4
+    assert read('aggregated', 'frequency.json') == 3
@@ -0,0 +1,93 @@
+import argparse
+import datetime
+import json
+
+import stats.countonly
+import stats.dashboard
+from . import cache
+from .loop import process_file
+
+
+def test_file_key(tmpdir):
+    inputfile = tmpdir.join('test.xml')
+    inputfile.write('<iati-activities/>')
+    key = cache.file_key(inputfile.strpath, 'pub/test.xml', 'version1')
+    assert key == cache.file_key(inputfile.strpath, 'pub/test.xml', 'version1')
+    assert key != cache.file_key(inputfile.strpath, 'pub/test.xml', 'version2')
+    # The same contents at another path
+    assert key != cache.file_key(inputfile.strpath, 'pub/test2.xml', 'version1')
+    assert key != cache.file_key(inputfile.strpath, 'pub2/test.xml', 'version1')
+    inputfile.write('<iati-organisations/>')
+    assert key != cache.file_key(inputfile.strpath, 'pub/test.xml', 'version1')
+
+
+def test_cache_same_contents_other_path(tmpdir, monkeypatch):
+    """Files with identical contents but different ckan filetypes each get their own wrong_roots."""
+    monkeypatch.setattr(stats.dashboard, 'ckan', {
+        'pubact': {'pubact-test.xml': {'extras': {'filetype': '"activity"'}}},
+        'puborg': {'puborg-test.xml': {'extras': {'filetype': '"organisation"'}}},
+    })
+    data_dir = tmpdir.mkdir('data')
+    for folder in ['pubact', 'puborg']:
+        data_dir.mkdir(folder).join(folder + '-test.xml').write('<iati-activities version="2.03"><iati-activity/></iati-activities>')
+    output_dir = tmpdir.mkdir('out')
+    args = argparse.Namespace(
+        stats_module='stats.dashboard', verbose_loop=False, intermediate_format='json', bundle=False,
+        new=False, cache_dir=tmpdir.join('cache').strpath, stream=False,
+        strict=False, debug=False, today=datetime.date(2020, 1, 1), profile_stats=False, timeout=None)
+    args.cache_version = cache.run_version(stats.dashboard, args)
+
+    def wrong_roots(folder):
+        xmlfile = folder + '-test.xml'
+        process_file((data_dir.join(folder, xmlfile).strpath, output_dir.strpath, folder, xmlfile, args))
+        return json.loads(output_dir.join('aggregated-file', folder, xmlfile, 'wrong_roots.json').read())
+
+    assert wrong_roots('pubact') == {}
+    # Not the cached output of the activity file
+    assert wrong_roots('puborg') == {'iati-activities': 1}
+    # Each is reused from the cache
+    output_dir.remove()
+    assert wrong_roots('pubact') == {}
+    assert wrong_roots('puborg') == {'iati-activities': 1}
+
+
+def test_store_fetch(tmpdir):
+    cache_dir = tmpdir.join('cache').strpath
+    outputfile = tmpdir.join('out', 'test.xml')
+    outputfile.join('activities.json').write('3', ensure=True)
+
+    assert not cache.fetch(cache_dir, 'abcdef', outputfile.strpath)
+    cache.store(cache_dir, 'abcdef', outputfile.strpath)
+
+    fetched = tmpdir.join('out2', 'test.xml')
+    assert cache.fetch(cache_dir, 'abcdef', fetched.strpath)
+    assert fetched.join('activities.json').read() == '3'
+
+
+def test_store_fetch_bundle(tmpdir):
+    cache_dir = tmpdir.join('cache').strpath
+    outputfile = tmpdir.join('out', 'test.xml.bundle.json')
+    outputfile.write('{"activities": 3}', ensure=True)
+
+    assert not cache.fetch(cache_dir, 'abcdef', outputfile.strpath)
+    cache.store(cache_dir, 'abcdef', outputfile.strpath)
+
+    fetched = tmpdir.join('out2', 'test.xml.bundle.json')
+    assert cache.fetch(cache_dir, 'abcdef', fetched.strpath)
+    assert fetched.read() == '{"activities": 3}'
+    # The modification time is kept, for aggregate --incremental
+    assert fetched.mtime() == tmpdir.join('cache', 'ab', 'abcdef').mtime()
+
+
+def test_run_version():
+    def run_version(**kwargs):
+        options = dict(today=datetime.date(2020, 1, 1), intermediate_format='json', bundle=False, strict=False, stream=False)
+        options.update(kwargs)
+        return cache.run_version(stats.countonly, argparse.Namespace(**options))
+    version = run_version()
+    assert version == run_version()
+    assert version != run_version(today=datetime.date(2020, 1, 2))
+    # Each option that changes the output of a file changes the version
+    versions = set([version, run_version(intermediate_format='pickle'), run_version(bundle=True),
+                    run_version(strict=True), run_version(stream=True)])
+    assert len(versions) == 5
@@ -0,0 +1,48 @@
+import argparse
+import json
+from decimal import Decimal
+
+from . import database
+
+
+def test_flatten_unflatten():
+    value = json.loads('{"b": {"2015": 1.5, "2014": 2}, "a": [1, 2], "c": {}, "d": true, "e": null, "f": "text"}')
+    rows = list(database.flatten(value))
+    assert rows[0] == (('b', '2015'), 1.5, None)
+    assert rows[2] == (('a',), None, '[1, 2]')
+    assert [(database.encode_key_path(key_path), v, json_value) for key_path, v, json_value in rows][3] == ('["c"]', None, '{}')
+    unflattened = database.unflatten([(database.encode_key_path(key_path), v, json_value) for key_path, v, json_value in rows])
+    assert json.dumps(unflattened) == json.dumps(value)
+    assert list(database.flatten(Decimal('100.50'))) == [((), 100.5, None)]
+    assert list(database.flatten(2 ** 70)) == [((), None, str(2 ** 70))]
+
+
+def test_write_read_export(tmpdir):
+    db = database.connect(tmpdir.strpath)
+    for publisher, activities in [('pub1', 3), ('pub2', 5)]:
+        database.write_json(db, 'aggregated-publisher', publisher, '', 'activities', str(activities))
+        database.write_json(db, 'aggregated-publisher', publisher, '', 'currencies', '{\n  "USD": 2,\n  "EUR": 1\n}')
+        database.write_value(db, 'aggregated-file', publisher, 'test.xml', 'activities', activities)
+    db.commit()
+
+    assert db.execute('''SELECT publisher, value FROM stats
+                         WHERE level = 'aggregated-publisher' AND stat = 'activities' AND key_path = '[]'
+                         ORDER BY value DESC''').fetchall() == [('pub2', 5), ('pub1', 3)]
+    assert list(database.read_values(db, 'aggregated-publisher', 'pub1')) == [
+        ('pub1', '', 'activities', 3), ('pub1', '', 'currencies', {'USD': 2, 'EUR': 1})]
+    assert database.publishers(db, 'aggregated-file') == ['pub1', 'pub2']
+
+    # Writing a level again replaces it
+    database.clear_levels(db, ['aggregated-file'])
+    database.write_value(db, 'aggregated-file', 'pub1', 'test.xml', 'activities', 4)
+    db.commit()
+    db.close()
+
+    database.export(argparse.Namespace(output=tmpdir.strpath, bundle=False))
+    assert tmpdir.join('aggregated-publisher', 'pub1', 'currencies.json').read() == '{\n  "USD": 2,\n  "EUR": 1\n}'
+    assert tmpdir.join('aggregated-file', 'pub1', 'test.xml', 'activities.json').read() == '4'
+    assert not tmpdir.join('aggregated-file', 'pub2').check()
+    assert tmpdir.join('inverted-publisher').check(dir=True)
+
+    database.export(argparse.Namespace(output=tmpdir.strpath, bundle=True))
+    assert tmpdir.join('aggregated-file', 'pub1', 'test.xml.bundle.json').read() == '{\n  "activities": 4\n}'
@@ -0,0 +1,87 @@
+import datetime
+import json
+from collections import defaultdict
+from decimal import Decimal
+
+import stats.countonly
+from .aggregate import aggregate_file, dumps_aggregate
+from .intermediate import (bundle_filename, dump_pickle, dumps_json_bundle, export_json, file_output_path, load,
+                           split_bundle_filename, split_filename, stat_filename)
+from .invert import invert_dir
+
+
+def example_aggregates():
+    return {
+        'sums': {'USD': {2015: Decimal('100.50'), 2016: Decimal('3')}},
+        'activity_dates': {'start_actual': defaultdict(int, {datetime.date(2015, 1, 2): 2})},
+        'count': 3,
+    }
+
+
+def test_filenames():
+    assert stat_filename('activities', 'json') == 'activities.json'
+    assert stat_filename('activities', 'pickle') == 'activities.pickle'
+    assert split_filename('activities.pickle') == ('activities', 'pickle')
+    assert split_filename('activities.json') == ('activities', 'json')
+    assert split_filename('activities.txt') == (None, None)
+    assert bundle_filename('test.xml', 'pickle') == 'test.xml.bundle.pickle'
+    assert split_bundle_filename('test.xml.bundle.json') == ('test.xml', 'json')
+    assert split_bundle_filename('activities.json') == (None, None)
+    assert file_output_path('pub', 'test.xml', 'json', False) == 'pub/test.xml'
+    assert file_output_path('pub', 'test.xml', 'json', True) == 'pub/test.xml.bundle.json'
+
+
+def test_pickle_matches_json(tmpdir):
+    for name, aggregate in example_aggregates().items():
+        json_text = dumps_aggregate(aggregate)
+        tmpdir.join(stat_filename(name, 'json')).write(json_text)
+        dump_pickle(dumps_aggregate(aggregate, indent=None), tmpdir.join(stat_filename(name, 'pickle')).strpath)
+        # Both formats are read as the same value
+        assert load(tmpdir.join(name + '.pickle').strpath) == load(tmpdir.join(name + '.json').strpath, parse_float=Decimal)
+        assert load(tmpdir.join(name + '.json').strpath) == json.loads(json_text)
+
+    exported = tmpdir.mkdir('exported')
+    for name, aggregate in example_aggregates().items():
+        dump_pickle(dumps_aggregate(aggregate, indent=None), exported.join(stat_filename(name, 'pickle')).strpath)
+    export_json(exported.strpath)
+    assert sorted(f.basename for f in exported.listdir()) == ['activity_dates.json', 'count.json', 'sums.json']
+    for name in example_aggregates():
+        assert exported.join(name + '.json').read() == tmpdir.join(name + '.json').read()
+    assert tmpdir.join('sums.json').read() == '{\n  "USD": {\n    "2015": 100.5,\n    "2016": 3.0\n  }\n}'
+
+
+def test_aggregate_file_formats(tmpdir):
+    stats_json = {'file': {}, 'elements': [{'activities': 1}, {'activities': 1}]}
+    aggregate_file(stats.countonly, stats_json, tmpdir.join('json').strpath)
+    aggregate_file(stats.countonly, stats_json, tmpdir.join('pickle').strpath, 'pickle')
+    assert [f.basename for f in tmpdir.join('json').listdir()] == ['activities.json']
+    assert [f.basename for f in tmpdir.join('pickle').listdir()] == ['activities.pickle']
+    assert load(tmpdir.join('pickle', 'activities.pickle').strpath) == 2
+    export_json(tmpdir.join('pickle').strpath)
+    assert tmpdir.join('pickle', 'activities.json').read() == tmpdir.join('json', 'activities.json').read() == '2'
+
+
+def test_dumps_json_bundle():
+    aggregates = example_aggregates()
+    bundle_text = dumps_json_bundle(dict((name, dumps_aggregate(aggregate)) for name, aggregate in aggregates.items()))
+    assert bundle_text == json.dumps(dict((name, json.loads(dumps_aggregate(aggregate)))
+                                          for name, aggregate in example_aggregates().items()), sort_keys=True, indent=2)
+    assert dumps_json_bundle({}) == json.dumps({}, indent=2)
+
+
+def test_aggregate_file_bundle(tmpdir):
+    stats_json = {'file': {}, 'elements': [{'activities': 1}, {'activities': 1}]}
+    aggregate_file(stats.countonly, stats_json, tmpdir.join('pub', 'test.xml').strpath)
+    aggregate_file(stats.countonly, stats_json, tmpdir.join('bundles', 'pub', 'test.xml.bundle.json').strpath, 'json', True)
+    aggregate_file(stats.countonly, stats_json, tmpdir.join('pickles', 'pub', 'test.xml.bundle.pickle').strpath, 'pickle', True)
+    assert tmpdir.join('bundles', 'pub', 'test.xml.bundle.json').read() == '{\n  "activities": 2\n}'
+    assert load(tmpdir.join('pickles', 'pub', 'test.xml.bundle.pickle').strpath) == {'activities': 2}
+    export_json(tmpdir.join('pickles').strpath)
+    assert tmpdir.join('pickles', 'pub').listdir() == [tmpdir.join('pickles', 'pub', 'test.xml.bundle.json')]
+    assert tmpdir.join('pickles', 'pub', 'test.xml.bundle.json').read() == '{\n  "activities": 2\n}'
+
+    # Inverting the bundles gives the same as inverting a folder per file
+    invert_dir('pub', 'inverted', tmpdir.strpath)
+    invert_dir('bundles', 'inverted-bundles', tmpdir.strpath)
+    assert tmpdir.join('inverted', 'activities.json').read() == '{\n  "test.xml": 2\n}'
+    assert tmpdir.join('inverted-bundles', 'activities.json').read() == tmpdir.join('inverted', 'activities.json').read()
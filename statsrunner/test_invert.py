@@ -0,0 +1,101 @@
+import argparse
+import json
+
+from . import database
+from .invert import in_stats_group, invert, invert_json, invert_stat, merge_inverted
+
+
+def write_aggregated(output):
+    for publisher, files in [('pub1', 1), ('pub2', 2)]:
+        output.join('aggregated-publisher', publisher, 'activities.json').write(str(files * 2), ensure=True)
+        for i in range(files):
+            output.join('aggregated-file', publisher, '{}.xml'.format(i), 'activities.json').write(str(i + 1), ensure=True)
+            output.join('aggregated-file', publisher, '{}.xml'.format(i), 'currencies.json').write(
+                '{"USD": %d}' % (i + 1), ensure=True)
+    for dirname in ['inverted-publisher', 'inverted-file', 'inverted-file-publisher']:
+        output.mkdir(dirname)
+
+
+def test_in_stats_group():
+    names = ['activities', 'currencies', 'elements', 'versions']
+    groups = [[name for name in names if in_stats_group(name, (group, 3))] for group in range(3)]
+    assert sorted(sum(groups, [])) == names
+    assert all(in_stats_group(name, None) for name in names)
+
+
+def test_merge_inverted():
+    stats_values = [
+        ('pub1', '0.xml', {'activities': 1, 'currencies': {'USD': 1}, 'by_year': {'2015': {'USD': 1}}, 'text': {'a': 'x'}}),
+        ('pub1', '1.xml', {'activities': 2, 'currencies': {'EUR': 2}, 'by_year': {'2015': {'USD': 2}}}),
+        ('pub2', '0.xml', {'activities': 3, 'currencies': {'USD': 3}, 'by_year': {'2016': {'USD': {'a': 1}}}, 'text': {'a': 'y'}}),
+    ]
+    expected = {}
+    for publisher, parent_folder, values in stats_values:
+        for stats_name, stats_value in values.items():
+            invert_stat(expected, stats_name, stats_value, parent_folder)
+    total = {}
+    for publisher in ['pub1', 'pub2']:
+        out = {}
+        for stats_publisher, parent_folder, values in stats_values:
+            if stats_publisher == publisher:
+                for stats_name, stats_value in values.items():
+                    invert_stat(out, stats_name, stats_value, parent_folder)
+        merge_inverted(total, out)
+    assert json.dumps(total, sort_keys=True) == json.dumps(expected, sort_keys=True)
+    assert total['activities'] == {'0.xml': 4, '1.xml': 2}
+    assert total['text'] == {'a': {'0.xml': 'y'}}
+
+
+def test_invert_json(tmpdir):
+    output = tmpdir.mkdir('out')
+    write_aggregated(output)
+    invert_json(output.strpath)
+    assert output.join('inverted-publisher', 'activities.json').read() == '{\n  "pub1": 2,\n  "pub2": 4\n}'
+    assert output.join('inverted-file', 'activities.json').read() == '{\n  "0.xml": 2,\n  "1.xml": 2\n}'
+    assert output.join('inverted-file', 'currencies.json').read() == \
+        '{\n  "USD": {\n    "0.xml": 1,\n    "1.xml": 2\n  }\n}'
+    assert output.join('inverted-file-publisher', 'pub2', 'activities.json').read() == '{\n  "0.xml": 1,\n  "1.xml": 2\n}'
+
+    # Splitting the stats into groups gives the same files
+    grouped = tmpdir.mkdir('grouped')
+    write_aggregated(grouped)
+    for group in range(2):
+        invert_json(grouped.strpath, (group, 2))
+    inverted = [f for f in output.visit(lambda f: f.ext == '.json' and f.relto(output).startswith('inverted'))]
+    assert len(inverted) == 7
+    for f in inverted:
+        assert grouped.join(f.relto(output)).read() == f.read()
+
+    # With bundles, the publishers are split between the processes instead, which gives the same files too
+    bundled = tmpdir.mkdir('bundled')
+    write_aggregated(bundled)
+    for xmlfile in bundled.join('aggregated-file').visit(lambda f: f.ext == '.xml'):
+        bundle = dict((f.purebasename, json.loads(f.read())) for f in xmlfile.listdir())
+        xmlfile.remove()
+        xmlfile.new(basename=xmlfile.basename + '.bundle.json').write(json.dumps(bundle))
+    invert(argparse.Namespace(output=bundled.strpath, output_backend='json', multi=2, bundle=True))
+    for f in inverted:
+        assert bundled.join(f.relto(output)).read() == f.read()
+
+
+def test_invert_database(tmpdir):
+    db = database.connect(tmpdir.strpath)
+    for publisher, files in [('pub1', 1), ('pub2', 2)]:
+        database.write_value(db, 'aggregated-publisher', publisher, '', 'activities', files * 2)
+        for i in range(files):
+            database.write_value(db, 'aggregated-file', publisher, '{}.xml'.format(i), 'activities', i + 1)
+    db.commit()
+    assert database.stats_names(db, ['aggregated-file']) == ['activities']
+    assert list(database.read_values(db, 'aggregated-file', stats=['currencies'])) == []
+    db.close()
+
+    for multi in [1, 2]:
+        invert(argparse.Namespace(output=tmpdir.strpath, output_backend='sqlite', multi=multi))
+        db = database.connect(tmpdir.strpath)
+        assert list(database.read_values(db, 'inverted-file')) == [('', '', 'activities', {'0.xml': 2, '1.xml': 2})]
+        assert list(database.read_values(db, 'inverted-file-publisher')) == [
+            ('pub1', '', 'activities', {'0.xml': 1}), ('pub2', '', 'activities', {'0.xml': 1, '1.xml': 2})]
+        assert list(database.read_values(db, 'inverted-publisher')) == [('', '', 'activities', {'pub1': 2, 'pub2': 4})]
+        db.close()
+    # The databases of the rows made by each process are removed once copied
+    assert [f.basename for f in tmpdir.listdir()] == [database.DATABASE_FILENAME]
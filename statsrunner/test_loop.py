@@ -0,0 +1,199 @@
+import argparse
+import datetime
+import json
+import os
+import signal
+import time
+
+from lxml import etree
+import pytest
+
+from .loop import FileTimeout, init_worker, iter_root_children, loop as run_loop, process_file, scan_file
+from . import loop
+import stats.countonly
+import statsrunner.shared
+
+
+def test_iter_root_children(tmpdir):
+    xmlfile = tmpdir.join('test.xml')
+    xmlfile.write('''<iati-activities version="2.03">
+        <iati-activity><iati-identifier>A</iati-identifier></iati-activity>
+        <!-- comment -->
+        <iati-activity><iati-identifier>B</iati-identifier></iati-activity>
+    </iati-activities>''')
+    identifiers = []
+    for element in iter_root_children(xmlfile.strpath):
+        assert element.getparent().attrib['version'] == '2.03'
+        # Previously processed children have been removed from the tree
+        assert element.getprevious() is None
+        identifiers.append(element.findtext('iati-identifier'))
+    assert identifiers == ['A', 'B']
+
+
+def test_scan_file(tmpdir):
+    xmlfile = tmpdir.join('test.xml')
+    xmlfile.write('''<iati-activities version="2.03">
+        <iati-activity version="2.02"/>
+        <iati-activity version="2.02"/>
+        <iati-activity/>
+    </iati-activities>''')
+    root, element_versions = scan_file(xmlfile.strpath)
+    assert root.tag == 'iati-activities'
+    assert root.attrib['version'] == '2.03'
+    assert element_versions == ['2.02']
+
+
+def test_scan_file_invalid(tmpdir):
+    xmlfile = tmpdir.join('test.xml')
+    xmlfile.write('<iati-activities><iati-activity>')
+    with pytest.raises(etree.ParseError):
+        scan_file(xmlfile.strpath)
+
+
+def test_process_file_memory_exceeded(tmpdir, monkeypatch):
+    def activities(self):
+        if self.blank:
+            return 0
+        raise MemoryError
+    monkeypatch.setattr(stats.countonly.ActivityStats, 'activities', activities)
+    monkeypatch.setattr(statsrunner.shared, 'stat_plans', {})
+    xmlfile = tmpdir.mkdir('data').mkdir('pub').join('test.xml')
+    xmlfile.write('<iati-activities><iati-activity/></iati-activities>')
+    output_dir = tmpdir.mkdir('out')
+    args = argparse.Namespace(
+        stats_module='stats.countonly', verbose_loop=False, intermediate_format='json', bundle=False,
+        new=False, cache_dir=None, stream=False,
+        strict=False, debug=False, today=datetime.date(2020, 1, 1), profile_stats=False, timeout=None)
+    status = process_file((xmlfile.strpath, output_dir.strpath, 'pub', 'test.xml', args))
+    assert status['processed']
+    assert status['memoryexceeded']
+    assert status['peak_rss_kb'] > 0
+    # The file is recorded as exceeding the memory limit, rather than stopping the loop
+    file_output = output_dir.join('aggregated-file', 'pub', 'test.xml')
+    assert json.loads(file_output.join('memoryexceeded.json').read()) == 1
+    assert json.loads(file_output.join('activities.json').read()) == 0
+
+
+def test_process_file_timeout(tmpdir, monkeypatch):
+    def activities(self):
+        if self.blank:
+            return 0
+        # Catching the timeout in a stat doesn't stop it
+        try:
+            time.sleep(10)
+        except Exception:
+            pass
+        time.sleep(10)
+    monkeypatch.setattr(stats.countonly.ActivityStats, 'activities', activities)
+    monkeypatch.setattr(statsrunner.shared, 'stat_plans', {})
+    xmlfile = tmpdir.mkdir('data').mkdir('pub').join('test.xml')
+    xmlfile.write('<iati-activities><iati-activity/></iati-activities>')
+    output_dir = tmpdir.mkdir('out')
+    args = argparse.Namespace(
+        stats_module='stats.countonly', verbose_loop=False, intermediate_format='json', bundle=False,
+        new=False, cache_dir=None, stream=False,
+        strict=False, debug=False, today=datetime.date(2020, 1, 1), profile_stats=False, timeout=0.1, max_memory=None)
+    alarm_handler = signal.getsignal(signal.SIGALRM)
+    try:
+        init_worker(args)
+        status = process_file((xmlfile.strpath, output_dir.strpath, 'pub', 'test.xml', args))
+    finally:
+        signal.signal(signal.SIGALRM, alarm_handler)
+    assert status['timeout']
+    assert status['end'] - status['start'] < 5
+    file_output = output_dir.join('aggregated-file', 'pub', 'test.xml')
+    assert json.loads(file_output.join('timeout.json').read()) == 1
+    assert json.loads(file_output.join('activities.json').read()) == 0
+
+
+def test_process_file_timeout_handling_parse_error(tmpdir, monkeypatch):
+    set_deadline = loop.set_deadline
+    deadlines = []
+
+    def set_deadline_late(seconds):
+        # The deadline goes off as the ParseError is being handled, before it can be disarmed
+        set_deadline(seconds)
+        deadlines.append(seconds)
+        if deadlines == [0.1, 0]:
+            raise FileTimeout()
+    monkeypatch.setattr(loop, 'set_deadline', set_deadline_late)
+    xmlfile = tmpdir.mkdir('data').mkdir('pub').join('test.xml')
+    xmlfile.write('<iati-activities><iati-activity>')
+    output_dir = tmpdir.mkdir('out')
+    args = argparse.Namespace(
+        stats_module='stats.countonly', verbose_loop=False, intermediate_format='json', bundle=False,
+        new=False, cache_dir=None, stream=False,
+        strict=False, debug=False, today=datetime.date(2020, 1, 1), profile_stats=False, timeout=0.1, max_memory=None)
+    alarm_handler = signal.getsignal(signal.SIGALRM)
+    try:
+        init_worker(args)
+        status = process_file((xmlfile.strpath, output_dir.strpath, 'pub', 'test.xml', args))
+        # The deadline is disarmed once the file is done with
+        assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+    finally:
+        signal.signal(signal.SIGALRM, alarm_handler)
+    assert status['processed']
+    assert status['timeout']
+    file_output = output_dir.join('aggregated-file', 'pub', 'test.xml')
+    assert json.loads(file_output.join('timeout.json').read()) == 1
+
+
+# Data for comparing the output of the loop with and without --stream, keyed by the file's path in the data directory
+STREAM_DATA = {
+    'pub1/pub1-activities.xml': '''<iati-activities version="2.03">
+        <iati-activity default-currency="USD">
+            <iati-identifier>AA-AAA-1</iati-identifier>
+            <reporting-org ref="AA-AAA" type="10"/>
+            <activity-status code="2"/>
+            <activity-date type="1" iso-date="2015-01-01"/>
+            <transaction><transaction-type code="3"/><transaction-date iso-date="2015-02-01"/><value>100</value></transaction>
+        </iati-activity>
+        <!-- A comment between activities -->
+        <iati-activity>
+            <iati-identifier>AA-AAA-2</iati-identifier>
+            <budget><period-start iso-date="2016-01-01"/><period-end iso-date="2016-12-31"/><value>50</value></budget>
+        </iati-activity>
+    </iati-activities>''',
+    'pub1/pub1-organisation.xml': '''<iati-organisations version="2.03">
+        <iati-organisation><organisation-identifier>AA-AAA</organisation-identifier></iati-organisation>
+    </iati-organisations>''',
+    'pub2/pub2-mixed.xml': '''<iati-activities version="2.03">
+        <iati-activity version="2.02"><iati-identifier>BB-BBB-1</iati-identifier></iati-activity>
+        <iati-activity version="2.03"><iati-identifier>BB-BBB-2</iati-identifier></iati-activity>
+    </iati-activities>''',
+    'pub2/pub2-invalid.xml': '''<iati-activities version="2.03">
+        <iati-activity><iati-identifier>BB-BBB-3</iati-identifier>
+    </iati-activities>''',
+}
+
+
+def test_loop_stream(tmpdir):
+    """--stream gives the same output for each file as parsing the whole file."""
+    data_dir = tmpdir.mkdir('data')
+    for path, xml in STREAM_DATA.items():
+        data_dir.join(path).write(xml, ensure=True)
+
+    def loop_output(stream):
+        output_dir = tmpdir.join('out-stream' if stream else 'out')
+        args = argparse.Namespace(
+            stats_module='stats.dashboard', data=data_dir.strpath, output=output_dir.strpath, folder=None,
+            verbose_loop=False, intermediate_format='json', bundle=False, new=False, cache_dir=None, stream=stream,
+            strict=False, debug=False, today=datetime.date(2020, 1, 1), profile_stats=False, timeout=None,
+            max_memory=None, multi=1, timings_file=None)
+        run_loop(args)
+        aggregated_file = output_dir.join('aggregated-file')
+        outputs = {}
+        for dirname, dirs, files in os.walk(aggregated_file.strpath):
+            for filename in files:
+                path = os.path.join(dirname, filename)
+                with open(path) as fp:
+                    outputs[os.path.relpath(path, aggregated_file.strpath)] = json.load(fp)
+        return outputs
+
+    outputs = loop_output(stream=False)
+    # Each file was processed, including the one that isn't well formed
+    assert outputs['pub2/pub2-invalid.xml/invalidxml.json'] == 1
+    assert outputs['pub2/pub2-mixed.xml/version_mismatch.json'] == {'true': 1}
+    assert outputs['pub1/pub1-activities.xml/activities.json'] == 2
+    assert outputs['pub1/pub1-organisation.xml/organisations.json'] == 1
+    assert loop_output(stream=True) == outputs
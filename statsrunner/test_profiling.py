@@ -0,0 +1,37 @@
+import json
+
+from . import profiling
+
+
+def test_record_and_summarise():
+    profile = {}
+    for seconds in [0.001] * 98 + [0.5, 1.0]:
+        profiling.record(profile, ('ActivityStats', 'activities'), seconds)
+    summary = profiling.summarise(profile[('ActivityStats', 'activities')])
+    assert summary['calls'] == 100
+    assert summary['max'] == 1.0
+    # Percentiles are estimated to within a histogram bucket
+    assert 0.001 <= summary['p50'] < 0.0011
+    assert 0.5 <= summary['p99'] < 0.55
+
+
+def test_write_profile(tmpdir):
+    profile1 = {}
+    profile2 = {}
+    profiling.record(profile1, ('ActivityStats', 'activities'), 0.002)
+    profiling.record(profile2, ('ActivityStats', 'activities'), 0.004)
+    profiling.record(profile2, ('ActivityFileStats', 'validation'), 0.1)
+    statuses = [
+        {'file': 'pub1/file1.xml', 'profile': profile1},
+        {'file': 'pub2/file2.xml', 'profile': profile2},
+        {'file': 'pub2/file3.xml'},
+    ]
+    filename = tmpdir.join('profile', 'stats_timing.json')
+    profiling.write_profile(filename.strpath, statuses, {'xmlschema': {'hits': 1}})
+    out = json.loads(filename.read())
+    assert out['totals']['calls'] == 3
+    assert out['by_stat']['ActivityStats.activities']['calls'] == 2
+    assert out['by_stat']['ActivityStats.activities']['max'] == 0.004
+    assert out['by_class']['ActivityFileStats']['total'] == 0.1
+    assert out['by_publisher']['pub2']['calls'] == 2
+    assert out['cache_info'] == {'xmlschema': {'hits': 1}}
@@ -0,0 +1,27 @@
+from .scheduling import estimate_costs, make_chunks, tail_time
+
+
+def test_estimate_costs(tmpdir):
+    files = []
+    for name, size in [('a.xml', 100), ('b.xml', 300)]:
+        tmpdir.join('pub', name).write('x' * size, ensure=True)
+        files.append((tmpdir.join('pub', name).strpath, 'out', 'pub', name, None))
+    # b.xml has no timing, so is estimated at the same seconds per byte as a.xml
+    assert estimate_costs(files, {'pub/a.xml': 2.0}) == [2.0, 6.0]
+
+
+def test_make_chunks():
+    files = ['small1', 'large', 'small2', 'small3', 'medium']
+    costs = [1, 40, 1, 1, 5]
+    chunks = make_chunks(files, costs, 1)
+    assert chunks == [['large'], ['medium'], ['small3', 'small2', 'small1']]
+
+
+def test_tail_time():
+    statuses = [
+        {'pid': 1, 'end': 10},
+        {'pid': 1, 'end': 15},
+        {'pid': 2, 'end': 12},
+    ]
+    assert tail_time(statuses) == 3
+    assert tail_time([]) == 0
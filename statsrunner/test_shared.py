@@ -0,0 +1,32 @@
+from .shared import reset_stats_object, stat_plan
+
+
+class ExampleStats(object):
+    def b_stat(self):
+        return 'b'
+
+    def a_stat(self):
+        return self.element
+
+    def _private(self):
+        return 'private'
+
+
+class EnabledExampleStats(ExampleStats):
+    enabled_stats = ['b_stat', '_private']
+
+
+def test_stat_plan():
+    assert [name for name, function in stat_plan(ExampleStats())] == ['a_stat', 'b_stat']
+    assert [name for name, function in stat_plan(EnabledExampleStats())] == ['_private', 'b_stat']
+
+
+def test_reset_stats_object():
+    stats = reset_stats_object(ExampleStats, element='first')
+    stats.cache = {'a_stat': 'first'}
+    assert [function(stats) for name, function in stat_plan(stats)] == ['first', 'b']
+
+    reused = reset_stats_object(ExampleStats, element='second')
+    assert reused is stats
+    assert not hasattr(reused, 'cache')
+    assert [function(reused) for name, function in stat_plan(reused)] == ['second', 'b']